@@ -15,6 +15,7 @@ from . import bot
 from . import interval
 from . import gitlab
 from . import user as user_module
+from . import webhook
 
 
 class MargeBotCliArgError(Exception):
@@ -32,7 +33,26 @@ def time_interval(str_interval):
         ) from err
 
 
-def _parse_config(args):  # pylint: disable=too-many-statements
+def webhook_address(str_address):
+    try:
+        return webhook.parse_address(str_address)
+    except ValueError as err:
+        raise configargparse.ArgumentTypeError(
+            f'Invalid listen address (e.g. 0.0.0.0:8080): {str_address}'
+        ) from err
+
+
+def clone_strategy_override(str_override):
+    try:
+        str_regexp, str_strategy = str_override.rsplit('=', 1)
+        return re.compile(str_regexp), bot.CloneStrategy(str_strategy)
+    except (ValueError, re.error) as err:
+        raise configargparse.ArgumentTypeError(
+            f'Invalid clone strategy override (e.g. big/monorepo=blobless): {str_override}'
+        ) from err
+
+
+def _parse_config(args):  # pylint: disable=too-many-statements,too-many-branches
 
     def regexp(str_regex):
         try:
@@ -78,6 +98,57 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         metavar='URL',
         help='Your GitLab instance, e.g. "https://gitlab.example.com".\n',
     )
+    parser.add_argument(
+        '--api-pool-connections',
+        type=int,
+        default=10,
+        metavar='N',
+        help='How many hosts to keep a pool of persistent GitLab API connections for.\n',
+    )
+    parser.add_argument(
+        '--api-pool-maxsize',
+        type=int,
+        default=10,
+        metavar='N',
+        help='How many persistent connections to keep open to each GitLab API host.\n',
+    )
+    parser.add_argument(
+        '--api-page-concurrency',
+        type=int,
+        default=4,
+        metavar='N',
+        help='How many pages of a GitLab API listing to fetch at the same time.\n',
+    )
+    parser.add_argument(
+        '--api-connect-timeout',
+        type=time_interval,
+        default='60s',
+        help='How long to wait for a connection to the GitLab API to be established.\n',
+    )
+    parser.add_argument(
+        '--api-read-timeout',
+        type=time_interval,
+        default='60s',
+        help='How long to wait for GitLab to answer a single API request.\n',
+    )
+    parser.add_argument(
+        '--api-cache',
+        action='store_true',
+        help=(
+            'Reuse the answers to GitLab API requests for projects, users, merge requests,\n'
+            'approvals and branches for a few seconds, instead of asking again.\n'
+        ),
+    )
+    parser.add_argument(
+        '--api-etag-cache-size',
+        type=int,
+        default=1000,
+        metavar='N',
+        help=(
+            'How many GitLab API answers to keep, so as to only download them again if they changed.\n'
+            '0 turns it off.\n'
+        ),
+    )
     repo_access = parser.add_mutually_exclusive_group(required=True)
     repo_access.add_argument(
         '--use-https',
@@ -137,6 +208,29 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Enable processing MRs in batches\n',
     )
+    parser.add_argument(
+        '--batch-max-size',
+        type=int,
+        default=10,
+        help=(
+            'The most MRs to put in a batch. Within that, each batch is sized from how long\n'
+            'CI takes and how often it failed recently on its target branch.\n'
+        ),
+    )
+    parser.add_argument(
+        '--merge-train',
+        action='store_true',
+        help=(
+            'Merge MRs as a train: each MR is tested on top of the ones ahead of it in\n'
+            'the queue, with their pipelines running at the same time.\n'
+        ),
+    )
+    parser.add_argument(
+        '--merge-train-length',
+        type=int,
+        default=5,
+        help='How many pipelines of a --merge-train may run at the same time.\n',
+    )
     parser.add_argument(
         '--add-part-of',
         action='store_true',
@@ -199,6 +293,50 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         default=None,
         help='A reference repo to be used when git cloning.\n'
     )
+    parser.add_argument(
+        '--repo-cache-dir',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='Keep clones in this directory across restarts instead of cloning every project again.\n',
+    )
+    parser.add_argument(
+        '--clone-strategy',
+        type=str,
+        default='full',
+        choices=[strategy.value for strategy in bot.CloneStrategy],
+        help=(
+            'How to clone projects: everything, without file contents (blobless), without trees and\n'
+            'file contents (treeless), or only recent history (shallow), deepened as needed.\n'
+        ),
+    )
+    parser.add_argument(
+        '--project-clone-strategy',
+        type=clone_strategy_override,
+        action='append',
+        default=[],
+        metavar='REGEXP=STRATEGY',
+        help='Use another --clone-strategy for projects that match; e.g. big/monorepo=blobless.\n'
+             'Can be given several times; the first match wins.\n',
+    )
+    parser.add_argument(
+        '--targeted-fetch',
+        action='store_true',
+        help='Only fetch the branches being merged (with git protocol v2) rather than the whole remote,\n'
+             'and prune stale remote-tracking branches in the background.\n',
+    )
+    parser.add_argument(
+        '--use-worktrees',
+        action='store_true',
+        help='Process each merge request in a git worktree of its own, recycled afterwards, rather\n'
+             'than in the working tree of the clone of its project.\n',
+    )
+    parser.add_argument(
+        '--in-memory-fusion',
+        action='store_true',
+        help='Rebase and merge without checking branches out, with git merge-tree (needs git 2.40+),\n'
+             'falling back to the working tree on conflicts.\n',
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -220,23 +358,90 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Skip CI when updating individual MRs when using batches'
     )
+    parser.add_argument(
+        '--bisect-batches',
+        action='store_true',
+        help=(
+            'When the CI of a batch fails, bisect it to find the MR that broke it, unassign\n'
+            'that MR and merge the others once they pass CI without it.\n'
+        ),
+    )
     parser.add_argument(
         '--cli',
         action='store_true',
         help='Run marge-bot as a single CLI command, not a service'
     )
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        default=1,
+        help=(
+            'How many merge requests to process at the same time.\n'
+            'Each project/target branch pair gets its own lane, so merges into a single\n'
+            'target branch are still strictly serial.\n'
+        ),
+    )
+    parser.add_argument(
+        '--webhook-listen',
+        type=webhook_address,
+        default=None,
+        metavar='[HOST:]PORT',
+        help=(
+            'Listen for GitLab merge request, pipeline and note webhooks on this address, and only\n'
+            'poll for assigned merge requests every --reconcile-interval.\n'
+        ),
+    )
+    parser.add_argument(
+        '--webhook-secret',
+        type=str,
+        metavar='TOKEN',
+        help=(
+            'The secret token GitLab sends along with webhooks.\n'
+            'DISABLED because passing credentials on the command line is insecure:\n'
+            'You can still set it via ENV variable or config file.\n'
+        ),
+    )
+    parser.add_argument(
+        '--reconcile-interval',
+        type=time_interval,
+        default='5min',
+        help='How often to list all assigned merge requests when --webhook-listen is used.\n',
+    )
     parser.add_argument(
         '--guarantee-final-pipeline',
         action='store_true',
         help='Guaranteed final pipeline when assigned to marge-bot'
     )
+    parser.add_argument(
+        '--hand-off-merges',
+        action='store_true',
+        help=(
+            'Once an MR is rebased, let GitLab merge it when its pipeline succeeds, and move on\n'
+            'to other projects and target branches instead of waiting for CI.\n'
+        ),
+    )
 
     config = parser.parse_args(args)
 
     if config.use_merge_strategy and config.batch:
         raise MargeBotCliArgError('--use-merge-strategy and --batch are currently mutually exclusive')
+    if config.use_merge_strategy and config.merge_train:
+        raise MargeBotCliArgError('--use-merge-strategy and --merge-train are currently mutually exclusive')
+    if config.batch and config.merge_train:
+        raise MargeBotCliArgError('--batch and --merge-train are mutually exclusive')
     if config.use_merge_strategy and config.add_tested:
         raise MargeBotCliArgError('--use-merge-strategy and --add-tested are currently mutually exclusive')
+    if config.max_workers < 1:
+        raise MargeBotCliArgError('--max-workers must be at least 1')
+    flags = [
+        '--batch-max-size', '--merge-train-length',
+        '--api-pool-connections', '--api-pool-maxsize', '--api-page-concurrency',
+    ]
+    for flag in flags:
+        if getattr(config, flag[2:].replace("-", "_")) < 1:
+            raise MargeBotCliArgError(f'{flag} must be at least 1')
+    if config.api_etag_cache_size < 0:
+        raise MargeBotCliArgError('--api-etag-cache-size must not be negative')
     if config.rebase_remotely:
         conflicting_flag = [
             '--use-merge-strategy',
@@ -252,7 +457,7 @@ def _parse_config(args):  # pylint: disable=too-many-statements
     # pylint: disable=protected-access
     for _, (_, value) in parser._source_to_settings.get(configargparse._COMMAND_LINE_SOURCE_KEY, {}).items():
         cli_args.extend(value)
-    for bad_arg in ['--auth-token', '--ssh-key']:
+    for bad_arg in ['--auth-token', '--ssh-key', '--webhook-secret']:
         if any(bad_arg in arg for arg in cli_args):
             raise MargeBotCliArgError(f'"{bad_arg}" can only be set via ENV var or config file.')
     return config
@@ -288,7 +493,17 @@ def main(args=None):
         logging.getLogger("requests").setLevel(logging.WARNING)
 
     with _secret_auth_token_and_ssh_key(options) as (auth_token, ssh_key_file):
-        api = gitlab.Api(options.gitlab_url, auth_token)
+        api = gitlab.Api(
+            options.gitlab_url,
+            auth_token,
+            pool_connections=options.api_pool_connections,
+            # every worker and page fetcher needs its own connection, or they end up queueing for one
+            pool_maxsize=max(options.api_pool_maxsize, options.max_workers, options.api_page_concurrency),
+            page_concurrency=options.api_page_concurrency,
+            timeout=(options.api_connect_timeout.total_seconds(), options.api_read_timeout.total_seconds()),
+            cache=gitlab.ResponseCache() if options.api_cache else None,
+            etag_store_size=options.api_etag_cache_size,
+        )
         user = user_module.User.myself(api)
         if options.max_ci_time_in_minutes:
             logging.warning(
@@ -303,6 +518,9 @@ def main(args=None):
 
             logging.warning('Experimental batch mode enabled')
 
+        if options.merge_train and options.rebase_remotely:
+            raise MargeBotCliArgError("Merge trains do not work together with rebase remotely.")
+
         if options.use_merge_strategy:
             fusion = bot.Fusion.merge
         elif options.rebase_remotely:
@@ -325,6 +543,12 @@ def main(args=None):
             project_regexp=options.project_regexp,
             git_timeout=options.git_timeout,
             git_reference_repo=options.git_reference_repo,
+            repo_cache_dir=options.repo_cache_dir,
+            clone_strategy=bot.CloneStrategy(options.clone_strategy),
+            clone_strategy_overrides=options.project_clone_strategy,
+            targeted_fetch=options.targeted_fetch,
+            use_worktrees=options.use_worktrees,
+            in_memory_fusion=options.in_memory_fusion,
             merge_order=options.merge_order,
             merge_opts=bot.MergeJobOptions.default(
                 add_tested=options.add_tested,
@@ -338,10 +562,19 @@ def main(args=None):
                 use_no_ff_batches=options.use_no_ff_batches,
                 use_merge_commit_batches=options.use_merge_commit_batches,
                 skip_ci_batches=options.skip_ci_batches,
+                bisect_batches=options.bisect_batches,
                 guarantee_final_pipeline=options.guarantee_final_pipeline,
+                hand_off=options.hand_off_merges,
             ),
             batch=options.batch,
             cli=options.cli,
+            batch_max_size=options.batch_max_size,
+            merge_train=options.merge_train,
+            merge_train_length=options.merge_train_length,
+            max_workers=options.max_workers,
+            webhook_listen=options.webhook_listen,
+            webhook_secret=options.webhook_secret,
+            reconcile_interval=options.reconcile_interval,
         )
 
         marge_bot = bot.Bot(api=api, config=config)
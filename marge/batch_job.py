@@ -1,10 +1,10 @@
 # pylint: disable=too-many-branches,too-many-statements,arguments-differ
 import logging as log
-from time import sleep
 from requests.utils import quote
 
 from . import git
 from . import gitlab
+from . import polling
 from .commit import Commit
 from .job import MergeJob, CannotMerge, SkipMerge
 from .merge_request import MergeRequest
@@ -12,17 +12,36 @@ from .pipeline import Pipeline
 
 DELETE = gitlab.DELETE
 
+# How long to wait for GitLab to see that pushing to the target branch merged a merge request
+MERGED_TIMEOUT = 30
+
 
 class CannotBatch(Exception):
     pass
 
 
+class BatchCIFailed(CannotBatch):
+    """The CI of the batch MR failed."""
+
+
 class BatchMergeJob(MergeJob):
     BATCH_BRANCH_NAME = 'marge_bot_batch_merge_job'
 
-    def __init__(self, *, api, user, project, repo, config, options, merge_requests):
-        super().__init__(api=api, user=user, project=project, repo=repo, config=config, options=options)
+    def __init__(
+            self, *, api, user, project, repo, config, options, merge_requests,
+            events=None, max_batch_size=None,
+    ):
+        super().__init__(
+            api=api, user=user, project=project, repo=repo, config=config, options=options, events=events,
+        )
         self._merge_requests = merge_requests
+        self._max_batch_size = max_batch_size
+        # The merge requests that made it into the batch MR
+        self.batched_merge_requests = []
+        # The merge request that bisecting a failed batch blamed, if any
+        self.culprit = None
+        # The approvals that ensure_mergeable_mr fetched last, by MR iid, for the merge to reuse
+        self._approvals = {}
 
     def remove_batch_branch(self):
         log.info('Removing local batch branch')
@@ -66,6 +85,17 @@ class BatchMergeJob(MergeJob):
         log.info('Batch MR !%s created', batch_mr.iid)
         return batch_mr
 
+    def branches_to_fetch(self, target_branch, merge_requests):
+        """The branches of origin to fetch to fuse `merge_requests` onto `target_branch`.
+
+        The source branches of MRs from forks are fetched from the forks themselves.
+        """
+        return [target_branch] + [
+            merge_request.source_branch
+            for merge_request in merge_requests
+            if merge_request.source_project_id == self._project.id
+        ]
+
     def get_mrs_with_common_target_branch(self, target_branch):
         log.info('Filtering MRs with target branch %s', target_branch)
         return [
@@ -73,20 +103,34 @@ class BatchMergeJob(MergeJob):
             if merge_request.target_branch == target_branch
         ]
 
-    def ensure_mergeable_mr(self, merge_request, skip_ci=False):
-        super().ensure_mergeable_mr(merge_request)
+    def ensure_mergeable_mr(self, merge_request, skip_ci=False, *, refetch=True):
+        pipelines = self._project.only_allow_merge_if_pipeline_succeeds and not skip_ci
+        mergeability, = self.fetch_mergeability([merge_request], refetch=refetch, pipelines=pipelines)
+        self.check_mergeable_mr(merge_request, mergeability)
+        return mergeability.approvals
+
+    def check_mergeable_mr(self, merge_request, mergeability):
+        super().check_mergeable_mr(merge_request, mergeability)
+        self._approvals[merge_request.iid] = mergeability.approvals
 
-        if self._project.only_allow_merge_if_pipeline_succeeds and not skip_ci:
-            ci_status = self.get_mr_ci_status(merge_request)
-            if ci_status != 'success':
+        if mergeability.pipelines is not None:
+            if self.ci_status(merge_request, mergeability.pipelines) != 'success':
                 raise CannotBatch('This MR has not passed CI.')
 
     def get_mergeable_mrs(self, merge_requests):
         log.info('Filtering mergeable MRs')
+        if not merge_requests:
+            return []
+
+        # Only the fetching runs concurrently; the checks, and any comments or unassigning
+        # they lead to, happen here in order
+        mergeabilities = self.fetch_mergeability(
+            merge_requests, pipelines=self._project.only_allow_merge_if_pipeline_succeeds,
+        )
         mergeable_mrs = []
-        for merge_request in merge_requests:
+        for merge_request, mergeability in zip(merge_requests, mergeabilities):
             try:
-                self.ensure_mergeable_mr(merge_request)
+                self.check_mergeable_mr(merge_request, mergeability)
             except (CannotBatch, SkipMerge) as ex:
                 log.warning('Skipping unbatchable MR: "%s"', ex)
             except CannotMerge as ex:
@@ -100,17 +144,93 @@ class BatchMergeJob(MergeJob):
     def push_batch(self):
         log.info('Pushing batch branch')
         self._repo.push(BatchMergeJob.BATCH_BRANCH_NAME, force=True)
+        self._api.invalidate_cache(f'/projects/{self._project.id}/')
+
+    def find_culprit(self, batch_mr, merge_requests, batch_shas):
+        """Bisect a failed batch down to the first merge request that breaks the build.
+
+        `batch_shas[i]` is the batch branch with `merge_requests[:i + 1]` on top of the
+        target branch, and the last of them is known to fail CI. Returns the index of the
+        culprit in `merge_requests`.
+        """
+        # merge_requests[:good] passes CI, merge_requests[:bad] doesn't
+        good, bad = 0, len(merge_requests)
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            sha = batch_shas[middle - 1]
+            log.info('Bisecting batch MR !%s: trying the first %s MRs (%s)', batch_mr.iid, middle, sha)
+            self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, sha)
+            self.push_batch()
+            try:
+                self.wait_for_ci_to_pass(batch_mr, commit_sha=sha)
+            except CannotMerge as err:
+                log.info('The first %s MRs failed: %s', middle, err.reason)
+                bad = middle
+            else:
+                good = middle
+        return bad - 1
+
+    def drop_culprit(self, batch_mr, merge_requests, batch_shas, reason):
+        """Unassign the merge request that broke the batch, and batch up the others again.
+
+        Those after the culprit are put back on top of those before it, which passed CI
+        together, and tested once more. Returns the merge requests that passed CI without
+        the culprit and the sha they were tested at. If the second try fails too, those
+        after the culprit are left for the next batch.
+        """
+        index = self.find_culprit(batch_mr, merge_requests, batch_shas)
+        self.culprit = merge_requests[index]
+        log.warning('MR !%s broke batch MR !%s', self.culprit.iid, batch_mr.iid)
+        self.unassign_from_mr(self.culprit)
+        self.culprit.comment(
+            f'Batch MR !{batch_mr.iid} failed: {reason} Bisecting it showed that this MR breaks the build.',
+        )
+
+        good_merge_requests = merge_requests[:index]
+        good_sha = batch_shas[index - 1] if index else None
+        rest = merge_requests[index + 1:]
+        if rest:
+            self._repo.checkout_branch(
+                BatchMergeJob.BATCH_BRANCH_NAME, good_sha or f'origin/{batch_mr.target_branch}',
+            )
+            rebuilt, rebuilt_shas = self.add_to_batch(batch_mr, rest)
+            if rebuilt and self.passes_ci_without_culprit(batch_mr, rebuilt_shas[-1]):
+                good_merge_requests += rebuilt
+                good_sha = rebuilt_shas[-1]
+
+        for merge_request in rest:
+            if merge_request not in good_merge_requests:
+                merge_request.comment(
+                    f'Batch MR !{batch_mr.iid} failed because of !{self.culprit.iid}. I will retry later...',
+                )
+        if not good_merge_requests:
+            return [], None
+
+        if self._options.use_merge_commit_batches:
+            # The batch MR itself gets merged, so it must point to what passed
+            self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, good_sha)
+            self.push_batch()
+        return good_merge_requests, good_sha
+
+    def passes_ci_without_culprit(self, batch_mr, sha):
+        log.info('Trying batch MR !%s again without !%s (%s)', batch_mr.iid, self.culprit.iid, sha)
+        self.push_batch()
+        try:
+            self.wait_for_ci_to_pass(batch_mr, commit_sha=sha)
+        except CannotMerge as err:
+            log.info('Batch MR !%s failed without !%s too: %s', batch_mr.iid, self.culprit.iid, err.reason)
+            return False
+        return True
 
     def ensure_mr_not_changed(self, merge_request):
+        """Raise if `merge_request` changed since we last fetched it, which refreshes it."""
         log.info('Ensuring MR !%s did not change', merge_request.iid)
-        changed_mr = MergeRequest.fetch_by_iid(
-            merge_request.project_id,
-            merge_request.iid,
-            self._api,
-        )
+        attrs = ('source_branch', 'source_project_id', 'target_branch', 'target_project_id', 'sha')
+        before = {attr: getattr(merge_request, attr) for attr in attrs}
+        merge_request.refetch_info()
         error_message = 'The {} changed whilst merging!'
-        for attr in ('source_branch', 'source_project_id', 'target_branch', 'target_project_id', 'sha'):
-            if getattr(changed_mr, attr) != getattr(merge_request, attr):
+        for attr in attrs:
+            if getattr(merge_request, attr) != before[attr]:
                 raise CannotMerge(error_message.format(attr.replace('_', ' ')))
 
     def merge_batch(self, target_branch, source_branch, no_ff=False):
@@ -129,14 +249,14 @@ class BatchMergeJob(MergeJob):
     def update_merge_request(
         self,
         merge_request,
-        source_repo_url=None,
+        source_remote=None,
     ):
         log.info('Fusing MR !%s', merge_request.iid)
-        approvals = merge_request.fetch_approvals()
+        approvals = self._approvals.pop(merge_request.iid, None) or merge_request.fetch_approvals()
 
         _, _, actual_sha = self.update_from_target_branch_and_push(
             merge_request,
-            source_repo_url=source_repo_url,
+            source_remote=source_remote,
             skip_ci=self._options.skip_ci_batches,
         )
 
@@ -160,7 +280,7 @@ class BatchMergeJob(MergeJob):
         self,
         merge_request,
         expected_remote_target_branch_sha,
-        source_repo_url=None,
+        source_remote=None,
     ):
         log.info('Accept MR !%s', merge_request.iid)
 
@@ -172,7 +292,7 @@ class BatchMergeJob(MergeJob):
         # Rebase and apply the trailers
         self.update_merge_request(
             merge_request,
-            source_repo_url=source_repo_url,
+            source_remote=source_remote,
         )
 
         # This switches git to <target_branch>
@@ -183,10 +303,21 @@ class BatchMergeJob(MergeJob):
         )
         # Don't force push in case the remote has changed.
         self._repo.push(merge_request.target_branch, force=False)
-
-        sleep(2)
-
-        # At this point Gitlab should have recognised the MR as being accepted.
+        self.forget_cached(merge_request)
+
+        def merged():
+            merge_request.refetch_info(fresh=True)
+            return merge_request.state == 'merged'
+
+        # Wait for GitLab to recognise the MR as merged before cleaning up after it
+        if not polling.wait_until(
+                merged,
+                timeout=MERGED_TIMEOUT,
+                name='batched merge request to be merged',
+                events=self._events,
+                match=merge_request.is_event_about_me,
+        ):
+            log.warning('GitLab does not show !%s as merged yet, carrying on', merge_request.iid)
         log.info('Successfully merged MR !%s', merge_request.iid)
 
         pipelines = Pipeline.pipelines_by_branch(
@@ -208,39 +339,19 @@ class BatchMergeJob(MergeJob):
 
         return final_sha
 
-    def execute(self):
-        # Cleanup previous batch work
-        self.remove_batch_branch()
-        self.close_batch_mr()
-
-        target_branch = self._merge_requests[0].target_branch
-        merge_requests = self.get_mrs_with_common_target_branch(target_branch)
-        merge_requests = self.get_mergeable_mrs(merge_requests)
-
-        if len(merge_requests) <= 1:
-            # Either no merge requests are ready to be merged, or there's only one for this target branch.
-            # Let's raise an error to do a basic job for these cases.
-            raise CannotBatch('not enough ready merge requests')
-
-        self._repo.fetch('origin')
-
-        # Save the sha of remote <target_branch> so we can use it to make sure
-        # the remote wasn't changed while we're testing against it
-        remote_target_branch_sha = self._repo.get_commit_hash(f'origin/{target_branch}')
-
-        self._repo.checkout_branch(target_branch, f'origin/{target_branch}')
-        self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, f'origin/{target_branch}')
-
-        batch_mr = self.create_batch_mr(
-            target_branch=target_branch,
-        )
-        batch_mr_sha = batch_mr.sha
+    def add_to_batch(self, batch_mr, merge_requests):
+        """Put `merge_requests` on top of the batch branch, one after the other.
 
+        Those that don't rebase cleanly are skipped. Returns the merge requests that made
+        it and `batch_shas`, where `batch_shas[i]` is the batch branch once the first
+        `i + 1` of them are in.
+        """
         working_merge_requests = []
+        batch_shas = []
 
         for merge_request in merge_requests:
             try:
-                _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
+                _, source_remote, merge_request_remote = self.fetch_source_project(merge_request)
                 self._repo.checkout_branch(
                     merge_request.source_branch,
                     f'{merge_request_remote}/{merge_request.source_branch}',
@@ -250,7 +361,7 @@ class BatchMergeJob(MergeJob):
                     # Rebase and apply the trailers before running the batch MR
                     actual_sha = self.update_merge_request(
                         merge_request,
-                        source_repo_url=source_repo_url,
+                        source_remote=source_remote,
                     )
                     # Update <batch> branch with MR changes
                     batch_mr_sha = self._repo.merge(
@@ -266,7 +377,7 @@ class BatchMergeJob(MergeJob):
                     self.fuse(
                         merge_request.source_branch,
                         BatchMergeJob.BATCH_BRANCH_NAME,
-                        source_repo_url=source_repo_url,
+                        source_remote=source_remote,
                         local=True,
                     )
                     # Update <batch> branch with MR changes
@@ -289,9 +400,44 @@ class BatchMergeJob(MergeJob):
                     merge_request.update_sha(actual_sha)
 
                 working_merge_requests.append(merge_request)
+                batch_shas.append(batch_mr_sha)
+        return working_merge_requests, batch_shas
+
+    def execute(self):
+        # Cleanup previous batch work
+        self.remove_batch_branch()
+        self.close_batch_mr()
+
+        target_branch = self._merge_requests[0].target_branch
+        merge_requests = self.get_mrs_with_common_target_branch(target_branch)
+        merge_requests = self.get_mergeable_mrs(merge_requests)
+        if self._max_batch_size is not None:
+            merge_requests = merge_requests[:self._max_batch_size]
 
+        if len(merge_requests) <= 1:
+            # Either no merge requests are ready to be merged, or there's only one for this target branch.
+            # Let's raise an error to do a basic job for these cases.
+            raise CannotBatch('not enough ready merge requests')
+
+        self._repo.fetch('origin', branches=self.branches_to_fetch(target_branch, merge_requests))
+
+        # Save the sha of remote <target_branch> so we can use it to make sure
+        # the remote wasn't changed while we're testing against it
+        remote_target_branch_sha = self._repo.get_commit_hash(f'origin/{target_branch}')
+
+        self._repo.checkout_branch(target_branch, f'origin/{target_branch}')
+        self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, f'origin/{target_branch}')
+
+        batch_mr = self.create_batch_mr(
+            target_branch=target_branch,
+        )
+
+        working_merge_requests, batch_shas = self.add_to_batch(batch_mr, merge_requests)
         if len(working_merge_requests) <= 1:
             raise CannotBatch('not enough ready merge requests')
+        batch_mr_sha = batch_shas[-1]
+
+        self.batched_merge_requests = working_merge_requests
 
         # This switches git to <batch> branch
         self.push_batch()
@@ -303,27 +449,34 @@ class BatchMergeJob(MergeJob):
             try:
                 self.wait_for_ci_to_pass(batch_mr, commit_sha=batch_mr_sha)
             except CannotMerge as err:
-                for merge_request in working_merge_requests:
-                    merge_request.comment(
-                        f'Batch MR !{batch_mr.iid} failed: {err.reason} I will retry later...',
-                    )
-                raise CannotBatch(err.reason) from err
+                if not self._options.bisect_batches:
+                    for merge_request in working_merge_requests:
+                        merge_request.comment(
+                            f'Batch MR !{batch_mr.iid} failed: {err.reason} I will retry later...',
+                        )
+                    raise BatchCIFailed(err.reason) from err
+
+                working_merge_requests, batch_mr_sha = self.drop_culprit(
+                    batch_mr, working_merge_requests, batch_shas, err.reason,
+                )
+                if not working_merge_requests:
+                    return
 
         # check each sub MR, and accept each sub MR if using the normal batch
         for merge_request in working_merge_requests:
             try:
                 # FIXME: this should probably be part of the merge request
-                _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
+                _, source_remote, _ = self.fetch_source_project(merge_request)
                 self.ensure_mr_not_changed(merge_request)
                 # we know the batch MR's CI passed, so we skip CI for sub MRs this time
-                self.ensure_mergeable_mr(merge_request, skip_ci=True)
+                self.ensure_mergeable_mr(merge_request, skip_ci=True, refetch=False)
 
                 if not self._options.use_merge_commit_batches:
                     # accept each MRs
                     remote_target_branch_sha = self.accept_mr(
                         merge_request,
                         remote_target_branch_sha,
-                        source_repo_url=source_repo_url,
+                        source_remote=source_remote,
                     )
             except CannotBatch as err:
                 merge_request.comment(
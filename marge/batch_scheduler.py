@@ -0,0 +1,92 @@
+"""
+Decides how many merge requests to put in the next batch of a lane.
+
+A bigger batch merges more merge requests per pipeline when it passes, but is more likely to
+fail, and a failed batch costs a whole pipeline plus a single merge to make progress. For each
+lane (project, target branch), we remember how recent batches and single merges went, estimate
+the chance `p` that any one merge request breaks the build, and pick the size `n` maximizing the
+expected number of merged merge requests per unit of time:
+
+    s = (1 - p) ** n        # chance the batch passes
+    rate(n) = (s * n + (1 - s) * (1 - p)) / (batch_duration + (1 - s) * single_duration)
+
+against `(1 - p) / single_duration` for merging one merge request at a time.
+"""
+import collections
+import logging as log
+import threading
+from collections import namedtuple
+
+# Until we know better, assume one merge request in ten breaks the build.
+PRIOR_FAILURES = 1
+PRIOR_MERGE_REQUESTS = 10
+
+
+class Outcome(namedtuple('Outcome', 'size passed duration')):
+    """How a batch (or, with `size` 1, a single merge) went.
+
+    `passed` is `None` when we don't know, and `duration` is in seconds.
+    """
+
+
+class BatchScheduler:
+
+    def __init__(self, max_batch_size, window=20):
+        assert max_batch_size >= 1, max_batch_size
+        self._max_batch_size = max_batch_size
+        self._window = window
+        self._lock = threading.Lock()
+        self._outcomes = {}
+
+    def record(self, lane, size, passed, duration):
+        """Remember how a batch of `size` merge requests (or a single merge) of `lane` went."""
+        with self._lock:
+            outcomes = self._outcomes.setdefault(lane, collections.deque(maxlen=self._window))
+            outcomes.append(Outcome(size, passed, duration))
+
+    def failure_rate(self, lane):
+        """The estimated chance that a merge request of `lane` fails CI."""
+        with self._lock:
+            outcomes = list(self._outcomes.get(lane, ()))
+        outcomes = [outcome for outcome in outcomes if outcome.passed is not None]
+        # a failed batch tells us at least one of its merge requests was broken
+        failures = sum(1 for outcome in outcomes if not outcome.passed)
+        merge_requests = sum(outcome.size for outcome in outcomes)
+        return (failures + PRIOR_FAILURES) / (merge_requests + PRIOR_MERGE_REQUESTS)
+
+    def durations(self, lane):
+        """The mean duration of a batch and of a single merge in `lane`, in seconds."""
+        with self._lock:
+            outcomes = list(self._outcomes.get(lane, ()))
+
+        def mean(durations):
+            return sum(durations) / len(durations) if durations else None
+
+        batch = mean([outcome.duration for outcome in outcomes if outcome.size > 1])
+        single = mean([outcome.duration for outcome in outcomes if outcome.size == 1])
+        if batch is None and single is None:
+            return 1, 1  # only their ratio matters
+        return batch or single, single or batch
+
+    def batch_size(self, lane, queued):
+        """How many of the `queued` merge requests of `lane` to batch; 1 means don't batch."""
+        limit = min(queued, self._max_batch_size)
+        if limit <= 1:
+            return limit
+
+        p = self.failure_rate(lane)  # pylint: disable=invalid-name
+        batch_duration, single_duration = self.durations(lane)
+
+        def rate(size):
+            if size == 1:
+                return (1 - p) / single_duration
+            passes = (1 - p) ** size
+            merged = passes * size + (1 - passes) * (1 - p)
+            return merged / (batch_duration + (1 - passes) * single_duration)
+
+        size = max(range(1, limit + 1), key=rate)
+        log.debug(
+            'Lane %s: failure rate %.2f, batch %.0fs, single %.0fs: batching %d of %d',
+            lane, p, batch_duration, single_duration, size, queued,
+        )
+        return size
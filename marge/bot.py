@@ -1,13 +1,24 @@
+import contextlib
 import logging as log
+import os
+import threading
 import time
 from collections import namedtuple
+from concurrent import futures
 from tempfile import TemporaryDirectory
 
+from . import batch_job
+from . import batch_scheduler
 from . import git
+from . import gitlab
+from . import hand_off
 from . import job
 from . import merge_request as merge_request_module
+from . import polling
 from . import single_merge_job
 from . import store
+from . import train_job
+from . import webhook
 from .project import Project
 
 MergeRequest = merge_request_module.MergeRequest
@@ -21,6 +32,28 @@ class Bot:
         self._matching_projects_last_refresh = None
         self._cached_projects = None
 
+        # Set whenever there may be new work: a webhook arrived or a lane finished.
+        self._wakeup = threading.Event()
+        self._events = None
+        if config.webhook_listen:
+            self._events = webhook.EventHub()
+            self._events.subscribe(self._on_event)
+        # With webhooks, the assigned merge requests are tracked in memory between reconciliations
+        self._assigned_lock = threading.Lock()
+        self._assigned = None
+        self._stale_merge_requests = set()
+        self._last_reconciliation = None
+        self._assigned_at_cache = merge_request_module.AssignedAtCache()
+        self._batch_scheduler = None
+        if config.batch:
+            self._batch_scheduler = batch_scheduler.BatchScheduler(max_batch_size=config.batch_max_size)
+        # The merge requests handed off to GitLab to merge when their pipeline succeeds
+        self._hand_offs = None
+        if config.merge_opts.hand_off:
+            self._hand_offs = hand_off.HandOffReconciler(
+                api=api, user=config.user, timeout=config.merge_opts.ci_timeout,
+            )
+
         user = config.user
         opts = config.merge_opts
 
@@ -34,7 +67,7 @@ class Bot:
 
     def start(self):
         skip_clone = self._config.merge_opts.fusion is Fusion.gitlab_rebase
-        with TemporaryDirectory() as root_dir:
+        with self._repos_root_dir() as root_dir:
             if self._config.use_only_gitlab_api:
                 repo_manager = store.ApiOnlyRepoManager(
                     user=self.user,
@@ -42,6 +75,7 @@ class Bot:
                     skip_clone=skip_clone,
                     timeout=self._config.git_timeout,
                     reference=self._config.git_reference_repo,
+                    persistent=self._config.repo_cache_dir is not None,
                 )
             elif self._config.use_https:
                 repo_manager = store.HttpsRepoManager(
@@ -51,6 +85,12 @@ class Bot:
                     auth_token=self._config.auth_token,
                     timeout=self._config.git_timeout,
                     reference=self._config.git_reference_repo,
+                    persistent=self._config.repo_cache_dir is not None,
+                    clone_strategy=self._config.clone_strategy,
+                    clone_strategy_overrides=self._config.clone_strategy_overrides,
+                    targeted_fetch=self._config.targeted_fetch,
+                    worktrees=self._config.use_worktrees,
+                    in_memory_fusion=self._config.in_memory_fusion,
                 )
             else:
                 repo_manager = store.SshRepoManager(
@@ -60,8 +100,61 @@ class Bot:
                     ssh_key_file=self._config.ssh_key_file,
                     timeout=self._config.git_timeout,
                     reference=self._config.git_reference_repo,
+                    persistent=self._config.repo_cache_dir is not None,
+                    clone_strategy=self._config.clone_strategy,
+                    clone_strategy_overrides=self._config.clone_strategy_overrides,
+                    targeted_fetch=self._config.targeted_fetch,
+                    worktrees=self._config.use_worktrees,
+                    in_memory_fusion=self._config.in_memory_fusion,
                 )
-            self._run(repo_manager)
+            with self._webhook_listener(), repo_manager.pruning():
+                self._run(repo_manager)
+
+    @contextlib.contextmanager
+    def _repos_root_dir(self):
+        cache_dir = self._config.repo_cache_dir
+        if cache_dir is None:
+            with TemporaryDirectory() as root_dir:
+                yield root_dir
+            return
+
+        os.makedirs(cache_dir, exist_ok=True)
+        yield cache_dir
+
+    @contextlib.contextmanager
+    def _webhook_listener(self):
+        if not self._events:
+            yield
+            return
+
+        server = webhook.WebhookServer(
+            self._config.webhook_listen,
+            hub=self._events,
+            secret=self._config.webhook_secret,
+        )
+        server.start()
+        try:
+            yield
+        finally:
+            server.stop()
+
+    def _on_event(self, event):
+        if event.merge_request_iid is not None and event.project_id is not None:
+            key = (event.project_id, event.merge_request_iid)
+            with self._assigned_lock:
+                # Only merge request events can assign an MR to me; others matter for mine only
+                if event.kind == webhook.MERGE_REQUEST_HOOK or key in (self._assigned or {}):
+                    self._stale_merge_requests.add(key)
+        self._wakeup.set()
+
+    def _sleep(self, secs):
+        """Sleep for `secs`, or less if a webhook or a finished lane brings new work."""
+        if self._events:
+            # webhooks tell us about new work, polling is only a fallback
+            secs = max(secs, self._config.reconcile_interval.total_seconds())
+        log.debug('Sleeping for up to %s seconds...', secs)
+        self._wakeup.wait(secs)
+        self._wakeup.clear()
 
     @property
     def user(self):
@@ -72,31 +165,103 @@ class Bot:
         return self._api
 
     def _run(self, repo_manager):
-        time_to_sleep_between_merges_in_secs = 1
+        if self._config.max_workers > 1:
+            self._run_lanes(repo_manager)
+            return
+
         time_to_sleep_when_no_mrs_found_in_secs = 15
         while True:
-            project, merge_request = self._get_assigned_merge_requests()
+            project, merge_requests = self._get_assigned_merge_requests()
 
-            if merge_request:
-                self._process_merge_request(repo_manager, project, merge_request)
+            if merge_requests:
+                self._process_merge_requests(repo_manager, project, merge_requests)
                 if not self._config.cli:
                     # Continue with the next MR without sleeping
-                    time.sleep(time_to_sleep_between_merges_in_secs)
                     continue
 
-            if self._config.cli:
+            if self._config.cli and not self._hand_offs_pending():
                 return
 
-            log.debug('Sleeping for %s seconds...', time_to_sleep_when_no_mrs_found_in_secs)
-            time.sleep(time_to_sleep_when_no_mrs_found_in_secs)
+            self._sleep(time_to_sleep_when_no_mrs_found_in_secs)
+
+    def _run_lanes(self, repo_manager):
+        """Process merge requests of different lanes at the same time.
+
+        A lane is a (project, target branch) pair: merges into one target branch stay strictly
+        serial, but a merge request waiting for CI no longer holds up every other project.
+        Lanes of the same project share its clone, so only one of them runs at a time; the others
+        wait their turn without taking up a worker.
+        """
+        time_to_sleep_when_no_mrs_found_in_secs = 15
+        max_workers = self._config.max_workers
+        busy_lanes = {}
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='marge-lane') as executor:
+            while True:
+                for lane, future in list(busy_lanes.items()):
+                    if future.done():
+                        del busy_lanes[lane]
+                        # Re-raise anything the worker died of, like the serial loop would
+                        future.result()
+
+                if len(busy_lanes) < max_workers:
+                    busy_projects = {project_id for project_id, _ in busy_lanes}
+                    for lane, (project, merge_requests) in self._iter_assigned_lanes():
+                        if project.id in busy_projects:
+                            continue
+
+                        log.info('Starting lane %s for MR !%s', lane, merge_requests[0].iid)
+                        busy_lanes[lane] = executor.submit(
+                            self._process_merge_requests, repo_manager, project, merge_requests,
+                        )
+                        busy_lanes[lane].add_done_callback(lambda _: self._wakeup.set())
+                        busy_projects.add(project.id)
+                        if len(busy_lanes) >= max_workers:
+                            break
+
+                if self._config.cli and not busy_lanes and not self._hand_offs_pending():
+                    return
+
+                if busy_lanes:
+                    log.debug('%d lane(s) busy', len(busy_lanes))
+                self._sleep(time_to_sleep_when_no_mrs_found_in_secs)
 
     def _get_assigned_merge_requests(self):
-        log.debug('Fetching merge requests assigned to me...')
-        my_merge_requests = MergeRequest.fetch_all_open_assigned_to_me(
-            user=self.user,
-            api=self._api,
-            merge_order=self._config.merge_order,
-        )
+        """The project and assigned merge requests of the lane whose turn it is."""
+        _, lane_merge_requests = next(self._iter_assigned_lanes(), (None, (None, [])))
+        return lane_merge_requests
+
+    def _hand_offs_pending(self):
+        return self._hand_offs is not None and self._hand_offs.pending
+
+    def _iter_assigned_lanes(self):
+        """Group the assigned merge requests by lane, in merge order of the first one of each lane.
+
+        Lanes waiting for GitLab to merge a merge request handed off to it are left out.
+        """
+        handed_off_lanes = set()
+        if self._hand_offs is not None:
+            self._hand_offs.reconcile()
+            handed_off_lanes = self._hand_offs.busy_lanes()
+
+        lanes = {}
+        for project, merge_request in self._iter_assigned_merge_requests():
+            lane = (project.id, merge_request.target_branch)
+            if lane not in handed_off_lanes:
+                lanes.setdefault(lane, (project, []))[1].append(merge_request)
+        return iter(lanes.items())
+
+    def _iter_assigned_merge_requests(self):
+        if self._events:
+            my_merge_requests = self._tracked_merge_requests()
+        else:
+            log.debug('Fetching merge requests assigned to me...')
+            my_merge_requests = MergeRequest.fetch_all_open_assigned_to_me(
+                user=self.user,
+                api=self._api,
+                merge_order=self._config.merge_order,
+                assigned_at_cache=self._assigned_at_cache,
+            )
 
         self._refresh_cached_projects(forced=False)
 
@@ -115,9 +280,56 @@ class Bot:
                           merge_request.iid, merge_request.project_id)
                 continue
 
-            return (self._cached_projects[merge_request.project_id], merge_request)
+            yield self._cached_projects[merge_request.project_id], merge_request
+
+    def _tracked_merge_requests(self):
+        """The merge requests assigned to me, as learnt from webhooks.
+
+        Every `reconcile_interval` we fall back to listing them all, in case we missed an event.
+        """
+        with self._assigned_lock:
+            stale, self._stale_merge_requests = self._stale_merge_requests, set()
+
+        reconciliation_due = (
+            self._assigned is None
+            or time.time() - self._last_reconciliation > self._config.reconcile_interval.total_seconds()
+        )
+        if reconciliation_due:
+            log.debug('Reconciling merge requests assigned to me...')
+            self._assigned = {
+                (merge_request.project_id, merge_request.iid): merge_request
+                for merge_request in MergeRequest.fetch_all_open_assigned_to_me(
+                    user=self.user,
+                    api=self._api,
+                    merge_order=self._config.merge_order,
+                    assigned_at_cache=self._assigned_at_cache,
+                )
+            }
+            self._last_reconciliation = time.time()
+            return list(self._assigned.values())
+
+        for project_id, merge_request_iid in stale:
+            log.debug('Refreshing MR !%s of project %s after a webhook', merge_request_iid, project_id)
+            try:
+                merge_request = MergeRequest.fetch_by_iid(project_id, merge_request_iid, self._api)
+            except gitlab.NotFound:
+                merge_request = None
+
+            still_mine = merge_request and merge_request.state == 'opened' and (
+                self.user.id in merge_request.assignee_ids
+            )
+            if still_mine:
+                self._assigned[(project_id, merge_request_iid)] = merge_request
+            else:
+                self._assigned.pop((project_id, merge_request_iid), None)
 
-        return (None, None)
+        return MergeRequest.sorted_by_merge_order(
+            list(self._assigned.values()),
+            user=self.user,
+            api=self._api,
+            merge_order=self._config.merge_order,
+            assigned_at_cache=self._assigned_at_cache,
+        )
 
     def _refresh_cached_projects(self, forced):
         if forced or not self._cached_projects or self._matching_projects_last_refresh < (time.time() - 900):
@@ -133,17 +345,115 @@ class Bot:
 
             self._matching_projects_last_refresh = time.time()
 
-    def _process_merge_request(self, repo_manager, project, merge_request):
-        if not merge_request:
+    def _process_merge_requests(self, repo_manager, project, merge_requests):
+        if not merge_requests:
             log.debug('Nothing to merge at this point...')
             return
 
+        # Lanes of the same project share a clone, so only one of them may drive it at a time
+        with repo_manager.project_lock(project), contextlib.ExitStack() as stack:
+            try:
+                repo = stack.enter_context(repo_manager.checkout(project))
+            except git.GitError:
+                log.exception("Couldn't initialize repository for project!")
+                raise
+
+            try:
+                if self._config.merge_train and self._try_train(project, merge_requests, repo):
+                    return
+                if self._batch_scheduler and self._try_batch(project, merge_requests, repo):
+                    return
+                self._process_merge_request(project, merge_requests[0], repo)
+            finally:
+                # Whatever happened, don't trust our in-memory copy of them anymore
+                with self._assigned_lock:
+                    self._stale_merge_requests.update((mr.project_id, mr.iid) for mr in merge_requests)
+                if self._api.cache is not None:
+                    log.info('API cache: %(hits)s hits, %(misses)s misses, %(entries)s entries',
+                             self._api.cache.stats())
+                log.debug('Time spent waiting for GitLab: %s', polling.WAITS.summary())
+
+    def _try_batch(self, project, merge_requests, repo):
+        """Try to merge a batch of `merge_requests`; return whether we should stop there."""
+        lane = (project.id, merge_requests[0].target_branch)
+        batch_size = self._batch_scheduler.batch_size(lane, len(merge_requests))
+        if batch_size <= 1:
+            return False
+
+        log.info('Attempting to merge up to %s of %s MRs as a batch...', batch_size, len(merge_requests))
+        batch_merge_job = batch_job.BatchMergeJob(
+            api=self._api,
+            user=self.user,
+            project=project,
+            merge_requests=merge_requests,
+            repo=repo,
+            config=self._config,
+            options=self._config.merge_opts,
+            events=self._events,
+            max_batch_size=batch_size,
+        )
+        time_0 = time.monotonic()
         try:
-            repo = repo_manager.repo_for_project(project)
+            batch_merge_job.execute()
+        except batch_job.BatchCIFailed as err:
+            log.warning('BatchMergeJob failed CI: %s', err)
+            self._batch_scheduler.record(
+                lane, len(batch_merge_job.batched_merge_requests), False, time.monotonic() - time_0,
+            )
+        except batch_job.CannotBatch as err:
+            log.warning('BatchMergeJob aborted: %s', err)
+        except job.CannotMerge as err:
+            log.warning('BatchMergeJob failed: %s', err)
+            return True
         except git.GitError:
-            log.exception("Couldn't initialize repository for project!")
-            raise
+            log.exception('BatchMergeJob failed')
+        else:
+            # With --bisect-batches, a failed batch still merges what it can
+            passed = batch_merge_job.culprit is None
+            self._batch_scheduler.record(
+                lane, len(batch_merge_job.batched_merge_requests), passed, time.monotonic() - time_0,
+            )
+            return True
+
+        log.info('Falling back to merging the oldest MR on its own...')
+        return False
 
+    def _try_train(self, project, merge_requests, repo):
+        """Try to merge `merge_requests` as a train; return whether we should stop there."""
+        if len(merge_requests) <= 1:
+            return False
+
+        log.info('Attempting to merge %s MRs as a train...', len(merge_requests))
+        merge_train_job = train_job.MergeTrainJob(
+            api=self._api,
+            user=self.user,
+            project=project,
+            merge_requests=merge_requests,
+            repo=repo,
+            config=self._config,
+            options=self._config.merge_opts,
+            events=self._events,
+            train_length=self._config.merge_train_length,
+        )
+        try:
+            merge_train_job.execute()
+        except batch_job.CannotBatch as err:
+            log.warning('MergeTrainJob aborted: %s', err)
+        except job.CannotMerge as err:
+            log.warning('MergeTrainJob failed: %s', err)
+            return True
+        except git.GitError:
+            log.exception('MergeTrainJob failed')
+        else:
+            return True
+
+        if merge_train_job.merged_merge_requests:
+            # The queue moved on; look at it again before merging anything else
+            return True
+        log.info('Falling back to merging the oldest MR on its own...')
+        return False
+
+    def _process_merge_request(self, project, merge_request, repo):
         log.debug('Attempting to merge MR...')
         merge_job = self._get_single_job(
             project=project,
@@ -152,7 +462,14 @@ class Bot:
             config=self._config,
             options=self._config.merge_opts,
         )
+        time_0 = time.monotonic()
         merge_job.execute()
+        if self._hand_offs is not None and merge_job.handed_off:
+            self._hand_offs.add(merge_request, *merge_job.handed_off)
+            return
+        if self._batch_scheduler:
+            lane = (project.id, merge_request.target_branch)
+            self._batch_scheduler.record(lane, 1, None, time.monotonic() - time_0)
 
     def _get_single_job(self, project, merge_request, repo, config, options):
         return single_merge_job.SingleMergeJob(
@@ -163,15 +480,21 @@ class Bot:
             repo=repo,
             config=config,
             options=options,
+            events=self._events,
         )
 
 
 class BotConfig(namedtuple('BotConfig',
                            'user use_https auth_token ssh_key_file project_regexp merge_order merge_opts '
                            + 'git_timeout git_reference_repo batch cli '
-                           + 'use_only_gitlab_api')):
+                           + 'use_only_gitlab_api max_workers '
+                           + 'webhook_listen webhook_secret reconcile_interval repo_cache_dir '
+                           + 'clone_strategy clone_strategy_overrides batch_max_size '
+                           + 'merge_train merge_train_length targeted_fetch use_worktrees '
+                           + 'in_memory_fusion')):
     pass
 
 
 MergeJobOptions = job.MergeJobOptions
 Fusion = job.Fusion
+CloneStrategy = git.CloneStrategy
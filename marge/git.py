@@ -1,4 +1,6 @@
+import enum
 import logging as log
+import re
 import shlex
 import os
 import sys
@@ -18,103 +20,260 @@ from . import trailerfilter
 GIT_SSH_COMMAND = "ssh -o StrictHostKeyChecking=no "
 
 
-def _filter_branch_script(trailer_name, trailer_values):
-    trailers = shlex.quote(
-        '\n'.join(
-            f'{trailer_name}: {trailer_value}'
-            for trailer_value in trailer_values or ['']
-        )
-    )
+# pylint: disable=invalid-name
+@enum.unique
+class CloneStrategy(enum.Enum):
+    full = 'full'
+    blobless = 'blobless'  # file contents are fetched when needed
+    treeless = 'treeless'  # trees and file contents are fetched when needed
+    shallow = 'shallow'  # recent history only, deepened until the merge base is there
+
+    def clone_args(self):
+        return {
+            CloneStrategy.full: (),
+            CloneStrategy.blobless: ('--filter=blob:none',),
+            CloneStrategy.treeless: ('--filter=tree:0',),
+            CloneStrategy.shallow: (f'--depth={SHALLOW_CLONE_DEPTH}', '--no-single-branch'),
+        }[self]
+
 
-    filter_script = f'TRAILERS={trailers} python3 {trailerfilter.__file__}'
-    return filter_script
+SHALLOW_CLONE_DEPTH = 50
+# how far to deepen a shallow clone before giving up and fetching all of history
+MAX_DEEPEN = 3200
 
 
-class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout reference')):
+class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout reference clone_strategy '
+                              + 'targeted_fetch in_memory_fusion',
+                      defaults=(CloneStrategy.full, False, False))):
+    """A local clone of `remote_url`.
+
+    With `targeted_fetch`, fusing branches only fetches the branches involved rather than every
+    branch and tag of the remote, and stale remote-tracking branches are left for `prune` to remove.
+
+    With `in_memory_fusion`, branches are rebased and merged without checking them out, using
+    `git merge-tree` (git 2.40+), and pushed without looking at the working tree. Whatever can't be
+    fused that way, e.g. because of conflicts, goes through the working tree as usual.
+    """
+
     def clone(self):
         reference_flag = '--reference=' + self.reference if self.reference else ''
-        self.git('clone', '--origin=origin', reference_flag, self.remote_url,
-                 self.local_path, from_repo=False)
+        self.git('clone', '--origin=origin', reference_flag, *self.clone_strategy.clone_args(),
+                 self.remote_url, self.local_path, from_repo=False)
+
+    def revalidate(self):
+        """Check a clone left behind by an earlier run and reset it, raising `GitError` if it is broken."""
+        index_lock = os.path.join(self.local_path, '.git', 'index.lock')
+        if os.path.exists(index_lock):
+            os.remove(index_lock)
+
+        self.git('remote', 'set-url', 'origin', self.remote_url)
+        self.git('fsck', '--connectivity-only', '--no-dangling', '--no-progress')
+        self.reset_working_tree()
+
+    def reset_working_tree(self):
+        """Abort whatever was in progress, and throw away local changes and untracked files."""
+        for operation in ('rebase', 'merge', 'cherry-pick'):
+            try:
+                self.git(operation, '--abort')
+            except GitError:
+                pass  # it wasn't in progress
+        self.git('reset', '--hard')
+        self.git('clean', '-fdx')
+
+    def add_worktree(self, path):
+        """Check out another working tree of this clone at `path`, and return it as a `Repo`.
+
+        It shares the objects, branches and remotes of this clone. Its HEAD is detached, as git
+        won't check out a branch in two working trees at once.
+        """
+        self.git('worktree', 'add', '--detach', path)
+        return self._replace(local_path=path)
+
+    def remove_worktree(self, path):
+        self.git('worktree', 'remove', '--force', path)
+
+    def prune_worktrees(self):
+        """Forget about working trees of this clone that are gone."""
+        self.git('worktree', 'prune')
+
+    def detach(self):
+        """Detach HEAD, leaving the branch it was on free to be checked out elsewhere."""
+        self.git('checkout', '--detach')
 
     def config_user_info(self, user_name, user_email):
         self.git('config', 'user.email', user_email)
         self.git('config', 'user.name', user_name)
 
-    def fetch(self, remote_name, remote_url=None):
+    def config_targeted_fetch(self):
+        # With protocol v2, the remote only advertises the refs matching what we fetch
+        self.git('config', 'protocol.version', '2')
+
+    def fetch(self, remote_name, remote_url=None, *, branches=None):
+        """Fetch `remote_name`; with `targeted_fetch`, only `branches` of it, if given."""
         if remote_name != 'origin':
             assert remote_url is not None
-            # upsert remote
-            try:
-                self.git('remote', 'rm', remote_name)
-            except GitError:
-                pass
+            self.ensure_remote(remote_name, remote_url)
+
+        if self.targeted_fetch and branches:
+            refspecs = [
+                f'+refs/heads/{branch}:refs/remotes/{remote_name}/{branch}'
+                for branch in dict.fromkeys(branches)
+            ]
+            self.git('fetch', '--no-tags', remote_name, *refspecs)
+        else:
+            self.git('fetch', '--prune', remote_name)
+
+    def ensure_remote(self, remote_name, remote_url):
+        """Point `remote_name` at `remote_url`, adding it if needed; it is kept for later jobs."""
+        try:
+            current_url = self.get_remote_url(remote_name)
+        except GitError:
             self.git('remote', 'add', remote_name, remote_url)
-        self.git('fetch', '--prune', remote_name)
+            return
+        if current_url != remote_url:
+            self.git('remote', 'set-url', remote_name, remote_url)
+
+    def fetch_merge_request(self, iid, remote_name, branch):
+        """Fetch the head of merge request `iid` of origin as `<remote_name>/<branch>`.
+
+        GitLab keeps the head of every merge request under `refs/merge-requests/` of its target
+        project, so the source branch of a merge request from a fork can be fetched from origin.
+        """
+        refspec = f'+refs/merge-requests/{iid}/head:refs/remotes/{remote_name}/{branch}'
+        self.git('fetch', '--no-tags', 'origin', refspec)
+
+    def prune(self, remote_name='origin'):
+        """Remove the remote-tracking branches of branches gone from `remote_name`."""
+        self.git('remote', 'prune', remote_name)
 
     def tag_with_trailer(self, trailer_name, trailer_values, branch, start_commit):
         """Replace `trailer_name` in commit messages with `trailer_values` in `branch` from `start_commit`.
         """
+        return self.tag_with_trailers([(trailer_name, trailer_values, start_commit)], branch=branch)
 
-        # Strips all `$trailer_name``: lines and trailing newlines, adds an empty
-        # newline and tags on the `$trailer_name: $trailer_value` for each `trailer_value` in
-        # `trailer_values`.
-        filter_script = _filter_branch_script(trailer_name, trailer_values)
-        commit_range = start_commit + '..' + branch
-        try:
-            # --force = overwrite backup of last filter-branch
-            self.git('filter-branch', '--force', '--msg-filter', filter_script, commit_range)
-        except GitError:
-            log.warning('filter-branch failed, will try to restore')
-            try:
-                self.get_commit_hash('refs/original/refs/heads/')
-            except GitError:
-                log.warning('No changes have been effected by filter-branch')
-            else:
-                self.git('reset', '--hard', 'refs/original/refs/heads/' + branch)
-            raise
-        return self.get_commit_hash()
+    def tag_with_trailers(self, trailers, branch):
+        """Rewrite the trailers of commit messages in `branch`, in a single pass over its history.
 
-    def merge(self, source_branch, target_branch, *merge_args, source_repo_url=None, local=False):
+        `trailers` is a list of `(trailer_name, trailer_values, start_commit)`: in each commit of
+        `start_commit..branch`, `trailer_name` lines are replaced with one per `trailer_value`.
+        They are applied in order, and the result is the same as that of as many
+        `git filter-branch --msg-filter` runs of `trailerfilter.py`, without their per-commit processes.
+        Returns the new head of `branch`.
+        """
+        parents = {}
+        ranges = []
+        for _, _, start_commit in trailers:
+            rev_list = self.git('rev-list', '--parents', f'{start_commit}..{branch}').stdout.decode('ascii')
+            commit_range = set()
+            for line in rev_list.splitlines():
+                commit, *commit_parents = line.split()
+                parents[commit] = commit_parents
+                commit_range.add(commit)
+            ranges.append(commit_range)
+
+        head = self.get_commit_hash(branch)
+        if not parents:
+            return head
+
+        rewritten = {}
+        originals = self._read_commits(_parents_first(parents))
+        for commit, (header, message) in originals.items():
+            try:
+                message = _rework_trailers(message, [
+                    (trailer_name, trailer_values)
+                    for (trailer_name, trailer_values, _), commit_range in zip(trailers, ranges)
+                    if commit in commit_range
+                ])
+            except trailerfilter.TrailerError as err:
+                raise GitError(f'Cannot add trailers to {commit}', err.args[0]) from err
+
+            parent_flags = []
+            for parent in parents[commit]:
+                parent_flags += ['-p', rewritten.get(parent, parent)]
+            identities = dict(
+                _ident_env('AUTHOR', header[b'author'][0]),
+                **_ident_env('COMMITTER', header[b'committer'][0]),
+            )
+            tree = header[b'tree'][0].decode('ascii')
+            new_commit = self.git('commit-tree', tree, *parent_flags, stdin=message, env=identities)
+            rewritten[commit] = new_commit.stdout.decode('ascii').strip()
+
+        new_head = rewritten.get(head, head)
+        self.git('update-ref', '-m', 'marge-bot: add trailers', f'refs/heads/{branch}', new_head, head)
+        return new_head
+
+    def _read_commits(self, commits):
+        """Return the headers and message of each commit in `commits`, in the same order."""
+        requests = ''.join(commit + '\n' for commit in commits).encode('ascii')
+        batch = self.git('cat-file', '--batch', stdin=requests).stdout
+        result = {}
+        for commit in commits:
+            info, batch = batch.split(b'\n', 1)
+            size = int(info.split()[2])
+            raw, batch = batch[:size], batch[size + 1:]
+
+            raw_header, _, message = raw.partition(b'\n\n')
+            header = {}
+            for line in raw_header.split(b'\n'):
+                if not line.startswith(b' '):  # skip continuation lines, e.g. of gpgsig
+                    key, _, value = line.partition(b' ')
+                    header.setdefault(key, []).append(value)
+            result[commit] = header, message
+        return result
+
+    def merge(self, source_branch, target_branch, *merge_args, source_remote=None, local=False):
         """Merge `target_branch` into `source_branch` and return the new HEAD commit id.
 
         By default `source_branch` and `target_branch` are assumed to reside in the same
-        repo as `self`. However, if `source_repo_url` is passed and not `None`,
-        `source_branch` is taken from there.
+        repo as `self`. However, if `source_remote` is passed and not `None`,
+        `source_branch` is taken from what was last fetched of it there.
 
         Throws a `GitError` if the merge fails. Will also try to --abort it.
         """
         return self._fuse_branch(
-            'merge', source_branch, target_branch, *merge_args, source_repo_url=source_repo_url, local=local,
+            'merge', source_branch, target_branch, *merge_args, source_remote=source_remote, local=local,
         )
 
-    def fast_forward(self, source, target, source_repo_url=None, local=False):
-        return self.merge(source, target, '--ff', '--ff-only', source_repo_url=source_repo_url, local=local)
+    def fast_forward(self, source, target, source_remote=None, local=False):
+        return self.merge(source, target, '--ff', '--ff-only', source_remote=source_remote, local=local)
 
-    def rebase(self, branch, new_base, source_repo_url=None, local=False):
+    def rebase(self, branch, new_base, source_remote=None, local=False):
         """Rebase `new_base` into `branch` and return the new HEAD commit id.
 
         By default `branch` and `new_base` are assumed to reside in the same
-        repo as `self`. However, if `source_repo_url` is passed and not `None`,
-        `branch` is taken from there.
+        repo as `self`. However, if `source_remote` is passed and not `None`,
+        `branch` is taken from what was last fetched of it there.
 
         Throws a `GitError` if the rebase fails. Will also try to --abort it.
         """
-        return self._fuse_branch('rebase', branch, new_base, source_repo_url=source_repo_url, local=local)
+        return self._fuse_branch('rebase', branch, new_base, source_remote=source_remote, local=local)
 
-    def _fuse_branch(self, strategy, branch, target_branch, *fuse_args, source_repo_url=None, local=False):
-        assert source_repo_url or branch != target_branch, branch
+    def _fuse_branch(self, strategy, branch, target_branch, *fuse_args, source_remote=None, local=False):
+        assert source_remote or branch != target_branch, branch
 
         if not local:
-            self.fetch('origin')
+            self.fetch('origin', branches=[target_branch] if source_remote else [target_branch, branch])
             target = 'origin/' + target_branch
-            if source_repo_url:
-                self.fetch('source', source_repo_url)
-                self.checkout_branch(branch, 'source/' + branch)
-            else:
-                self.checkout_branch(branch, 'origin/' + branch)
+            start_point = f'{source_remote or "origin"}/{branch}'
+        else:
+            target, start_point = target_branch, branch
+
+        remotes = [source_remote] if source_remote else []
+        if self.in_memory_fusion:
+            if self.clone_strategy is CloneStrategy.shallow:
+                self.deepen_to_merge_base(start_point, target, remotes=remotes)
+            new_head = self._fuse_in_memory(strategy, branch, start_point, target, fuse_args, local=local)
+            if new_head:
+                return new_head
+            log.info('Could not %s %s without checking it out', strategy, branch)
+
+        if not local:
+            self.checkout_branch(branch, start_point)
         else:
             self.checkout_branch(branch)
-            target = target_branch
+
+        if self.clone_strategy is CloneStrategy.shallow:
+            self.deepen_to_merge_base(branch, target, remotes=remotes)
 
         try:
             self.git(strategy, target, *fuse_args)
@@ -124,6 +283,144 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
             raise
         return self.get_commit_hash()
 
+    def _fuse_in_memory(self, strategy, branch, start_point, target, fuse_args, *, local):
+        """Point `branch` at `start_point` fused with `target` without touching the working tree.
+
+        Returns the new head of `branch`, or `None` if it has to be fused the usual way.
+        """
+        try:
+            if strategy == 'rebase':
+                new_head = self._rebase_in_memory(start_point, target, *fuse_args)
+            else:
+                new_head = self._merge_in_memory(branch, start_point, target, *fuse_args, local=local)
+        except GitError:
+            return None  # e.g. conflicts, or a git too old for merge-tree --merge-base
+        if new_head is None:
+            return None
+
+        self._detach_from(branch)
+        self.git('update-ref', '-m', f'marge-bot: {strategy}', f'refs/heads/{branch}', new_head)
+        return new_head
+
+    def _rebase_in_memory(self, start_point, new_base, *rebase_args):
+        """Replay the commits of `start_point` missing from `new_base` on it, like `git rebase` would."""
+        if rebase_args:
+            return None
+        if self._is_ancestor(new_base, start_point):
+            return self.get_commit_hash(start_point)  # up to date
+
+        # Like git rebase, leave out the commits whose patch is in `new_base` already
+        commit_range = f'{new_base}...{start_point}'
+        rev_list = self.git(
+            'rev-list', '--reverse', '--topo-order', '--parents', '--cherry-pick', '--right-only',
+            commit_range,
+        )
+        commits = [line.split() for line in rev_list.stdout.decode('ascii').splitlines()]
+        if any(len(parents) != 1 for _, *parents in commits):
+            return None  # git rebase flattens merges; leave that to it
+
+        new_head = self.get_commit_hash(new_base)
+        new_tree = self.get_commit_hash(f'{new_head}^{{tree}}')
+        originals = self._read_commits([commit for commit, _ in commits])
+        for commit, parent in commits:
+            header, message = originals[commit]
+            if b'encoding' in header:
+                return None
+            tree = self._merge_tree(new_head, commit, merge_base=parent)
+            if tree == new_tree and not self._is_empty(header, parent):
+                continue  # it is in `new_base` already, so git rebase would drop it
+            author = _ident_env('AUTHOR', header[b'author'][0])
+            new_head = self.git('commit-tree', tree, '-p', new_head, stdin=message, env=author)
+            new_head = new_head.stdout.decode('ascii').strip()
+            new_tree = tree
+        return new_head
+
+    def _merge_in_memory(self, branch, start_point, target, *merge_args, local):
+        """Merge `target` into `start_point`, like `git merge` would with `branch` checked out."""
+        message = None
+        ff_only = False
+        merge_args = list(merge_args)
+        while merge_args:
+            arg = merge_args.pop(0)
+            if arg == '-m' and merge_args:
+                message = merge_args.pop(0)
+            elif arg in ('--ff', '--ff-only'):
+                ff_only = ff_only or arg == '--ff-only'
+            else:
+                return None
+
+        if self._is_ancestor(target, start_point):
+            return self.get_commit_hash(start_point)  # already up to date
+        if self._is_ancestor(start_point, target):
+            return self.get_commit_hash(target)  # fast-forward
+        if ff_only:
+            return None  # let git merge explain why it can't
+
+        if message is None:
+            kind = 'branch' if local else 'remote-tracking branch'
+            into = '' if branch in ('main', 'master') else f' into {branch}'
+            message = f"Merge {kind} '{target}'{into}"
+        tree = self._merge_tree(start_point, target)
+        parent_flags = ['-p', start_point, '-p', target]
+        new_head = self.git('commit-tree', tree, *parent_flags, stdin=f'{message}\n'.encode())
+        return new_head.stdout.decode('ascii').strip()
+
+    def _is_empty(self, header, parent):
+        """Whether the commit with `header` changes nothing compared to `parent`."""
+        return header[b'tree'][0].decode('ascii') == self.get_commit_hash(f'{parent}^{{tree}}')
+
+    def _merge_tree(self, ours, theirs, merge_base=None):
+        """Write the tree of merging `ours` and `theirs`, raising `GitError` on conflicts."""
+        merge_base_flag = f'--merge-base={merge_base}' if merge_base else ''
+        result = self.git('merge-tree', '--write-tree', merge_base_flag, ours, theirs)
+        return result.stdout.decode('ascii').split('\n', 1)[0].strip()
+
+    def _is_ancestor(self, rev, other_rev):
+        try:
+            self.git('merge-base', '--is-ancestor', rev, other_rev)
+        except GitError:
+            return False
+        return True
+
+    def _detach_from(self, branch):
+        """Make sure `branch` isn't checked out, without touching the working tree."""
+        try:
+            head_ref = self.git('symbolic-ref', '-q', 'HEAD').stdout.decode('utf-8').strip()
+        except GitError:
+            return  # HEAD is detached already
+        if head_ref == f'refs/heads/{branch}':
+            self.git('update-ref', '--no-deref', 'HEAD', 'HEAD')
+
+    def deepen_to_merge_base(self, rev, other_rev, remotes=()):
+        """Fetch more of a shallow clone's history until `rev` and `other_rev` have a merge base."""
+        remotes = ['origin', *remotes]
+        depth = SHALLOW_CLONE_DEPTH
+        while not self._has_merge_base(rev, other_rev):
+            if not self._is_shallow():
+                return  # they really have nothing in common; let the caller fail
+
+            if depth > MAX_DEEPEN:
+                log.info('No merge base of %s and %s nearby, fetching all of history', rev, other_rev)
+                for remote in remotes:
+                    if self._is_shallow():
+                        self.git('fetch', '--unshallow', remote)
+                return
+
+            log.info('No merge base of %s and %s yet, deepening by %d commits', rev, other_rev, depth)
+            for remote in remotes:
+                self.git('fetch', f'--deepen={depth}', remote)
+            depth *= 2
+
+    def _has_merge_base(self, rev, other_rev):
+        try:
+            self.git('merge-base', rev, other_rev)
+        except GitError:
+            return False
+        return True
+
+    def _is_shallow(self):
+        return self.git('rev-parse', '--is-shallow-repository').stdout.decode('ascii').strip() == 'true'
+
     def remove_branch(self, branch, *, new_current_branch='master'):
         assert branch != new_current_branch
         self.git('branch', '-D', branch)
@@ -132,23 +429,19 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
         create_and_reset = '-B' if start_point else ''
         self.git('checkout', create_and_reset, branch, start_point, '--')
 
-    def push(self, branch, *, source_repo_url=None, force=False, skip_ci=False):
-        self.git('checkout', branch, '--')
+    def push(self, branch, *, source_remote=None, force=False, skip_ci=False):
+        if not self.in_memory_fusion:
+            self.git('checkout', branch, '--')
 
-        self.git('diff-index', '--quiet', 'HEAD')  # check it is not dirty
+            self.git('diff-index', '--quiet', 'HEAD')  # check it is not dirty
 
-        untracked_files = self.git('ls-files', '--others').stdout  # check no untracked files
-        if untracked_files:
-            raise GitError('There are untracked files', untracked_files)
+            untracked_files = self.git('ls-files', '--others').stdout  # check no untracked files
+            if untracked_files:
+                raise GitError('There are untracked files', untracked_files)
 
-        if source_repo_url:
-            assert self.get_remote_url('source') == source_repo_url
-            source = 'source'
-        else:
-            source = 'origin'
         force_flag = '--force' if force else ''
         skip_flag = ('-o', 'ci.skip') if skip_ci else ()
-        self.git('push', force_flag, *skip_flag, source, f'{branch}:{branch}')
+        self.git('push', force_flag, *skip_flag, source_remote or 'origin', f'{branch}:{branch}')
 
     def get_commit_hash(self, rev='HEAD'):
         """Return commit hash for `rev` (default "HEAD")."""
@@ -158,10 +451,11 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
     def get_remote_url(self, name):
         return self.git('config', '--get', f'remote.{name}.url').stdout.decode('utf-8').strip()
 
-    def git(self, *args, from_repo=True):
-        env = None
+    def git(self, *args, from_repo=True, stdin=None, env=None):
+        if env is not None:
+            env = dict(os.environ, **env)
         if self.ssh_key_file:
-            env = os.environ.copy()
+            env = env or os.environ.copy()
             # ssh's handling of identity files is infuriatingly dumb, to get it
             # to actually really use the IdentityFile we pass in via -i we also
             # need to tell it to ignore ssh-agent (IdentitiesOnly=true) and not
@@ -182,7 +476,7 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
         log.info('Running %s', ' '.join(shlex.quote(w) for w in command))
         try:
             timeout_seconds = self.timeout.total_seconds() if self.timeout is not None else None
-            return _run(*command, env=env, check=True, timeout=timeout_seconds)
+            return _run(*command, env=env, check=True, timeout=timeout_seconds, stdin=stdin)
         except subprocess.CalledProcessError as err:
             log.warning('git returned %s', err.returncode)
             log.warning('stdout: %r', err.stdout)
@@ -190,11 +484,51 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
             raise GitError(err) from err
 
 
-def _run(*args, env=None, check=False, timeout=None):
+def _parents_first(parents):
+    """Order the commits of a `{commit: [parent]}` mapping so that parents come before children."""
+    ordered, seen = [], set()
+    for root in parents:
+        stack = [(root, False)]
+        while stack:
+            commit, parents_done = stack.pop()
+            if parents_done:
+                ordered.append(commit)
+                continue
+            if commit in seen or commit not in parents:
+                continue
+            seen.add(commit)
+            stack.append((commit, True))
+            stack.extend((parent, False) for parent in reversed(parents[commit]))
+    return ordered
+
+
+def _rework_trailers(message, trailers):
+    """Apply `(trailer_name, trailer_values)` pairs to `message`, one after another."""
+    for trailer_name, trailer_values in trailers:
+        new_trailers = [
+            f'{trailer_name}: {trailer_value}'.encode('utf-8')
+            for trailer_value in trailer_values or ['']
+        ]
+        message = trailerfilter.rework_commit_message(message.strip(), new_trailers)
+    return message
+
+
+def _ident_env(role, ident):
+    """Turn the value of a commit's author/committer header into GIT_<role>_* variables."""
+    match = re.match(br'\A(.*) <(.*)> (\d+ [+-]\d{4})\Z', ident)
+    if not match:
+        raise GitError(f'Cannot parse {role.lower()}: {ident!r}')
+    # Without an encoding header, an ident may be in any encoding: pass its bytes on untouched
+    name, email, date = (part.decode('utf-8', 'surrogateescape') for part in match.groups())
+    return {f'GIT_{role}_NAME': name, f'GIT_{role}_EMAIL': email, f'GIT_{role}_DATE': f'@{date}'}
+
+
+def _run(*args, env=None, check=False, timeout=None, stdin=None):
     encoded_args = [a.encode('utf-8') for a in args] if sys.platform != 'win32' else args
-    with subprocess.Popen(encoded_args, env=env, stdout=PIPE, stderr=PIPE) as process:
+    stdin_pipe = PIPE if stdin is not None else None
+    with subprocess.Popen(encoded_args, env=env, stdin=stdin_pipe, stdout=PIPE, stderr=PIPE) as process:
         try:
-            stdout, stderr = process.communicate(input, timeout=timeout)
+            stdout, stderr = process.communicate(stdin, timeout=timeout)
         except TimeoutExpired as err:
             process.kill()
             stdout, stderr = process.communicate()
@@ -1,7 +1,20 @@
+import asyncio
+import collections
 from collections import namedtuple
+from concurrent import futures
+import copy
+from email.utils import parsedate_to_datetime
+import functools
 import json
 import logging as log
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import parse_header_links
 from retry import retry
 
 
@@ -74,6 +87,8 @@ class UnexpectedError(ApiError):
     pass
 
 
+PER_PAGE = 100
+
 HTTP_ERRORS = {
     400: BadRequest,
     401: Unauthorized,
@@ -92,27 +107,89 @@ HTTP_ERRORS = {
 
 
 class Api:
-    def __init__(self, gitlab_url, auth_token, append_api_version=True):
+    def __init__(
+            self, gitlab_url, auth_token, append_api_version=True, *,
+            pool_connections=10, pool_maxsize=10, timeout=60, page_concurrency=4, cache=None,
+            etag_store_size=1000, rate_limiter=None,
+    ):
         self._auth_token = auth_token
+        # Paces our calls to the budget GitLab gives us, see `RateLimiter`
+        self._rate_limiter = rate_limiter or RateLimiter()
+        # A `ResponseCache`, if GET responses may be reused for a little while
+        self._cache = cache
+        # What GitLab last sent us for each GET, to only download it again if it changed
+        self._etags = EtagStore(etag_store_size)
+        self._page_concurrency = page_concurrency
         self._api_base_url = gitlab_url.rstrip('/')
+        # Either a single number of seconds or a (connect, read) tuple, as understood by requests.
+        self._timeout = timeout
 
         # The `append_api_version` flag facilitates testing.
         if append_api_version:
             self._api_base_url += '/api/v4'
 
+        # A single session keeps connections to GitLab alive between calls, instead of paying
+        # for a new TCP and TLS handshake on every request. `pool_connections` is how many hosts
+        # we keep a pool for, `pool_maxsize` how many connections we keep open to each of them.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def close(self):
+        self._session.close()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def invalidate_cache(self, endpoint_prefix=''):
+        """Forget cached responses of endpoints under `endpoint_prefix`, e.g. after a git push."""
+        if self._cache is not None:
+            self._cache.invalidate(endpoint_prefix)
+
+    def call(self, command, sudo=None):
+        cache = self._cache
+        if cache is None:
+            return self._call(command, sudo)
+
+        if command.method != 'GET':
+            try:
+                return self._call(command, sudo)
+            finally:
+                # Whether it went through or not, what we knew about its project may be stale
+                cache.invalidate(_project_scope(command.endpoint))
+
+        hit, result = cache.get(command, sudo)
+        if not hit:
+            result = self._call(command._replace(extract=None), sudo)
+            cache.put(command, sudo, result)
+        return command.extract(result) if command.extract else result
+
     @retry(
         (requests.exceptions.Timeout,
          Conflict,
          BadGateway,
          ServiceUnavailable,
-         InternalServerError,
-         TooManyRequests,),
+         InternalServerError,),
         tries=4,
         delay=20,
         backoff=2,
         jitter=(3, 10,)
     )
-    def call(self, command, sudo=None):
+    def _call(self, command, sudo=None):
+        # When GitLab rate limits us, the rate limiter knows for how long, and holds the next try back
+        tries = 1
+        while True:
+            try:
+                return self._request(command, sudo)
+            except TooManyRequests:
+                if tries >= RATE_LIMITED_TRIES:
+                    raise
+                tries += 1
+                log.warning('Rate limited by GitLab on %s %s, trying again', command.method, command.endpoint)
+
+    def _request(self, command, sudo=None):
         method = command.method
         url = self._api_base_url + command.endpoint
 
@@ -120,13 +197,24 @@ class Api:
 
         if sudo:
             headers['SUDO'] = f'{sudo}'
-        log.debug('REQUEST: %s %s %r %r', method.__name__.upper(), url, headers, command.call_args)
+
+        etag_key = etag_entry = None
+        if method == 'GET':
+            etag_key = _cache_key(command, sudo)
+            etag_entry = self._etags.get(etag_key)
+            if etag_entry is not None:
+                headers['If-None-Match'] = etag_entry.etag
+        self._rate_limiter.acquire(background=_is_listing(command))
+        log.debug('REQUEST: %s %s %r %r', method, url, headers, command.call_args)
         try:
-            response = method(url, headers=headers, timeout=60, **command.call_args)
+            response = self._session.request(
+                method, url, headers=headers, timeout=self._timeout, **command.call_args,
+            )
         except requests.exceptions.Timeout as err:
             log.error('Request timeout: %s', err)
             raise
         log.debug('RESPONSE CODE: %s', response.status_code)
+        self._rate_limiter.update(response.status_code, response.headers)
         if 'x-gitlab-meta' in response.headers:
             log.debug('RESPONSE META: %s', response.headers['x-gitlab-meta'])
         log.debug('RESPONSE BODY: %r', response.content)
@@ -137,8 +225,16 @@ class Api:
         if response.status_code == 204:
             return True  # NoContent
 
+        if response.status_code == 304 and etag_entry is not None:
+            log.debug('Not modified since %s', etag_entry.etag)
+            return _parsed(command, copy.deepcopy(etag_entry.body), etag_entry.headers)
+
         if response.status_code < 300:
-            return command.extract(response.json()) if command.extract else response.json()
+            body = response.json()
+            etag = CaseInsensitiveDict(response.headers).get('ETag')
+            if etag_key is not None and etag:
+                self._etags.put(etag_key, EtagEntry(etag, copy.deepcopy(body), response.headers))
+            return _parsed(command, body, response.headers)
 
         if response.status_code == 304:
             return False  # Not Modified
@@ -157,23 +253,349 @@ class Api:
         raise error(response.status_code, err_message)
 
     def collect_all_pages(self, get_command):
-        result = []
-        fetch_again, page_no = True, 1
-        while fetch_again:
+        first_page = self.call(get_command.for_page(1))
+        result = list(first_page)
+
+        total_pages = getattr(first_page, 'total_pages', None)
+        if total_pages is not None:
+            # We know how many pages there are, so fetch the rest at the same time
+            remaining_pages = range(2, total_pages + 1)
+            if remaining_pages:
+                max_workers = min(self._page_concurrency, len(remaining_pages))
+                with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for page in executor.map(
+                            lambda page_no: self.call(get_command.for_page(page_no)), remaining_pages,
+                    ):
+                        result.extend(page)
+            return result
+
+        # GitLab leaves X-Total-Pages out of very large listings, so walk the pages one by one.
+        page, page_no = first_page, 1
+        while _has_next_page(page):
+            page_no = getattr(page, 'next_page', None) or page_no + 1
             page = self.call(get_command.for_page(page_no))
-            if page:
-                result.extend(page)
-                page_no += 1
-            else:
-                fetch_again = False
+            result.extend(page)
 
         return result
 
+    def iter_all_pages(self, get_command, keyset=False):
+        """Yield the items of a listing one at a time, fetching each page only once it is needed.
+
+        Callers may stop early, in which case the remaining pages are never requested. With `keyset`,
+        GitLab's keyset pagination is used, which stays fast on deep pages; the listing is then ordered
+        by id unless `get_command` asks for something else. Endpoints that don't support it fall back
+        to offset pagination transparently.
+        """
+        if keyset:
+            keyset_args = {'pagination': 'keyset', 'per_page': PER_PAGE, 'order_by': 'id', 'sort': 'asc'}
+            command = get_command._replace(args=dict(keyset_args, **get_command.args))
+        else:
+            command = get_command.for_page(1)
+
+        while command is not None:
+            page = self.call(command)
+            yield from page
+            command = _next_page_command(command, page)
+
     def version(self):
         response = self.call(GET('/version'))
         return Version.parse(response['version'])
 
 
+class AsyncApi:
+    """An asyncio front to an `Api`, to have several independent GitLab calls in flight at once.
+
+    Calls are made by the blocking `api` in a pool of at most `max_concurrency` threads, so they
+    share its session, cache and ETags, and fail or are retried exactly like `Api.call`.
+    """
+
+    def __init__(self, api, *, max_concurrency=4):
+        self._api = api
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='gitlab')
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def run(self, fun, *args, **kwargs):
+        """Await a blocking function of the API, e.g. `merge_request.fetch_approvals`."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fun, *args, **kwargs))
+
+
+# How long the response to a GET of an endpoint may be reused, in seconds; the first
+# pattern matching the whole endpoint wins. Anything else, e.g. pipelines, is never cached.
+CACHE_TTLS = (
+    (r'/version', 3600),
+    (r'/user', 300),
+    (r'/users/\d+', 300),
+    (r'/projects/\d+', 300),
+    (r'/projects/\d+/merge_requests/\d+', 10),
+    (r'/projects/\d+/merge_requests/\d+/approvals', 10),
+    (r'/projects/\d+/repository/branches/[^/]+', 10),
+)
+
+
+class ResponseCache:
+    """Keeps the responses to GET requests for a little while, to spare GitLab the same requests.
+
+    Responses are copied on the way in and out, so callers may modify what they get. Writes
+    through the `Api` invalidate what was cached about their project, and anything else that
+    changes things behind GitLab's back (e.g. a git push) should call `Api.invalidate_cache`.
+    """
+
+    def __init__(self, ttls=CACHE_TTLS, clock=time.monotonic):
+        self._ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, endpoint):
+        endpoint = '/' + endpoint.lstrip('/')
+        return next((ttl for pattern, ttl in self._ttls if pattern.fullmatch(endpoint)), None)
+
+    def get(self, command, sudo=None):
+        """Return `(True, response)` if we have a fresh response to `command`, else `(False, None)`."""
+        key = _cache_key(command, sudo)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, command, sudo, response):
+        ttl = self.ttl(command.endpoint)
+        if ttl is None or not response:
+            return
+        response = copy.deepcopy(response)
+        with self._lock:
+            self._entries[_cache_key(command, sudo)] = (self._clock() + ttl, response)
+
+    def invalidate(self, endpoint_prefix=''):
+        endpoint_prefix = '/' + endpoint_prefix.lstrip('/')
+        with self._lock:
+            for key in [key for key in self._entries if key[0].startswith(endpoint_prefix)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+class EtagEntry(namedtuple('EtagEntry', 'etag body headers')):
+    """The parsed body of a response, along with its ETag and headers."""
+
+
+class EtagStore:
+    """The last response with an ETag to each GET request, forgetting the least recently used.
+
+    With it, `Api` asks GitLab for a resource only if it changed since (`If-None-Match`), and
+    reuses what it already has when GitLab answers 304 Not Modified.
+    """
+
+    def __init__(self, maxsize=1000):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# How many times to make a call GitLab keeps rejecting with 429 Too Many Requests
+RATE_LIMITED_TRIES = 4
+
+
+class RateLimiter:
+    """Paces the calls of an `Api` to stay within the budget GitLab advertises.
+
+    GitLab tells us how many calls we have left (`RateLimit-Remaining`) until when
+    (`RateLimit-Reset`). We spread what's left evenly over the time left, rather than spend it
+    all at once and be rejected. Background calls (listings) leave a `reserve` fraction of the
+    budget to the calls that move merges forward, and let those go first when both wait. After
+    a 429, every call waits exactly as long as GitLab asked for with `Retry-After`.
+    """
+
+    # How long to hold calls back after a 429 that doesn't say for how long
+    DEFAULT_RETRY_AFTER = 20
+
+    def __init__(self, reserve=0.2, clock=time.time, sleep=time.sleep):
+        self._reserve = reserve
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._limit = None
+        self._remaining = None
+        self._reset_at = None
+        self._next_at = 0
+        self._blocked_until = 0
+        self._urgent_waiting = 0
+
+    def acquire(self, background=False):
+        """Wait until we may make a call; `background` calls give way to the others."""
+        waiting = False
+        try:
+            while True:
+                delay = self._delay(background)
+                if delay <= 0:
+                    return
+                if not background and not waiting:
+                    waiting = True
+                    with self._lock:
+                        self._urgent_waiting += 1
+                log.debug('Holding a call back for %.2f secs (background: %s)', delay, background)
+                self._sleep(delay)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._urgent_waiting -= 1
+
+    def _delay(self, background):
+        """How long to wait before trying again; 0 if we may make the call, which spends budget."""
+        with self._lock:
+            now = self._clock()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if background and self._urgent_waiting:
+                return 0.1
+            if self._reset_at is not None and now >= self._reset_at:
+                self._remaining = self._reset_at = None  # the budget was renewed
+            if self._reset_at is None:
+                return 0
+
+            reserve = self._reserve * self._limit if background and self._limit else 0
+            spendable = self._remaining - reserve
+            if spendable < 1:
+                return self._reset_at - now
+            if now < self._next_at:
+                return self._next_at - now
+            self._next_at = now + (self._reset_at - now) / spendable
+            self._remaining -= 1
+            return 0
+
+    def update(self, status_code, headers):
+        """Learn what's left of the budget from the headers of a response."""
+        headers = CaseInsensitiveDict(headers)
+        with self._lock:
+            now = self._clock()
+            remaining, reset_at = _int_or_none(headers.get('RateLimit-Remaining')), None
+            if remaining is not None:
+                reset_at = _int_or_none(headers.get('RateLimit-Reset'))
+            if reset_at is not None:
+                self._remaining, self._reset_at = remaining, reset_at
+                self._limit = _int_or_none(headers.get('RateLimit-Limit')) or self._limit
+
+            if status_code == 429:
+                retry_after = _retry_after(headers.get('Retry-After'), now)
+                if retry_after is None:
+                    reset_in = (self._reset_at or 0) - now
+                    retry_after = reset_in if reset_in > 0 else self.DEFAULT_RETRY_AFTER
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+                log.warning('GitLab rate limits us, holding calls back for %.0f secs', retry_after)
+
+
+def _retry_after(value, now):
+    """The seconds to wait according to a Retry-After header, which holds seconds or a date."""
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_listing(command):
+    return command.method == 'GET' and ('page' in command.args or 'pagination' in command.args)
+
+
+def _parsed(command, body, headers):
+    if command.extract:
+        return command.extract(body)
+    if isinstance(body, list):
+        return Page(body, headers)
+    return body
+
+
+def _cache_key(command, sudo):
+    return '/' + command.endpoint.lstrip('/'), tuple(sorted(_prepare_params(command.args).items())), sudo
+
+
+def _project_scope(endpoint):
+    """What a write to `endpoint` may have changed: its project, or anything at all."""
+    match = re.match(r'/?(projects/[^/]+)/', endpoint)
+    return f'/{match.group(1)}/' if match else ''
+
+
+class Page(list):
+    """One page of a listing, along with what GitLab told us about the other pages."""
+
+    def __init__(self, items, headers):
+        super().__init__(items)
+        headers = CaseInsensitiveDict(headers)
+        self.has_pagination_headers = 'X-Next-Page' in headers
+        self.total_pages = _int_or_none(headers.get('X-Total-Pages'))
+        self.next_page = _int_or_none(headers.get('X-Next-Page'))
+        # keyset pagination only tells us where to go next through the Link header
+        links = parse_header_links(headers.get('Link', ''))
+        self.next_link = next((link['url'] for link in links if link.get('rel') == 'next'), None)
+
+
+def _int_or_none(value):
+    return int(value) if value else None
+
+
+def _has_next_page(page):
+    if getattr(page, 'has_pagination_headers', False):
+        return page.next_page is not None
+    # No headers to go by: a full page may be followed by more
+    return len(page) >= PER_PAGE
+
+
+def _next_page_command(command, page):
+    next_link = getattr(page, 'next_link', None)
+    if next_link:
+        # The link carries every parameter of the listing, plus the cursor to resume from
+        return command._replace(args=dict(parse_qsl(urlsplit(next_link).query)))
+    if command.args.get('pagination') == 'keyset' and 'page' not in command.args:
+        if getattr(page, 'has_pagination_headers', False):
+            # GitLab ignored the keyset request, carry on with offset pagination
+            return command.for_page(page.next_page) if page.next_page else None
+        return None
+    if _has_next_page(page):
+        return command.for_page(getattr(page, 'next_page', None) or command.args['page'] + 1)
+    return None
+
+
 def from_singleton_list(fun=None):
     fun = fun or (lambda x: x)
 
@@ -199,7 +621,7 @@ class Command(namedtuple('Command', 'endpoint args extract')):
 class GET(Command):
     @property
     def method(self):
-        return requests.get
+        return 'GET'
 
     @property
     def call_args(self):
@@ -207,25 +629,25 @@ class GET(Command):
 
     def for_page(self, page_no):
         args = self.args
-        return self._replace(args=dict(args, page=page_no, per_page=100))
+        return self._replace(args=dict(args, page=page_no, per_page=PER_PAGE))
 
 
 class PUT(Command):
     @property
     def method(self):
-        return requests.put
+        return 'PUT'
 
 
 class POST(Command):
     @property
     def method(self):
-        return requests.post
+        return 'POST'
 
 
 class DELETE(Command):
     @property
     def method(self):
-        return requests.delete
+        return 'DELETE'
 
 
 def _prepare_params(params):
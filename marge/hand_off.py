@@ -0,0 +1,138 @@
+"""
+Sees the merge requests handed off to GitLab's "merge when pipeline succeeds" through.
+
+With `--hand-off-merges`, marge-bot rebases a merge request, asks GitLab to merge it once its
+pipeline succeeds, and moves on to other lanes instead of waiting for CI. Until the merge request
+is merged, or we give up on it, its lane (project, target branch) stays busy: merging anything
+else into the target branch would merge untested combinations.
+"""
+import logging as log
+import threading
+import time
+from collections import namedtuple
+
+from . import gitlab
+from .commit import Commit
+from .pipeline import PipelineTracker
+
+# Like `MergeJob.wait_for_ci_to_pass`, a skipped pipeline counts as a passed one
+PASSED = ('success', 'skipped')
+
+
+class HandOff(namedtuple('HandOff', 'merge_request sha target_sha tracker deadline')):
+    """A merge request GitLab should merge once the pipeline of `sha` passes.
+
+    `target_sha` is what its target branch pointed to when we rebased it, and `deadline` (as
+    in `time.monotonic`) when we stop waiting for CI.
+    """
+
+    @property
+    def lane(self):
+        return self.merge_request.project_id, self.merge_request.target_branch
+
+
+class HandOffReconciler:
+
+    def __init__(self, *, api, user, timeout, clock=time.monotonic):
+        self._api = api
+        self._user = user
+        self._timeout = timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._hand_offs = {}
+
+    @property
+    def pending(self):
+        """Whether some merge request we handed off is yet to be dealt with."""
+        with self._lock:
+            return len(self._hand_offs) > 0
+
+    def add(self, merge_request, sha, target_sha):
+        tracker = PipelineTracker(self._api, merge_request, sha)
+        deadline = self._clock() + self._timeout.total_seconds()
+        hand_off = HandOff(merge_request, sha, target_sha, tracker, deadline)
+        with self._lock:
+            self._hand_offs[(merge_request.project_id, merge_request.iid)] = hand_off
+
+    def busy_lanes(self):
+        """The lanes with a merge request that GitLab is yet to merge."""
+        with self._lock:
+            return {hand_off.lane for hand_off in self._hand_offs.values()}
+
+    def reconcile(self):
+        """Look at every merge request we handed off, and forget those we are done with."""
+        with self._lock:
+            hand_offs = list(self._hand_offs.items())
+        for key, hand_off in hand_offs:
+            try:
+                done = self._reconcile(hand_off)
+            except gitlab.ApiError:
+                log.exception('Failed to check on MR !%s, will try again', hand_off.merge_request.iid)
+                continue
+            if done:
+                with self._lock:
+                    del self._hand_offs[key]
+
+    def _reconcile(self, hand_off):
+        """Deal with how `hand_off` went so far; returns whether its lane is free again."""
+        merge_request = hand_off.merge_request
+        merge_request.refetch_info(fresh=True)
+        if merge_request.state == 'merged':
+            log.info('GitLab merged !%s', merge_request.iid)
+            return True
+        if merge_request.state == 'closed' or self._user.id not in merge_request.assignee_ids:
+            log.info('MR !%s is not ours to merge anymore', merge_request.iid)
+            return True
+
+        ci_status = hand_off.tracker.poll_status()
+        reason = self._failure(hand_off, ci_status)
+        if reason:
+            self._give_up(hand_off, reason)
+            return True
+
+        if not merge_request.merge_when_pipeline_succeeds:
+            # GitLab dropped it without telling; leave it to be merged again from scratch
+            log.warning('GitLab will not merge !%s when its pipeline succeeds anymore', merge_request.iid)
+            return True
+
+        if ci_status not in PASSED and self._target_moved(hand_off):
+            log.info('Someone was naughty and by-passed marge')
+            self._cancel(merge_request)
+            merge_request.comment(
+                "My job would be easier if people didn't jump the queue and push directly... *sigh*"
+            )
+            return True
+        return False
+
+    def _failure(self, hand_off, ci_status):
+        """Why we should give up on `hand_off`, if we should."""
+        if hand_off.merge_request.sha != hand_off.sha:
+            return 'Someone pushed to branch while we were trying to merge'
+        if ci_status == 'failed':
+            return 'CI failed!'
+        if ci_status == 'canceled':
+            return 'Someone canceled the CI.'
+        if ci_status not in PASSED and self._clock() > hand_off.deadline:
+            return 'CI is taking too long.'
+        return None
+
+    def _target_moved(self, hand_off):
+        merge_request = hand_off.merge_request
+        last_commit = Commit.last_on_branch(merge_request.project_id, merge_request.target_branch, self._api)
+        return last_commit.id != hand_off.target_sha
+
+    def _give_up(self, hand_off, reason):
+        merge_request = hand_off.merge_request
+        log.warning('Giving up on MR !%s: %s', merge_request.iid, reason)
+        self._cancel(merge_request)
+        merge_request.hand_back(self._user.id)
+        merge_request.comment(f"I couldn't merge this merge request: {reason}")
+
+    @staticmethod
+    def _cancel(merge_request):
+        if not merge_request.merge_when_pipeline_succeeds:
+            return
+        try:
+            merge_request.cancel_merge_when_pipeline_succeeds()
+        except gitlab.ApiError:
+            log.warning('Failed to cancel the merge of !%s when its pipeline succeeds', merge_request.iid)
@@ -1,22 +1,35 @@
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+import asyncio
 import enum
 import logging as log
 import time
 from collections import namedtuple
 from datetime import datetime, timedelta
 
-from . import git, gitlab
+from . import git, gitlab, polling
 from .branch import Branch
 from .interval import IntervalUnion
 from .merge_request import MergeRequestRebaseFailed
 from .project import Project
 from .user import User
-from .pipeline import Pipeline
+from .pipeline import Pipeline, PipelineTracker
+
+# How long to wait for GitLab to tell whether a merge request can be merged
+MERGE_STATUS_TIMEOUT = 10
+# How many GitLab calls telling whether merge requests are mergeable may be in flight at once
+MERGEABILITY_FETCH_CONCURRENCY = 4
+
+
+class Mergeability(namedtuple('Mergeability', 'approvals pipelines target_branch')):
+    """What `MergeJob.fetch_mergeability` fetched about a merge request.
+
+    `pipelines` and `target_branch` are `None` unless they were asked for.
+    """
 
 
 class MergeJob:
 
-    def __init__(self, *, api, user, project, repo, config, options):
+    def __init__(self, *, api, user, project, repo, config, options, events=None):
         self._api = api
         self._user = user
         self._project = project
@@ -24,6 +37,9 @@ class MergeJob:
         self._config = config
         self._options = options
         self._merge_timeout = options.ci_timeout
+        self._events = events
+        # The projects of merge requests from forks, by id
+        self._source_projects = {}
 
     @property
     def repo(self):
@@ -40,8 +56,52 @@ class MergeJob:
     def execute(self):
         raise NotImplementedError
 
-    def ensure_mergeable_mr(self, merge_request):
-        merge_request.refetch_info()
+    def fetch_mergeability(
+            self, merge_requests, *, refetch=True, pipelines=False, target_branch=False,
+    ):
+        """Fetch what it takes to tell whether each of `merge_requests` is mergeable, all at once.
+
+        That is the merge request itself again if `refetch`, its approvals and, if asked for, its
+        pipelines and its target branch. Returns a `Mergeability` for each merge request.
+        """
+        async def nothing():
+            return None
+
+        async def fetch(async_api, merge_request):
+            results = await asyncio.gather(
+                async_api.run(merge_request.fetch_approvals),
+                async_api.run(
+                    Pipeline.pipelines_by_merge_request,
+                    merge_request.target_project_id, merge_request.iid, self._api,
+                ) if pipelines else nothing(),
+                async_api.run(
+                    Branch.fetch_by_name,
+                    merge_request.target_project_id, merge_request.target_branch, self._api,
+                ) if target_branch else nothing(),
+                async_api.run(merge_request.refetch_info) if refetch else nothing(),
+            )
+            return Mergeability(*results[:3])
+
+        async def fetch_all():
+            concurrency = MERGEABILITY_FETCH_CONCURRENCY
+            async with gitlab.AsyncApi(self._api, max_concurrency=concurrency) as async_api:
+                return await asyncio.gather(*(
+                    fetch(async_api, merge_request) for merge_request in merge_requests
+                ))
+
+        return asyncio.run(fetch_all())
+
+    def ensure_mergeable_mr(self, merge_request, *, refetch=True):
+        """Raise unless we may merge `merge_request`; returns the approvals it fetched on the way.
+
+        Without `refetch`, trusts that the caller has just fetched `merge_request` again.
+        """
+        mergeability, = self.fetch_mergeability([merge_request], refetch=refetch)
+        self.check_mergeable_mr(merge_request, mergeability)
+        return mergeability.approvals
+
+    def check_mergeable_mr(self, merge_request, mergeability):
+        """Raise unless we may merge `merge_request`, given its `Mergeability`."""
         log.info('Ensuring MR !%s is mergeable', merge_request.iid)
         log.debug('Ensuring MR %r is mergeable', merge_request)
 
@@ -53,7 +113,7 @@ class MergeJob:
                 "Sorry, merging requests marked as auto-squash would ruin my commit tagging!"
             )
 
-        approvals = merge_request.fetch_approvals()
+        approvals = mergeability.approvals
         if not approvals.sufficient:
             raise CannotMerge(
                 'Insufficient approvals '
@@ -91,14 +151,10 @@ class MergeJob:
             ) if should_add_reviewers
             else None
         )
-        sha = None
+        # (trailer_name, trailer_values, start_commit), all applied in a single pass
+        trailers = []
         if reviewers is not None:
-            sha = self._repo.tag_with_trailer(
-                trailer_name='Reviewed-by',
-                trailer_values=reviewers,
-                branch=merge_request.source_branch,
-                start_commit='origin/' + merge_request.target_branch,
-            )
+            trailers.append(('Reviewed-by', reviewers, 'origin/' + merge_request.target_branch))
 
         # add Tested-by
         should_add_tested = (
@@ -113,12 +169,7 @@ class MergeJob:
             else None
         )
         if tested_by is not None:
-            sha = self._repo.tag_with_trailer(
-                trailer_name='Tested-by',
-                trailer_values=tested_by,
-                branch=merge_request.source_branch,
-                start_commit=merge_request.source_branch + '^'
-            )
+            trailers.append(('Tested-by', tested_by, merge_request.source_branch + '^'))
 
         # add Part-of
         should_add_parts_of = (
@@ -130,23 +181,25 @@ class MergeJob:
             else None
         )
         if part_of is not None:
-            sha = self._repo.tag_with_trailer(
-                trailer_name='Part-of',
-                trailer_values=[part_of],
-                branch=merge_request.source_branch,
-                start_commit='origin/' + merge_request.target_branch,
-            )
-        return sha
+            trailers.append(('Part-of', [part_of], 'origin/' + merge_request.target_branch))
 
-    def get_mr_ci_status(self, merge_request, commit_sha=None):
-        if commit_sha is None:
-            commit_sha = merge_request.sha
+        if not trailers:
+            return None
+        return self._repo.tag_with_trailers(trailers, branch=merge_request.source_branch)
 
+    def get_mr_ci_status(self, merge_request, commit_sha=None):
         pipelines = Pipeline.pipelines_by_merge_request(
             merge_request.target_project_id,
             merge_request.iid,
             self._api,
         )
+        return self.ci_status(merge_request, pipelines, commit_sha)
+
+    @staticmethod
+    def ci_status(merge_request, pipelines, commit_sha=None):
+        """The status of the pipeline of `commit_sha` (by default, the MR's) among `pipelines`."""
+        if commit_sha is None:
+            commit_sha = merge_request.sha
 
         current_pipeline = next(iter(pipeline for pipeline in pipelines if pipeline.sha == commit_sha), None)
         log.debug('Current pipeline: %s', current_pipeline)
@@ -159,16 +212,17 @@ class MergeJob:
 
         return ci_status
 
-    def wait_for_ci_to_pass(self, merge_request, commit_sha=None):
+    def wait_for_ci_to_pass(self, merge_request, commit_sha=None, *, ref=None):
         time_0 = datetime.utcnow()
-        waiting_time_in_secs = 5
 
         if commit_sha is None:
             commit_sha = merge_request.sha
 
+        tracker = PipelineTracker(self._api, merge_request, commit_sha, ref=ref, events=self._events)
+
         log.info('Waiting for CI to pass for MR !%s', merge_request.iid)
         while datetime.utcnow() - time_0 < self._options.ci_timeout:
-            ci_status = self.get_mr_ci_status(merge_request, commit_sha=commit_sha)
+            ci_status = tracker.poll_status()
             if ci_status == 'success':
                 log.info('CI for MR !%s passed', merge_request.iid)
                 return
@@ -186,8 +240,8 @@ class MergeJob:
             if ci_status not in ('created', 'pending', 'running'):
                 log.warning('Suspicious CI status: %r', ci_status)
 
-            log.debug('Waiting for %s secs before polling CI status again', waiting_time_in_secs)
-            time.sleep(waiting_time_in_secs)
+            time_left = self._options.ci_timeout - (datetime.utcnow() - time_0)
+            tracker.wait(max(time_left.total_seconds(), 0))
 
         raise CannotMerge('CI is taking too long.')
 
@@ -201,34 +255,24 @@ class MergeJob:
         evidence that suggest gitlab will always check the mergeability synchronously while merging MRs.
         See more https://github.com/smarkets/marge-bot/pull/265#issuecomment-724147901
         """
-        attempts = 5
-        waiting_time_in_secs = 2
+        def resolved():
+            merge_request.refetch_info(fresh=True)
+            if merge_request.merge_status == 'unchecked':
+                log.info('MR !%s merge status currently unchecked.', merge_request.iid)
+            return merge_request.merge_status in ('can_be_merged', 'cannot_be_merged')
 
         log.info('Waiting for MR !%s to have merge_status can_be_merged', merge_request.iid)
-        for attempt in range(attempts):
-            merge_request.refetch_info()
-            merge_status = merge_request.merge_status
-
-            if merge_status == 'can_be_merged':
-                log.info('MR !%s can be merged on attempt %d', merge_request.iid, attempt)
-                return
+        polling.wait_until(resolved, timeout=MERGE_STATUS_TIMEOUT, name='merge status to resolve')
 
-            if merge_status == 'cannot_be_merged':
-                log.info('MR !%s cannot be merged on attempt %d', merge_request.iid, attempt)
-                raise CannotMerge('GitLab believes this MR cannot be merged.')
-
-            if merge_status == 'unchecked':
-                log.info('MR !%s merge status currently unchecked on attempt %d.', merge_request.iid, attempt)
-
-            time.sleep(waiting_time_in_secs)
+        if merge_request.merge_status == 'can_be_merged':
+            log.info('MR !%s can be merged', merge_request.iid)
+        elif merge_request.merge_status == 'cannot_be_merged':
+            log.info('MR !%s cannot be merged', merge_request.iid)
+            raise CannotMerge('GitLab believes this MR cannot be merged.')
 
     def unassign_from_mr(self, merge_request):
         log.info('Unassigning from MR !%s', merge_request.iid)
-        author_id = merge_request.author_id
-        if author_id != self._user.id:
-            merge_request.assign_to(author_id)
-        else:
-            merge_request.unassign()
+        merge_request.hand_back(self._user.id)
 
     def during_merge_embargo(self):
         now = datetime.utcnow()
@@ -254,31 +298,43 @@ class MergeJob:
                 approvals.reapprove()
 
     def fetch_source_project(self, merge_request):
-        remote = 'origin'
-        remote_url = None
+        """Fetch the source branch of `merge_request`, if it comes from a fork.
+
+        Returns its source project, the remote of the fork to push to (or `None` if it is not
+        from a fork), and the remote its source branch is under.
+        """
         source_project = self.get_source_project(merge_request)
-        if source_project is not self._project:
-            remote = 'source'
-            remote_url = source_project.ssh_url_to_repo
+        if source_project is self._project:
+            return source_project, None, 'origin'
+
+        # One remote per fork, so that a batch of MRs from several forks doesn't keep replacing it
+        remote = f'fork-{source_project.id}'
+        self._repo.ensure_remote(remote, source_project.ssh_url_to_repo)
+        self._repo.fetch_merge_request(merge_request.iid, remote, merge_request.source_branch)
+        if self._repo.get_commit_hash(f'{remote}/{merge_request.source_branch}') != merge_request.sha:
+            # GitLab updates the merge request refs asynchronously after a push to the fork
+            log.info('The head of MR !%s is not up to date yet, fetching it from the fork', merge_request.iid)
             self._repo.fetch(
                 remote_name=remote,
-                remote_url=remote_url,
+                remote_url=source_project.ssh_url_to_repo,
+                branches=[merge_request.source_branch],
             )
-        return source_project, remote_url, remote
+        return source_project, remote, remote
 
     def get_source_project(self, merge_request):
-        source_project = self._project
-        if merge_request.source_project_id != self._project.id:
-            source_project = Project.fetch_by_id(
-                merge_request.source_project_id,
-                api=self._api,
-            )
-        return source_project
+        source_project_id = merge_request.source_project_id
+        if source_project_id == self._project.id:
+            return self._project
+        if source_project_id not in self._source_projects:
+            self._source_projects[source_project_id] = Project.fetch_by_id(source_project_id, api=self._api)
+        return self._source_projects[source_project_id]
 
     def get_target_project(self, merge_request):
+        if merge_request.target_project_id == self._project.id:
+            return self._project
         return Project.fetch_by_id(merge_request.target_project_id, api=self._api)
 
-    def fuse(self, source, target, source_repo_url=None, local=False):
+    def fuse(self, source, target, source_remote=None, local=False):
         # NOTE: this leaves git switched to branch_a
         strategies = {
             Fusion.rebase: self._repo.rebase,
@@ -290,14 +346,14 @@ class MergeJob:
         return strategy(
             source,
             target,
-            source_repo_url=source_repo_url,
+            source_remote=source_remote,
             local=local,
         )
 
     def update_from_target_branch_and_push(
             self,
             merge_request,
-            source_repo_url=None,
+            source_remote=None,
             skip_ci=False,
             add_trailers=True,
     ):
@@ -311,8 +367,7 @@ class MergeJob:
         repo = self._repo
         source_branch = merge_request.source_branch
         target_branch = merge_request.target_branch
-        assert source_repo_url != repo.remote_url
-        if source_repo_url is None and source_branch == target_branch:
+        if source_remote is None and source_branch == target_branch:
             raise CannotMerge('source and target branch seem to coincide!')
 
         branch_update_done = commits_rewrite_done = False
@@ -321,7 +376,7 @@ class MergeJob:
             updated_sha = self.fuse(
                 source_branch,
                 target_branch,
-                source_repo_url=source_repo_url,
+                source_remote=source_remote,
             )
             branch_update_done = True
             # The fuse above fetches origin again, so we are now safe to fetch
@@ -336,7 +391,7 @@ class MergeJob:
             self.synchronize_mr_with_local_changes(
                 merge_request,
                 branch_was_modified,
-                source_repo_url,
+                source_remote,
                 skip_ci=skip_ci,
             )
         except git.GitError as err:
@@ -358,7 +413,7 @@ class MergeJob:
         self,
         merge_request,
         branch_was_modified,
-        source_repo_url=None,
+        source_remote=None,
         skip_ci=False,
     ):
         if self._options.fusion is Fusion.gitlab_rebase:
@@ -367,7 +422,7 @@ class MergeJob:
             self.push_force_to_mr(
                 merge_request,
                 branch_was_modified,
-                source_repo_url=source_repo_url,
+                source_remote=source_remote,
                 skip_ci=skip_ci,
             )
 
@@ -375,13 +430,13 @@ class MergeJob:
         self,
         merge_request,
         branch_was_modified,
-        source_repo_url=None,
+        source_remote=None,
         skip_ci=False,
     ):
         try:
             self._repo.push(
                 merge_request.source_branch,
-                source_repo_url=source_repo_url,
+                source_remote=source_remote,
                 force=True,
                 skip_ci=skip_ci,
             )
@@ -398,14 +453,25 @@ class MergeJob:
 
             change_type = "merged" if self.opts.fusion == Fusion.merge else "rebased"
             raise CannotMerge(f'Failed to push {change_type} changes, check my logs!') from err
+        finally:
+            self.forget_cached(merge_request)
 
-    def synchronize_using_gitlab_rebase(self, merge_request, verify_expected_sha=True, expected_sha=None):
+    def forget_cached(self, merge_request):
+        """Drop cached API responses a push to the branches of `merge_request` may have outdated."""
+        self._api.invalidate_cache(f'/projects/{merge_request.source_project_id}/')
+        if merge_request.target_project_id != merge_request.source_project_id:
+            self._api.invalidate_cache(f'/projects/{merge_request.target_project_id}/')
+
+    def synchronize_using_gitlab_rebase(
+            self, merge_request, verify_expected_sha=True, expected_sha=None, *, target_sha=None,
+    ):
         """Returns the new SHA of the MR HEAD."""
         if verify_expected_sha:
-            expected_sha = expected_sha or self._repo.get_commit_hash()
+            expected_sha = expected_sha or self._repo.get_commit_hash(merge_request.source_branch)
+            target_sha = target_sha or self._repo.get_commit_hash(f'origin/{merge_request.target_branch}')
 
         try:
-            merge_request.rebase()
+            merge_request.rebase(target_sha=target_sha, events=self._events)
         except MergeRequestRebaseFailed as err:
             raise CannotMerge(f"GitLab failed to rebase the branch saying: {err.args[0]}") from err
         except TimeoutError as err:
@@ -459,7 +525,9 @@ JOB_OPTIONS = [
     'use_no_ff_batches',
     'use_merge_commit_batches',
     'skip_ci_batches',
+    'bisect_batches',
     'guarantee_final_pipeline',
+    'hand_off',
 ]
 
 
@@ -476,7 +544,7 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             add_tested=False, add_part_of=False, add_reviewers=False, reapprove=False,
             approval_timeout=None, embargo=None, ci_timeout=None, fusion=Fusion.rebase,
             use_no_ff_batches=False, use_merge_commit_batches=False, skip_ci_batches=False,
-            guarantee_final_pipeline=False,
+            bisect_batches=False, guarantee_final_pipeline=False, hand_off=False,
     ):  # pylint: disable=too-many-arguments
         approval_timeout = approval_timeout or timedelta(seconds=0)
         embargo = embargo or IntervalUnion.empty()
@@ -493,7 +561,9 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             use_no_ff_batches=use_no_ff_batches,
             use_merge_commit_batches=use_merge_commit_batches,
             skip_ci_batches=skip_ci_batches,
+            bisect_batches=bisect_batches,
             guarantee_final_pipeline=guarantee_final_pipeline,
+            hand_off=hand_off,
         )
 
 
@@ -1,9 +1,12 @@
 import sys
 import logging as log
+import threading
 import time
 import datetime
 
 from . import gitlab
+from . import polling
+from . import webhook
 from .approvals import Approvals
 
 
@@ -61,7 +64,13 @@ class MergeRequest(gitlab.Resource):
         return assigned_at
 
     @classmethod
-    def fetch_all_open_for_user(cls, project_id, user, api, merge_order):
+    def _assigned_at_key(cls, user, api, assigned_at_cache):
+        if assigned_at_cache is not None:
+            return lambda mri: assigned_at_cache.fetch(user, api, mri)
+        return lambda mri: cls.fetch_assigned_at(user, api, mri)
+
+    @classmethod
+    def fetch_all_open_for_user(cls, project_id, user, api, merge_order, assigned_at_cache=None):
         request_merge_order = 'created_at' if merge_order == 'assigned_at' else merge_order
 
         all_merge_request_infos = api.collect_all_pages(GET(
@@ -75,12 +84,12 @@ class MergeRequest(gitlab.Resource):
         ]
 
         if merge_order == 'assigned_at':
-            my_merge_request_infos.sort(key=lambda mri: cls.fetch_assigned_at(user, api, mri))
+            my_merge_request_infos.sort(key=cls._assigned_at_key(user, api, assigned_at_cache))
 
         return [cls(api, merge_request_info) for merge_request_info in my_merge_request_infos]
 
     @classmethod
-    def fetch_all_open_assigned_to_me(cls, user, api, merge_order):
+    def fetch_all_open_assigned_to_me(cls, user, api, merge_order, assigned_at_cache=None):
         request_merge_order = 'created_at' if merge_order == 'assigned_at' else merge_order
 
         all_merge_request_infos = api.collect_all_pages(GET(
@@ -89,10 +98,24 @@ class MergeRequest(gitlab.Resource):
         ))
 
         if merge_order == 'assigned_at':
-            all_merge_request_infos.sort(key=lambda mri: cls.fetch_assigned_at(user, api, mri))
+            if assigned_at_cache is not None:
+                assigned_at_cache.retain(all_merge_request_infos)
+            all_merge_request_infos.sort(key=cls._assigned_at_key(user, api, assigned_at_cache))
 
         return [cls(api, merge_request_info) for merge_request_info in all_merge_request_infos]
 
+    @classmethod
+    def sorted_by_merge_order(cls, merge_requests, user, api, merge_order, assigned_at_cache=None):
+        """Sort `merge_requests` the way `fetch_all_open_assigned_to_me` would have returned them."""
+        # GitLab orders by creation, breaking ties by id; timestamps are ISO 8601 in UTC, so sort as strings
+        merge_requests = sorted(merge_requests, key=lambda mr: (mr.info['created_at'], mr.id))
+        if merge_order == 'assigned_at':
+            assigned_at = cls._assigned_at_key(user, api, assigned_at_cache)
+            merge_requests.sort(key=lambda mr: assigned_at(mr.info))
+        elif merge_order != 'created_at':
+            merge_requests.sort(key=lambda mr: mr.info[merge_order])
+        return merge_requests
+
     @property
     def project_id(self):
         return self.info['project_id']
@@ -117,6 +140,10 @@ class MergeRequest(gitlab.Resource):
     def rebase_in_progress(self):
         return self.info.get('rebase_in_progress', False)
 
+    @property
+    def merge_when_pipeline_succeeds(self):
+        return self.info.get('merge_when_pipeline_succeeds', False)
+
     @property
     def merge_error(self):
         return self.info.get('merge_error')
@@ -183,19 +210,30 @@ class MergeRequest(gitlab.Resource):
         """record the updated sha. We don't use refetch_info instead as it may hit cache."""
         self._info['sha'] = sha
 
-    def refetch_info(self):
-        self._info = self._api.call(GET(
-            f'/projects/{self.project_id}/merge_requests/{self.iid}',
-            {'include_rebase_in_progress': 'true'}
-        ))
+    def refetch_info(self, *, fresh=False):
+        """Fetch the merge request again; with `fresh`, never from the API's cache, e.g. when polling."""
+        endpoint = f'/projects/{self.project_id}/merge_requests/{self.iid}'
+        if fresh:
+            self._api.invalidate_cache(endpoint)
+        self._info = self._api.call(GET(endpoint, {'include_rebase_in_progress': 'true'}))
 
     def comment(self, message):
         notes_url = f'/projects/{self.project_id}/merge_requests/{self.iid}/notes'
 
         return self._api.call(POST(notes_url, {'body': message}))
 
-    def rebase(self):
+    def rebase(self, *, target_sha=None, events=None, timeout=30, settle_time=7):
+        """Rebase through GitLab and wait until the merge request shows the result.
+
+        GitLab may still report the old `sha` for a moment after `rebase_in_progress` has
+        cleared, so we wait until both `sha` and the base of the diff have changed, unless it
+        was already based on `target_sha`, the tip of the target branch. Without `target_sha`,
+        we wait for `sha` to change for at most `settle_time` seconds after the rebase finished,
+        as it may have been up to date. With webhook `events`, an event about the merge request
+        ends a wait between two polls early.
+        """
         self.refetch_info()
+        old_sha, old_base_sha = self.sha, self._base_sha()
 
         if not self.rebase_in_progress:
             log.debug('Rebasing through GitLab API..')
@@ -206,25 +244,46 @@ class MergeRequest(gitlab.Resource):
             # We wanted to rebase and someone just happened to press the button for us!
             log.info('A rebase was already in progress on the merge request!')
 
-        max_attempts = 30
-        wait_between_attempts_in_secs = 1
-
-        for _ in range(max_attempts):
-            self.refetch_info()
+        backoff = polling.Backoff(initial=0.5, maximum=5)
+        deadline = time.monotonic() + timeout
+        settled_by = None
+        while True:
+            cursor = events.cursor() if events else None
+            self.refetch_info(fresh=True)
             if not self.rebase_in_progress:
                 if self.merge_error:
                     raise MergeRequestRebaseFailed(self.merge_error)
-
-                # GitLab does not seem to always return the latest SHA even after
-                # rebase_in_progress starts returning false, hence we need to wait
-                # a little bit more before returning.
-                time.sleep(7)
-                self.refetch_info()
-                return
-
-            time.sleep(wait_between_attempts_in_secs)
-
-        raise TimeoutError('Waiting for merge request to be rebased by GitLab')
+                if self._shows_rebase(target_sha, old_sha, old_base_sha):
+                    return
+                if target_sha is None:
+                    if settled_by is None:
+                        settled_by = time.monotonic() + settle_time
+                        deadline = max(deadline, settled_by)
+                    if time.monotonic() >= settled_by:
+                        log.debug('The SHA of MR !%s did not change, assuming it was up to date', self.iid)
+                        return
+
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                raise TimeoutError('Waiting for merge request to be rebased by GitLab')
+            polling.sleep(min(backoff.next_delay(), time_left), events, self.is_event_about_me, since=cursor)
+
+    def _shows_rebase(self, target_sha, old_sha, old_base_sha):
+        if self.sha == old_sha:
+            # Either GitLab didn't catch up yet, or there was nothing to rebase
+            return target_sha is not None and old_base_sha == target_sha
+        # GitLab updates both at once, but the target branch may have moved on since `target_sha`
+        return target_sha is None or self._base_sha() != old_base_sha
+
+    def _base_sha(self):
+        return (self.info.get('diff_refs') or {}).get('base_sha')
+
+    def is_event_about_me(self, event):
+        return (
+            event.kind == webhook.MERGE_REQUEST_HOOK
+            and event.merge_request_iid == self.iid
+            and event.project_id == self.project_id
+        )
 
     def accept(self, remove_branch=False, sha=None, merge_when_pipeline_succeeds=True):
         return self._api.call(PUT(
@@ -236,6 +295,11 @@ class MergeRequest(gitlab.Resource):
             },
         ))
 
+    def cancel_merge_when_pipeline_succeeds(self):
+        return self._api.call(POST(
+            f'/projects/{self.project_id}/merge_requests/{self.iid}/cancel_merge_when_pipeline_succeeds',
+        ))
+
     def close(self):
         return self._api.call(PUT(
             f'/projects/{self.project_id}/merge_requests/{self.iid}',
@@ -251,6 +315,12 @@ class MergeRequest(gitlab.Resource):
     def unassign(self):
         return self.assign_to(0)
 
+    def hand_back(self, user_id):
+        """Assign it back to its author, or unassign it if `user_id` is the author."""
+        if self.author_id != user_id:
+            return self.assign_to(self.author_id)
+        return self.unassign()
+
     def fetch_approvals(self):
         # 'id' needed for for GitLab 9.2.2 hack (see Approvals.refetch_info())
         info = {'id': self.id, 'iid': self.iid, 'project_id': self.project_id}
@@ -264,3 +334,34 @@ class MergeRequest(gitlab.Resource):
 
 class MergeRequestRebaseFailed(Exception):
     pass
+
+
+class AssignedAtCache:
+    """Remembers `MergeRequest.fetch_assigned_at`, per merge request.
+
+    Assigning a merge request bumps its `updated_at`, so an entry stays valid for as long as
+    the merge request's `updated_at` doesn't change; only then are its discussions listed again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # (project_id, iid) -> (updated_at, assigned_at)
+
+    def fetch(self, user, api, merge_request_info):
+        key = (merge_request_info.get('project_id'), merge_request_info.get('iid'))
+        updated_at = merge_request_info.get('updated_at')
+        with self._lock:
+            entry = self._entries.get(key)
+            if updated_at is not None and entry is not None and entry[0] == updated_at:
+                return entry[1]
+
+        assigned_at = MergeRequest.fetch_assigned_at(user, api, merge_request_info)
+        with self._lock:
+            self._entries[key] = (updated_at, assigned_at)
+        return assigned_at
+
+    def retain(self, merge_request_infos):
+        """Forget every merge request but these, e.g. the ones still assigned."""
+        keys = {(mri.get('project_id'), mri.get('iid')) for mri in merge_request_infos}
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items() if key in keys}
@@ -1,14 +1,26 @@
+import logging as log
+
 from . import gitlab
+from . import polling
+from . import webhook
 
 
 GET, POST = gitlab.GET, gitlab.POST
 
+FINISHED_STATUSES = ('success', 'failed', 'canceled', 'skipped')
+
 
 class Pipeline(gitlab.Resource):
     def __init__(self, api, info, project_id):
         info['project_id'] = project_id
         super().__init__(api, info)
 
+    @classmethod
+    def fetch_by_id(cls, project_id, pipeline_id, api):
+        pipeline = cls(api, {'id': pipeline_id}, project_id)
+        pipeline.refetch_info()
+        return pipeline
+
     @classmethod
     def pipelines_by_branch(
             cls, project_id, branch, api, *,
@@ -60,7 +72,102 @@ class Pipeline(gitlab.Resource):
     def sha(self):
         return self.info['sha']
 
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def refetch_info(self):
+        info = self._api.call(GET(f'/projects/{self.project_id}/pipelines/{self.id}'))
+        info['project_id'] = self.project_id
+        self._info = info
+
     def cancel(self):
         return self._api.call(POST(
             f'/projects/{self.project_id}/pipelines/{self.id}/cancel',
         ))
+
+
+class PipelineTracker:
+    """Follows the pipeline of one commit of a merge request until it finishes.
+
+    The merge request's pipeline list is only fetched until the pipeline shows up; from then
+    on, only that pipeline is polled, less and less often while its status doesn't change.
+    With webhook `events`, a pipeline event for it ends the wait right away.
+
+    With `ref`, the pipelines of that branch of the target project are looked at instead of
+    those of the merge request, e.g. for a commit marge-bot pushed to a branch of her own.
+    """
+
+    def __init__(self, api, merge_request, commit_sha, *, ref=None, events=None, backoff=None):
+        self._api = api
+        self._merge_request = merge_request
+        self._commit_sha = commit_sha
+        self._ref = ref
+        self._events = events
+        self._backoff = backoff or polling.Backoff(initial=5, maximum=30)
+        self._pipeline = None
+        self._last_status = None
+        self._cursor = None
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    def poll_status(self):
+        """The current status of the pipeline, or `None` while it isn't listed yet."""
+        if self._events:
+            # anything published from now on may be newer than what we are about to fetch
+            self._cursor = self._events.cursor()
+
+        if self._pipeline is None:
+            self._pipeline = self._find_pipeline()
+        else:
+            try:
+                self._pipeline.refetch_info()
+            except gitlab.NotFound:
+                # e.g. it runs in the source project of a fork: go back to the list
+                self._pipeline = self._find_pipeline()
+            else:
+                if self._pipeline.status in ('failed', 'canceled'):
+                    # someone may have started a new pipeline for the same commit
+                    self._pipeline = self._find_pipeline() or self._pipeline
+
+        status = self._pipeline.status if self._pipeline else None
+        if status != self._last_status:
+            log.debug('Pipeline for %s is now %r', self._commit_sha, status)
+            self._backoff.reset()
+            self._last_status = status
+        return status
+
+    def wait(self, max_secs):
+        """Wait before polling again, at most `max_secs` seconds."""
+        delay = min(self._backoff.next_delay(), max_secs)
+        log.debug('Waiting for up to %s secs before polling CI status again', delay)
+        polling.sleep(delay, self._events, self._is_relevant, since=self._cursor)
+
+    def _find_pipeline(self):
+        if self._ref is None:
+            pipelines = Pipeline.pipelines_by_merge_request(
+                self._merge_request.target_project_id,
+                self._merge_request.iid,
+                self._api,
+            )
+        else:
+            pipelines = Pipeline.pipelines_by_branch(
+                self._merge_request.target_project_id,
+                self._ref,
+                self._api,
+            )
+        commit_sha = self._commit_sha
+        current_pipeline = next((pipeline for pipeline in pipelines if pipeline.sha == commit_sha), None)
+        if not current_pipeline:
+            log.warning('No pipeline listed for %s on branch %s', commit_sha,
+                        self._ref or self._merge_request.source_branch)
+        return current_pipeline
+
+    def _is_relevant(self, event):
+        if event.kind != webhook.PIPELINE_HOOK:
+            return False
+        if self._pipeline is not None:
+            return event.pipeline_id == self._pipeline.id
+        return event.object_attributes.get('sha') == self._commit_sha
@@ -0,0 +1,87 @@
+import logging as log
+import threading
+import time
+
+
+class Backoff:
+    """Delays between two polls, growing geometrically from `initial` to `maximum` seconds."""
+
+    def __init__(self, initial, maximum, factor=1.5):
+        assert 0 < initial <= maximum, (initial, maximum)
+        self._initial = initial
+        self._maximum = maximum
+        self._factor = factor
+        self._delay = initial
+
+    def next_delay(self):
+        delay = self._delay
+        self._delay = min(self._delay * self._factor, self._maximum)
+        return delay
+
+    def reset(self):
+        self._delay = self._initial
+
+
+def sleep(secs, events=None, match=None, since=None):
+    """Sleep for `secs`, or until a webhook event satisfying `match` arrives.
+
+    `events` is the bot's `webhook.EventHub`, if it listens to webhooks at all. Returns
+    the event that cut the sleep short, if any.
+    """
+    if secs <= 0:
+        return None
+
+    if events is None or match is None:
+        time.sleep(secs)
+        return None
+
+    event = events.wait_for(match, timeout=secs, since=since)
+    if event is not None:
+        log.debug('Woken up early by %r', event.kind)
+    return event
+
+
+class WaitMetrics:
+    """How long the named waits took, and how often they gave up, e.g. to spot dead time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits = {}
+
+    def record(self, name, secs, satisfied):
+        with self._lock:
+            stats = self._waits.setdefault(
+                name, {'count': 0, 'timeouts': 0, 'total_secs': 0.0, 'max_secs': 0.0},
+            )
+            stats['count'] += 1
+            stats['timeouts'] += 0 if satisfied else 1
+            stats['total_secs'] += secs
+            stats['max_secs'] = max(stats['max_secs'], secs)
+
+    def summary(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._waits.items()}
+
+
+WAITS = WaitMetrics()
+
+
+def wait_until(condition, *, timeout, name, backoff=None, events=None, match=None):
+    """Call `condition` until it returns something truthy, and return that.
+
+    Polls are spaced by `backoff` (0.5s growing to 5s by default), and a webhook event
+    satisfying `match` cuts the wait between two of them short. After `timeout` seconds,
+    gives up and returns the last result. How long it took is recorded in `WAITS`.
+    """
+    backoff = backoff or Backoff(initial=0.5, maximum=5)
+    time_0 = time.monotonic()
+    deadline = time_0 + timeout
+    while True:
+        since = events.cursor() if events else None
+        result = condition()
+        now = time.monotonic()
+        if result or now >= deadline:
+            log.debug('Waited %.1f secs for %s%s', now - time_0, name, '' if result else ' in vain')
+            WAITS.record(name, now - time_0, bool(result))
+            return result
+        sleep(min(backoff.next_delay(), deadline - now), events, match, since=since)
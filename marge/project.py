@@ -1,5 +1,4 @@
 from enum import IntEnum, unique
-from functools import partial
 
 from . import gitlab
 
@@ -16,13 +15,13 @@ class Project(gitlab.Resource):
 
     @classmethod
     def fetch_by_path(cls, project_path, api):
-        def filter_by_path_with_namespace(projects):
-            return [p for p in projects if p['path_with_namespace'] == project_path]
-
-        make_project = partial(cls, api)
-
-        all_projects = api.collect_all_pages(GET('/projects'))
-        return gitlab.from_singleton_list(make_project)(filter_by_path_with_namespace(all_projects))
+        # Let GitLab narrow the listing down, and stop reading it as soon as we find the project
+        projects = api.iter_all_pages(
+            GET('/projects', {'search': project_path, 'search_namespaces': True}),
+            keyset=True,
+        )
+        info = next((p for p in projects if p['path_with_namespace'] == project_path), None)
+        return cls(api, info) if info is not None else None
 
     @classmethod
     def fetch_all_mine(cls, api):
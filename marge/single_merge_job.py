@@ -1,21 +1,28 @@
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
 import logging as log
-import time
-from datetime import datetime
 
 from marge.branch import Branch
 
-from . import git, gitlab
+from . import git, gitlab, polling
 from .commit import Commit
 from .job import CannotMerge, Fusion, GitLabRebaseResultMismatch, MergeJob, SkipMerge
+from .pipeline import Pipeline
+
+# How long to wait for GitLab to show what we pushed, and for a pipeline we asked for
+BRANCH_SHA_TIMEOUT = 30
+NEW_PIPELINE_TIMEOUT = 30
 
 
 class SingleMergeJob(MergeJob):
 
-    def __init__(self, *, api, user, project, repo, config, options, merge_request):
-        super().__init__(api=api, user=user, project=project, repo=repo, config=config, options=options)
+    def __init__(self, *, api, user, project, repo, config, options, merge_request, events=None):
+        super().__init__(
+            api=api, user=user, project=project, repo=repo, config=config, options=options, events=events,
+        )
         self._merge_request = merge_request
         self._options = options
+        # With the hand_off option, the (sha, target sha) GitLab was asked to merge when CI passes
+        self.handed_off = None
 
     def execute(self):
         merge_request = self._merge_request
@@ -25,7 +32,10 @@ class SingleMergeJob(MergeJob):
         try:
             approvals = merge_request.fetch_approvals()
             self.update_merge_request_and_accept(approvals)
-            log.info('Successfully merged !%s.', merge_request.info['iid'])
+            if self.handed_off:
+                log.info('Handed !%s off to GitLab, to merge when its pipeline succeeds.', merge_request.iid)
+            else:
+                log.info('Successfully merged !%s.', merge_request.info['iid'])
         except SkipMerge as err:
             log.warning("Skipping MR !%s: %s", merge_request.info['iid'], err.reason)
         except CannotMerge as err:
@@ -50,23 +60,23 @@ class SingleMergeJob(MergeJob):
         first_iteration = True
 
         while not updated_into_up_to_date_target_branch:
-            self.ensure_mergeable_mr(merge_request)
+            gitlab_rebase_only = (
+                self._config.use_only_gitlab_api and self._options.fusion is Fusion.gitlab_rebase
+            )
+            mergeability, = self.fetch_mergeability([merge_request], target_branch=gitlab_rebase_only)
+            self.check_mergeable_mr(merge_request, mergeability)
 
             target_project = self.get_target_project(merge_request)
 
-            if self._config.use_only_gitlab_api and self._options.fusion is Fusion.gitlab_rebase:
-                target_branch = Branch.fetch_by_name(
-                    merge_request.target_project_id,
-                    merge_request.target_branch,
-                    self._api,
-                )
-
+            if gitlab_rebase_only:
+                target_branch = mergeability.target_branch
                 target_sha = target_branch.commit_id
 
                 if target_branch.commit_id != merge_request.diff_refs_base_sha:
                     actual_sha = self.synchronize_using_gitlab_rebase(
                         merge_request,
-                        verify_expected_sha=False
+                        verify_expected_sha=False,
+                        target_sha=target_sha,
                     )
 
                     log.info(
@@ -77,13 +87,13 @@ class SingleMergeJob(MergeJob):
                 else:
                     actual_sha = merge_request.sha
             else:
-                source_project, source_repo_url, _ = self.fetch_source_project(merge_request)
+                source_project, source_remote, _ = self.fetch_source_project(merge_request)
                 try:
                     # NB. this will be a no-op if there is nothing to update/rewrite
 
                     target_sha, _updated_sha, actual_sha = self.update_from_target_branch_and_push(
                         merge_request,
-                        source_repo_url=source_repo_url,
+                        source_remote=source_remote,
                     )
                 except GitLabRebaseResultMismatch as err:
                     if first_iteration:
@@ -99,8 +109,9 @@ class SingleMergeJob(MergeJob):
 
                 if _updated_sha == actual_sha and self._options.guarantee_final_pipeline:
                     log.info('No commits on target branch to fuse, triggering pipeline...')
+                    last_pipeline_id = self.last_pipeline_id(merge_request)
                     merge_request.comment("jenkins retry")
-                    time.sleep(30)
+                    self.wait_for_new_pipeline(merge_request, actual_sha, last_pipeline_id)
 
                 log.info(
                     'Commit id to merge %r into: %r (updated sha: %r)',
@@ -108,9 +119,8 @@ class SingleMergeJob(MergeJob):
                     target_sha,
                     _updated_sha
                 )
-                time.sleep(5)
 
-                sha_now = Commit.last_on_branch(source_project.id, merge_request.source_branch, api).id
+                sha_now = self.wait_for_branch_sha(source_project.id, merge_request.source_branch, actual_sha)
                 # Make sure no-one managed to race and push to the branch in the
                 # meantime, because we're about to impersonate the approvers, and
                 # we don't want to approve unreviewed commits
@@ -119,9 +129,12 @@ class SingleMergeJob(MergeJob):
 
             self.maybe_reapprove(merge_request, approvals)
 
-            if target_project.only_allow_merge_if_pipeline_succeeds:
+            hand_off = self._options.hand_off and target_project.only_allow_merge_if_pipeline_succeeds
+            if hand_off:
+                # GitLab merges it once CI passes; there only needs to be a pipeline for it to wait for
+                self.wait_for_new_pipeline(merge_request, actual_sha, None)
+            elif target_project.only_allow_merge_if_pipeline_succeeds:
                 self.wait_for_ci_to_pass(merge_request, actual_sha)
-                time.sleep(2)
 
             self.wait_for_merge_status_to_resolve(merge_request)
 
@@ -214,24 +227,64 @@ class SingleMergeJob(MergeJob):
                 log.exception('Unanticipated ApiError from GitLab on merge attempt')
                 raise CannotMerge('had some issue with GitLab, check my logs...') from err
             else:
-                self.wait_for_branch_to_be_merged()
+                if hand_off and not (isinstance(ret, dict) and ret.get('state') == 'merged'):
+                    self.handed_off = (actual_sha, target_sha)
+                else:
+                    self.wait_for_branch_to_be_merged()
                 updated_into_up_to_date_target_branch = True
 
     def wait_for_branch_to_be_merged(self):
         merge_request = self._merge_request
-        time_0 = datetime.utcnow()
-        waiting_time_in_secs = 5
 
-        while datetime.utcnow() - time_0 < self._merge_timeout:
-            merge_request.refetch_info()
-
-            if merge_request.state == 'merged':
-                return  # success!
+        def merged():
+            merge_request.refetch_info(fresh=True)
             if merge_request.state == 'closed':
                 raise CannotMerge('someone closed the merge request while merging!')
-            assert merge_request.state in ('opened', 'reopened', 'locked'), merge_request.state
-
-            log.info('Giving %s more secs for !%s to be merged...', waiting_time_in_secs, merge_request.iid)
-            time.sleep(waiting_time_in_secs)
-
-        raise CannotMerge('It is taking too long to see the request marked as merged!')
+            assert merge_request.state in ('merged', 'opened', 'reopened', 'locked'), merge_request.state
+            return merge_request.state == 'merged'
+
+        log.info('Waiting for !%s to be merged...', merge_request.iid)
+        if not polling.wait_until(
+                merged,
+                timeout=self._merge_timeout.total_seconds(),
+                name='merge request to be merged',
+                events=self._events,
+                match=merge_request.is_event_about_me,
+        ):
+            raise CannotMerge('It is taking too long to see the request marked as merged!')
+
+    def wait_for_branch_sha(self, project_id, branch, sha):
+        """Wait for GitLab to show `sha` at the tip of `branch`; returns the sha it shows last."""
+        shas = []
+
+        def visible():
+            self._api.invalidate_cache(f'/projects/{project_id}/repository/branches/')
+            shas.append(Commit.last_on_branch(project_id, branch, self._api).id)
+            return shas[-1] == sha
+
+        polling.wait_until(visible, timeout=BRANCH_SHA_TIMEOUT, name='pushed sha to show up')
+        return shas[-1]
+
+    def last_pipeline_id(self, merge_request):
+        pipelines = Pipeline.pipelines_by_merge_request(
+            merge_request.target_project_id, merge_request.iid, self._api,
+        )
+        return max((pipeline.id for pipeline in pipelines), default=None)
+
+    def wait_for_new_pipeline(self, merge_request, sha, last_pipeline_id):
+        """Wait for a pipeline of `sha` newer than `last_pipeline_id` to show up."""
+        def new_pipeline():
+            pipelines = Pipeline.pipelines_by_merge_request(
+                merge_request.target_project_id, merge_request.iid, self._api,
+            )
+            return next(
+                (
+                    pipeline for pipeline in pipelines
+                    if pipeline.sha == sha and (last_pipeline_id is None or pipeline.id > last_pipeline_id)
+                ),
+                None,
+            )
+
+        pipeline = polling.wait_until(new_pipeline, timeout=NEW_PIPELINE_TIMEOUT, name='new pipeline')
+        if pipeline is None:
+            log.warning('No new pipeline for %s showed up, carrying on', sha)
@@ -1,21 +1,184 @@
+import contextlib
+import logging as log
+import os
 import re
+import shutil
 import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
 
 from . import git
 
 
 class RepoManager:
+    """Hands out a local clone per project.
+
+    By default, clones go to fresh temporary directories under `root_dir`. If `persistent`,
+    `root_dir` is a cache that outlives the bot: each project is cloned to `<root_dir>/<project id>`
+    and a clone left there by an earlier run is reused once it has been checked and fetched.
+
+    Projects are cloned using `clone_strategy`, unless the path of the project matches one of the
+    regexps in `clone_strategy_overrides`, a list of `(regexp, git.CloneStrategy)` pairs.
+
+    With `targeted_fetch`, clones only fetch the branches a job needs, and stale remote-tracking
+    branches are pruned every `prune_interval` seconds while `pruning`, off the merge path.
 
-    def __init__(self, user, root_dir, skip_clone, timeout=None, reference=None):
+    With `worktrees`, jobs don't work in the clone itself but in a worktree of it (see `checkout`).
+    With `in_memory_fusion`, clones rebase and merge branches without checking them out.
+    """
+    def __init__(
+            self, user, root_dir, skip_clone, timeout=None, reference=None, *,
+            persistent=False, clone_strategy=git.CloneStrategy.full, clone_strategy_overrides=(),
+            targeted_fetch=False, prune_interval=3600, worktrees=False, in_memory_fusion=False,
+    ):  # pylint: disable=too-many-arguments
         self._root_dir = root_dir
         self._user = user
         self._repos = {}
         self._skip_clone = skip_clone
         self._timeout = timeout
         self._reference = reference
+        self._persistent = persistent
+        self._clone_strategy = clone_strategy
+        self._clone_strategy_overrides = clone_strategy_overrides
+        self._repo_options = {'targeted_fetch': targeted_fetch, 'in_memory_fusion': in_memory_fusion}
+        self._prune_interval = prune_interval
+        # The `WorktreePool` of each project, with `worktrees`
+        self._worktree_pools = {} if worktrees else None
+        self._lock = threading.Lock()
+        self._project_locks = {}
+        self._lock_files = {}
+
+    def project_lock(self, project):
+        """Return the lock serializing every use of `project`'s clone."""
+        with self._lock:
+            return self._project_locks.setdefault(project.id, threading.RLock())
+
+    def repo_for_project(self, project):
+        with self.project_lock(project):
+            return self._repo_for_project(project)
+
+    def _repo_for_project(self, project):
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def checkout(self, project):
+        """The working tree a job on `project` should use, for the duration of the context.
+
+        That is the clone of `project` itself, or with `worktrees`, a worktree of it that no
+        other job is using.
+        """
+        with self.project_lock(project):
+            repo = self._repo_for_project(project)
+            if self._worktree_pools is None or self._skip_clone or repo is None:
+                yield repo
+                return
+
+            pool = self._worktree_pools.get(project.id)
+            if pool is None or pool.repo != repo:
+                pool = self._worktree_pools[project.id] = WorktreePool(repo)
+
+        with pool.worktree() as worktree:
+            yield worktree
+
+    def _local_repo_dir(self, project):
+        if not self._persistent:
+            return tempfile.mkdtemp(dir=self._root_dir)
+
+        self._lock_cache_dir(project)
+        return os.path.join(self._root_dir, str(project.id))
+
+    def clone_strategy_for(self, project):
+        for project_regexp, clone_strategy in self._clone_strategy_overrides:
+            if project_regexp.match(project.path_with_namespace):
+                return clone_strategy
+        return self._clone_strategy
+
+    def _lock_cache_dir(self, project):
+        """Keep other marge-bots sharing the cache away from `project`'s clone until we exit."""
+        if fcntl is None or project.id in self._lock_files:
+            return
+
+        # pylint: disable=consider-using-with
+        lock_file = open(os.path.join(self._root_dir, f'{project.id}.lock'), 'w', encoding='utf-8')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.info('Waiting for another process to let go of the clone of %s', project.path_with_namespace)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self._lock_files[project.id] = lock_file
+
+    def _init_repo(self, repo):
+        if self._skip_clone:
+            return
+
+        if self._persistent and os.path.isdir(os.path.join(repo.local_path, '.git')):
+            try:
+                repo.revalidate()
+            except git.GitError:
+                log.warning('Cached clone in %s is broken, cloning it again', repo.local_path)
+                shutil.rmtree(repo.local_path)
+                repo.clone()
+            else:
+                repo.fetch('origin')
+        else:
+            if os.path.exists(repo.local_path) and self._persistent:
+                # left over from a clone that was interrupted
+                shutil.rmtree(repo.local_path)
+            repo.clone()
+
+        repo.config_user_info(
+            user_email=self._user.email,
+            user_name=self._user.name,
+        )
+        if repo.targeted_fetch:
+            repo.config_targeted_fetch()
+
+    @contextlib.contextmanager
+    def pruning(self):
+        """Prune the clones in the background until exiting the context, if they need it."""
+        if not self._repo_options['targeted_fetch'] or self._skip_clone:
+            # `git fetch --prune` takes care of it
+            yield
+            return
+
+        stop = threading.Event()
+
+        def prune_periodically():
+            while not stop.wait(self._prune_interval):
+                self.prune_idle_repos()
+
+        thread = threading.Thread(target=prune_periodically, name='prune-repos', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def prune_idle_repos(self):
+        """Prune the remote-tracking branches of the clones no job is using right now."""
+        repos = list(self._repos.items())
+        with self._lock:
+            repos = [(self._project_locks.get(project_id), repo) for project_id, repo in repos]
+        for project_lock, repo in repos:
+            if project_lock is None or not project_lock.acquire(blocking=False):
+                continue
+            try:
+                repo.prune()
+            except git.GitError:
+                log.warning('Failed to prune %s', repo.local_path)
+            finally:
+                project_lock.release()
 
     def forget_repo(self, project):
-        self._repos.pop(project.id, None)
+        with self._lock:
+            self._repos.pop(project.id, None)
+            if self._worktree_pools is not None:
+                self._worktree_pools.pop(project.id, None)
 
     @property
     def user(self):
@@ -26,28 +189,80 @@ class RepoManager:
         return self._root_dir
 
 
+class WorktreePool:
+    """Worktrees of a clone, handed out to one job at a time and recycled afterwards.
+
+    The clone is only used as the object store shared by its worktrees, which go to
+    `<clone>.worktrees/`.
+    """
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._root_dir = repo.local_path + '.worktrees'
+        self._lock = threading.Lock()
+        self._free = []
+        self._count = 0
+
+        # Drop the worktrees of an earlier run, and free the branch the clone is on
+        shutil.rmtree(self._root_dir, ignore_errors=True)
+        repo.prune_worktrees()
+        repo.detach()
+
+    @property
+    def repo(self):
+        return self._repo
+
+    @contextlib.contextmanager
+    def worktree(self):
+        worktree = self._acquire()
+        try:
+            yield worktree
+        finally:
+            self._release(worktree)
+
+    def _acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self._count += 1
+            path = os.path.join(self._root_dir, str(self._count))
+        log.info('Adding worktree %s', path)
+        return self._repo.add_worktree(path)
+
+    def _release(self, worktree):
+        try:
+            worktree.reset_working_tree()
+            worktree.detach()
+        except git.GitError:
+            log.warning('Failed to clean up worktree %s, removing it', worktree.local_path)
+            try:
+                self._repo.remove_worktree(worktree.local_path)
+            except git.GitError:
+                log.exception('Failed to remove worktree %s', worktree.local_path)
+            return
+
+        with self._lock:
+            self._free.append(worktree)
+
+
 class SshRepoManager(RepoManager):
 
-    def __init__(self, user, root_dir, skip_clone, ssh_key_file=None, timeout=None, reference=None):
-        super().__init__(user, root_dir, skip_clone, timeout, reference)
+    def __init__(
+            self, user, root_dir, skip_clone, ssh_key_file=None, timeout=None, reference=None, **kwargs,
+    ):
+        super().__init__(user, root_dir, skip_clone, timeout, reference, **kwargs)
         self._ssh_key_file = ssh_key_file
 
-    def repo_for_project(self, project):
+    def _repo_for_project(self, project):
         repo = self._repos.get(project.id)
         if not repo or repo.remote_url != project.ssh_url_to_repo:
             repo_url = project.ssh_url_to_repo
-            local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
+            local_repo_dir = self._local_repo_dir(project)
 
             repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=self._ssh_key_file,
-                            timeout=self._timeout, reference=self._reference)
-
-            if not self._skip_clone:
-                repo.clone()
-                repo.config_user_info(
-                    user_email=self._user.email,
-                    user_name=self._user.name,
-                )
-
+                            timeout=self._timeout, reference=self._reference,
+                            clone_strategy=self.clone_strategy_for(project), **self._repo_options)
+            self._init_repo(repo)
             self._repos[project.id] = repo
 
         return repo
@@ -59,30 +274,27 @@ class SshRepoManager(RepoManager):
 
 class HttpsRepoManager(RepoManager):
 
-    def __init__(self, user, root_dir, skip_clone, auth_token=None, timeout=None, reference=None):
-        super().__init__(user, root_dir, skip_clone, timeout, reference)
+    def __init__(
+            self, user, root_dir, skip_clone, auth_token=None, timeout=None, reference=None, **kwargs,
+    ):
+        super().__init__(user, root_dir, skip_clone, timeout, reference, **kwargs)
         self._auth_token = auth_token
 
-    def repo_for_project(self, project):
+    def _repo_for_project(self, project):
+        credentials = "oauth2:" + self._auth_token
+        # insert token auth "oauth2:<auth_token>@"
+        pattern = "(http(s)?://)"
+        replacement = r"\1" + credentials + "@"
+        repo_url = re.sub(pattern, replacement, project.http_url_to_repo, 1)
+
         repo = self._repos.get(project.id)
-        if not repo or repo.remote_url != project.http_url_to_repo:
-            credentials = "oauth2:" + self._auth_token
-            # insert token auth "oauth2:<auth_token>@"
-            pattern = "(http(s)?://)"
-            replacement = r"\1" + credentials + "@"
-            repo_url = re.sub(pattern, replacement, project.http_url_to_repo, 1)
-            local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
+        if not repo or repo.remote_url != repo_url:
+            local_repo_dir = self._local_repo_dir(project)
 
             repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=None,
-                            timeout=self._timeout, reference=self._reference)
-
-            if not self._skip_clone:
-                repo.clone()
-                repo.config_user_info(
-                    user_email=self._user.email,
-                    user_name=self._user.name,
-                )
-
+                            timeout=self._timeout, reference=self._reference,
+                            clone_strategy=self.clone_strategy_for(project), **self._repo_options)
+            self._init_repo(repo)
             self._repos[project.id] = repo
 
         return repo
@@ -95,5 +307,10 @@ class HttpsRepoManager(RepoManager):
 class ApiOnlyRepoManager(RepoManager):
 
     # pylint: disable=unused-argument
-    def repo_for_project(self, project):
+    def project_lock(self, project):
+        # There is no local clone to protect
+        return contextlib.nullcontext()
+
+    # pylint: disable=unused-argument
+    def _repo_for_project(self, project):
         return None
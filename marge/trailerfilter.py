@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
-"""Executable script to pass to git filter-branch --msgfilter to rewrite trailers.
+"""Rewrite trailers of commit messages.
+
+`rework_commit_message` is used in-process by `git.Repo.tag_with_trailers`; run as a
+script, this can also be passed to git filter-branch --msg-filter.
 
 This treats everything (stdin, stdout, env) at the level of raw bytes which are
 assumed to be utf-8, or more specifically some ASCII superset, regardless of
@@ -16,6 +19,10 @@ STDOUT = sys.stdout.buffer
 STDERR = sys.stderr.buffer
 
 
+class TrailerError(ValueError):
+    pass
+
+
 def die(msg):
     STDERR.write(b'ERROR: ')
     STDERR.write(msg)
@@ -33,7 +40,7 @@ def remove_duplicates(trailers):
 
 def rework_commit_message(commit_message, trailers):
     if not commit_message:
-        die(b'Expected a non-empty commit message')
+        raise TrailerError(b'Expected a non-empty commit message')
 
     trailer_names = [trailer.split(b':', 1)[0].lower() for trailer in trailers]
 
@@ -48,7 +55,7 @@ def rework_commit_message(commit_message, trailers):
     while len(reworked_lines) > 1 and re.match(br'^[A-Z][\w-]+: ', reworked_lines[-1]):
         trailers.insert(0, reworked_lines.pop())
     if not reworked_lines:
-        die(b"Your commit message seems to consist only of Trailers: " + commit_message)
+        raise TrailerError(b"Your commit message seems to consist only of Trailers: " + commit_message)
 
     drop_trailing_newlines(reworked_lines)
 
@@ -63,7 +70,10 @@ def main():
     trailers = os.environb[b'TRAILERS'].split(b'\n') if os.environb[b'TRAILERS'] else []
     assert all(b':' in trailer for trailer in trailers), trailers
     original_commit_message = STDIN.read().strip()
-    new_commit_message = rework_commit_message(original_commit_message, trailers)
+    try:
+        new_commit_message = rework_commit_message(original_commit_message, trailers)
+    except TrailerError as err:
+        die(err.args[0])
     STDOUT.write(new_commit_message)
 
 
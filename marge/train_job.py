@@ -0,0 +1,216 @@
+import logging as log
+from collections import namedtuple
+
+from requests.utils import quote
+
+from . import git
+from . import gitlab
+from .batch_job import BatchMergeJob, CannotBatch
+from .job import CannotMerge, SkipMerge
+from .merge_request import MergeRequest
+from .pipeline import Pipeline
+
+GET, DELETE = gitlab.GET, gitlab.DELETE
+
+
+class Car(namedtuple('Car', 'merge_request branch sha car_mr')):
+    """A merge request of the train, tested on top of the ones ahead of it.
+
+    `branch` is where marge-bot pushed `sha`: the target branch with the merge
+    requests ahead of it and then this one. `car_mr` is the merge request of `branch`
+    that marge-bot opened for its pipeline to run, like the batch MR of a batch.
+    """
+
+
+class MergeTrainJob(BatchMergeJob):
+    """Merges the queue of a target branch as a train of speculative pipelines.
+
+    The MR of each car is rebased onto the car ahead of it, and pushed to a branch of
+    its own, so that up to `train_length` pipelines run at the same time. Cars are merged
+    in order as their pipelines pass. When one fails, its MR is dropped from the train
+    and the cars behind it, which were built on top of it, are rebuilt.
+    """
+    TRAIN_BRANCH_PREFIX = 'marge_bot_train/'
+    TRAIN_LABEL = 'marge_bot_train'
+
+    def __init__(self, *, train_length, **kwargs):
+        super().__init__(**kwargs)
+        assert train_length >= 1, train_length
+        self._train_length = train_length
+        self._cars = []
+        # The merge requests that were merged, in order
+        self.merged_merge_requests = []
+
+    def car_branch(self, merge_request):
+        return f'{MergeTrainJob.TRAIN_BRANCH_PREFIX}{merge_request.iid}'
+
+    def remove_train_branches(self):
+        log.info('Removing leftover train branches')
+        branches = self._api.collect_all_pages(GET(
+            f'/projects/{self._project.id}/repository/branches',
+            {'search': f'^{MergeTrainJob.TRAIN_BRANCH_PREFIX}'},
+        ))
+        for branch in branches:
+            self.remove_remote_branch(branch['name'])
+
+    def close_train_mrs(self):
+        log.info('Closing leftover train MRs')
+        params = {
+            'author_id': self._user.id,
+            'labels': MergeTrainJob.TRAIN_LABEL,
+            'state': 'opened',
+        }
+        for car_mr in MergeRequest.search(api=self._api, project_id=self._project.id, params=params):
+            log.info('Closing train MR !%s', car_mr.iid)
+            car_mr.close()
+
+    def create_car_mr(self, merge_request, branch):
+        params = {
+            'source_branch': branch,
+            'target_branch': merge_request.target_branch,
+            'title': f'Marge Bot Train car of !{merge_request.iid} - DO NOT TOUCH',
+            'labels': MergeTrainJob.TRAIN_LABEL,
+        }
+        car_mr = MergeRequest.create(api=self._api, project_id=self._project.id, params=params)
+        log.info('Train MR !%s created for MR !%s', car_mr.iid, merge_request.iid)
+        return car_mr
+
+    def remove_remote_branch(self, branch):
+        try:
+            self._api.call(DELETE(
+                f'/projects/{self._project.id}/repository/branches/{quote(branch, safe="")}',
+            ))
+        except gitlab.NotFound:
+            pass
+
+    def add_car(self, merge_request):
+        """Build and push the car of `merge_request` at the back of the train.
+
+        Returns the car, or `None` if `merge_request` doesn't apply on top of the train.
+        """
+        base = self._cars[-1].branch if self._cars else merge_request.target_branch
+        branch = self.car_branch(merge_request)
+        try:
+            _, source_remote, merge_request_remote = self.fetch_source_project(merge_request)
+            self._repo.checkout_branch(
+                merge_request.source_branch,
+                f'{merge_request_remote}/{merge_request.source_branch}',
+            )
+            # Update <source_branch> on the car ahead so it contains the MRs before it
+            self.fuse(merge_request.source_branch, base, source_remote=source_remote, local=True)
+            self._repo.checkout_branch(branch, base)
+            sha = self._repo.fast_forward(branch, merge_request.source_branch, local=True)
+            self._repo.remove_branch(merge_request.source_branch)
+        except (git.GitError, CannotMerge):
+            log.warning('Skipping MR !%s, got conflicts while rebasing', merge_request.iid)
+            return None
+
+        log.info('Boarding MR !%s at position %s of the train (%s)', merge_request.iid, len(self._cars), sha)
+        self._repo.push(branch, force=True)
+        car = Car(merge_request, branch, sha, self.create_car_mr(merge_request, branch))
+        self._cars.append(car)
+        return car
+
+    def fill_train(self, queue):
+        """Board merge requests from the front of `queue` until the train is full."""
+        while queue and len(self._cars) < self._train_length:
+            self.add_car(queue.pop(0))
+
+    def derail(self, queue):
+        """Take the train apart, putting its merge requests back at the front of `queue`."""
+        for car in reversed(self._cars):
+            log.info('Removing MR !%s from the train', car.merge_request.iid)
+            for pipeline in Pipeline.pipelines_by_merge_request(self._project.id, car.car_mr.iid, self._api):
+                if not pipeline.finished:
+                    pipeline.cancel()
+            self.remove_car(car)
+            queue.insert(0, car.merge_request)
+        self._cars = []
+
+    def remove_car(self, car):
+        """Close the MR of `car`, and remove its branches."""
+        car.car_mr.close()
+        self.remove_remote_branch(car.branch)
+        self.remove_local_branch(car.branch)
+
+    def remove_local_branch(self, branch):
+        try:
+            self._repo.remove_branch(branch)
+        except git.GitError:
+            pass
+
+    def depart(self, car, target_sha):
+        """Merge the car at the front of the train; returns the new sha of the target branch."""
+        _, source_remote, _ = self.fetch_source_project(car.merge_request)
+        self.ensure_mr_not_changed(car.merge_request)
+        # we know the car's CI passed, so we skip CI for the MR this time
+        self.ensure_mergeable_mr(car.merge_request, skip_ci=True, refetch=False)
+        target_sha = self.accept_mr(car.merge_request, target_sha, source_remote=source_remote)
+        self.merged_merge_requests.append(car.merge_request)
+        self.remove_car(car)
+        return target_sha
+
+    def execute(self):
+        # Cleanup previous train work
+        self.close_train_mrs()
+        self.remove_train_branches()
+
+        target_branch = self._merge_requests[0].target_branch
+        queue = self.get_mrs_with_common_target_branch(target_branch)
+        queue = self.get_mergeable_mrs(queue)
+
+        if len(queue) <= 1:
+            # Either no merge requests are ready to be merged, or there's only one for this target branch.
+            # Let's raise an error to do a basic job for these cases.
+            raise CannotBatch('not enough ready merge requests')
+
+        self._repo.fetch('origin', branches=self.branches_to_fetch(target_branch, queue))
+
+        # Save the sha of remote <target_branch> so we can use it to make sure
+        # the remote wasn't changed while we're testing against it
+        target_sha = self._repo.get_commit_hash(f'origin/{target_branch}')
+        self._repo.checkout_branch(target_branch, f'origin/{target_branch}')
+
+        try:
+            while True:
+                self.fill_train(queue)
+                if not self._cars:
+                    break
+
+                car = self._cars[0]
+                if self._project.only_allow_merge_if_pipeline_succeeds:
+                    try:
+                        self.wait_for_ci_to_pass(car.car_mr, commit_sha=car.sha)
+                    except CannotMerge as err:
+                        self.drop_front_car(queue, f'CI of {car.branch} failed: {err.reason}')
+                        continue
+
+                try:
+                    target_sha = self.depart(car, target_sha)
+                except CannotBatch as err:
+                    car.merge_request.comment(
+                        f"I couldn't merge this merge request: {str(err)} I will retry later...",
+                    )
+                    raise
+                except SkipMerge:
+                    # The MR is not ours to merge anymore; the cars behind it must be rebuilt without it
+                    self._cars.pop(0)
+                    self.remove_car(car)
+                    self.derail(queue)
+                    continue
+                except CannotMerge as err:
+                    self.drop_front_car(queue, err.reason)
+                    continue
+                self._cars.pop(0)
+        finally:
+            self.derail(queue)
+
+    def drop_front_car(self, queue, reason):
+        """Give up on the MR at the front of the train, and rebuild the train behind it."""
+        car = self._cars.pop(0)
+        log.warning('Dropping MR !%s from the train: %s', car.merge_request.iid, reason)
+        self.remove_car(car)
+        self.unassign_from_mr(car.merge_request)
+        car.merge_request.comment(f"I couldn't merge this merge request: {reason}")
+        # Every car behind it was built on top of it
+        self.derail(queue)
@@ -0,0 +1,175 @@
+"""
+An embedded listener for GitLab webhooks.
+
+GitLab POSTs merge request, pipeline and note events to it; they are published on an `EventHub`,
+which lets the bot (and anything waiting for GitLab to do something) react as soon as an event
+arrives instead of polling the API.
+"""
+import collections
+import hmac
+import json
+import logging as log
+import threading
+import time
+from collections import namedtuple
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+MERGE_REQUEST_HOOK = 'Merge Request Hook'
+PIPELINE_HOOK = 'Pipeline Hook'
+NOTE_HOOK = 'Note Hook'
+
+KNOWN_HOOKS = (MERGE_REQUEST_HOOK, PIPELINE_HOOK, NOTE_HOOK)
+
+
+class Event(namedtuple('Event', 'kind payload')):
+
+    @property
+    def object_attributes(self):
+        return self.payload.get('object_attributes') or {}
+
+    @property
+    def project_id(self):
+        if self.kind == MERGE_REQUEST_HOOK:
+            return self.object_attributes.get('target_project_id')
+        if self.kind == NOTE_HOOK and self.payload.get('project_id') is not None:
+            return self.payload['project_id']
+        return (self.payload.get('project') or {}).get('id')
+
+    @property
+    def merge_request_iid(self):
+        """The iid of the merge request the event is about, if any."""
+        if self.kind == MERGE_REQUEST_HOOK:
+            return self.object_attributes.get('iid')
+        return (self.payload.get('merge_request') or {}).get('iid')
+
+    @property
+    def pipeline_id(self):
+        return self.object_attributes.get('id') if self.kind == PIPELINE_HOOK else None
+
+    @property
+    def pipeline_status(self):
+        return self.object_attributes.get('status') if self.kind == PIPELINE_HOOK else None
+
+
+class EventHub:
+    """Thread-safe fan-out of webhook events.
+
+    Besides calling subscribers, it remembers the last `backlog` events so that a
+    waiter can ask for anything that arrived since a `cursor()` it took earlier,
+    without racing against events published in between.
+    """
+
+    def __init__(self, backlog=1000):
+        self._condition = threading.Condition()
+        self._events = collections.deque(maxlen=backlog)
+        self._sequence = 0
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def publish(self, event):
+        with self._condition:
+            self._sequence += 1
+            self._events.append((self._sequence, event))
+            subscribers = list(self._subscribers)
+            self._condition.notify_all()
+
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Webhook event subscriber failed')
+
+    def cursor(self):
+        with self._condition:
+            return self._sequence
+
+    def wait_for(self, match, timeout, since=None):
+        """Wait up to `timeout` seconds for an event satisfying `match`.
+
+        Only events published after `since` (a `cursor()`, default: now) are considered.
+        Returns the first matching event, or `None` on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            seen = self._sequence if since is None else since
+            while True:
+                for sequence, event in self._events:
+                    if sequence > seen:
+                        seen = sequence
+                        if match(event):
+                            return event
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, hub, secret=None):
+        super().__init__(address, _WebhookHandler)
+        self.hub = hub
+        self.secret = secret
+        self._thread = None
+
+    def start(self):
+        host, port = self.server_address[:2]
+        log.info('Listening for GitLab webhooks on %s:%s', host, port)
+        self._thread = threading.Thread(target=self.serve_forever, name='marge-webhook', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        secret = self.server.secret
+        if secret and not hmac.compare_digest(self.headers.get('X-Gitlab-Token', ''), secret):
+            log.warning('Rejecting webhook with a bad token from %s', self.client_address[0])
+            self._reply(HTTPStatus.UNAUTHORIZED)
+            return
+
+        kind = self.headers.get('X-Gitlab-Event')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+        except (ValueError, json.JSONDecodeError):
+            log.warning('Rejecting webhook with an unparsable body')
+            self._reply(HTTPStatus.BAD_REQUEST)
+            return
+
+        if kind not in KNOWN_HOOKS or not isinstance(payload, dict):
+            log.debug('Ignoring webhook %r', kind)
+            self._reply(HTTPStatus.NO_CONTENT)
+            return
+
+        event = Event(kind=kind, payload=payload)
+        log.debug('Received %r for MR !%s of project %s', kind, event.merge_request_iid, event.project_id)
+        self.server.hub.publish(event)
+        self._reply(HTTPStatus.OK)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug('webhook: ' + format, *args)
+
+
+def parse_address(str_address):
+    """Parse a "[HOST:]PORT" listen address."""
+    host, _, port = str_address.rpartition(':')
+    return host or '0.0.0.0', int(port)
@@ -20,5 +20,18 @@ def create_bot_config(user, options):
         merge_order='created_at',
         merge_opts=options,
         batch=False,
+        batch_max_size=10,
+        merge_train=False,
+        merge_train_length=5,
+        targeted_fetch=False,
+        use_worktrees=False,
+        in_memory_fusion=False,
         cli=False,
+        max_workers=1,
+        webhook_listen=None,
+        webhook_secret=None,
+        reconcile_interval=None,
+        repo_cache_dir=None,
+        clone_strategy=bot.CloneStrategy.full,
+        clone_strategy_overrides=[],
     )
@@ -2,7 +2,6 @@ import logging as log
 from collections import defaultdict
 from datetime import timedelta
 import functools
-import shlex
 
 from marge import git
 
@@ -21,6 +20,7 @@ class RepoMock(git.Repo):
         remote_repos = defaultdict(GitRepoModel)
         remote_repos[source_url].set_ref(merge_request.source_branch, merge_request.sha)
         remote_repos[target_url].set_ref(merge_request.target_branch, initial_target_sha)
+        remote_repos[target_url].set_ref(f'merge-requests/{merge_request.iid}/head', merge_request.sha)
 
         result = cls(
             remote_url=target_url,
@@ -34,7 +34,8 @@ class RepoMock(git.Repo):
         result.mock_impl = GitModel(origin=target_url, remote_repos=remote_repos)
         return result
 
-    def git(self, *args, from_repo=True):
+    def git(self, *args, from_repo=True, stdin=None, env=None):
+        assert stdin is None and env is None, 'not simulated'
         command = args[0]
         command_args = args[1:]
 
@@ -52,6 +53,9 @@ class RepoMock(git.Repo):
 
         return self._pretend_result_comes_from_popen(result)
 
+    def tag_with_trailers(self, trailers, branch):
+        return self.mock_impl.tag_with_trailers(trailers, branch)
+
     @staticmethod
     def _pretend_result_comes_from_popen(result):
         result_bytes = ('' if result is None else str(result)).encode('ascii')
@@ -110,11 +114,27 @@ class GitModel:
 
         elif action == 'add':
             _, remote, url = args
+            assert remote not in self._remotes, remote
+            self._remotes[remote] = url
+        elif action == 'set-url':
+            _, remote, url = args
+            assert remote in self._remotes, remote
             self._remotes[remote] = url
         else:
             assert False, args
 
     def fetch(self, *args):
+        if args[0] == '--no-tags':
+            _, remote_name, *refspecs = args
+            remote_repo = self.remote_repos[self._remotes[remote_name]]
+            for refspec in refspecs:
+                src, dst = refspec.lstrip('+').split(':')
+                src_ref = src.removeprefix('refs/').removeprefix('heads/')
+                dst_remote, dst_branch = dst.removeprefix('refs/remotes/').split('/', 1)
+                remote_refs = self._remote_refs.setdefault(dst_remote, GitRepoModel())
+                remote_refs.set_ref(dst_branch, remote_repo.get_ref(src_ref))
+            return
+
         _, remote_name = args
         assert args == ('--prune', remote_name)
         remote_url = self._remotes[remote_name]
@@ -155,9 +175,26 @@ class GitModel:
         else:
             assert False
 
+    def tag_with_trailers(self, trailers, branch):
+        assert trailers
+        assert branch == self._branch
+        for trailer_name, trailer_values, start_commit in trailers:
+            assert trailer_name and start_commit
+            assert isinstance(trailer_values, list)
+
+        new_sha = functools.reduce(
+            lambda x, f: f"add-{f}({x})",
+            [trailer_name.lower() for trailer_name, _, _ in trailers],
+            self._head
+        )
+        self._local_repo.set_ref(self._branch, new_sha)
+        return new_sha
+
     def rev_parse(self, arg):
         if arg == 'HEAD':
             return self._head
+        if self._local_repo.has_ref(arg):
+            return self._local_repo.get_ref(arg)
 
         remote, branch = arg.split('/')
         return self._remote_refs[remote].get_ref(branch)
@@ -209,6 +246,8 @@ class GitModel:
         assert len(args) == 2 and args[0] == '--get'
         _, remote, _ = elems = args[1].split('.')
         assert elems == ['remote', remote, 'url'], elems
+        if remote not in self._remotes:
+            raise git.GitError(f'No such remote: {remote}')
         return self._remotes[remote]
 
     def diff_index(self, *args):
@@ -218,25 +257,3 @@ class GitModel:
     def ls_files(self, *args):
         assert args == ('--others',)
         # we don't model untracked files
-
-    def filter_branch(self, *args):
-        _, _, filter_cmd, commit_range = args
-        assert args == ('--force', '--msg-filter', filter_cmd, commit_range)
-
-        trailers_var, python, script_path = shlex.split(filter_cmd)
-        _, trailers_str = trailers_var.split('=')
-
-        assert trailers_var == f"TRAILERS={trailers_str}"
-        assert python == "python3"
-        assert script_path.endswith("marge/trailerfilter.py")
-
-        trailers = list(sorted(set(line.split(':')[0] for line in trailers_str.split('\n'))))
-        assert trailers
-
-        new_sha = functools.reduce(
-            lambda x, f: f"add-{f}({x})",
-            [trailer.lower() for trailer in trailers],
-            self._head
-        )
-        self._local_repo.set_ref(self._branch, new_sha)
-        return new_sha
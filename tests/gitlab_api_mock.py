@@ -202,6 +202,7 @@ class Api(gitlab.Api):
             Ok([info]),
             sudo, from_state, to_state,
         )
+        self.add_resource(f'/projects/{project_id}/pipelines/{{0.id}}', info, sudo, from_state, to_state)
 
     def expected_note(self, merge_request, note, sudo=None, from_state=None, to_state=None):
         self.add_transition(
@@ -10,6 +10,7 @@ import pytest
 
 from marge import app
 from marge import bot as bot_module
+from marge import gitlab
 from marge import interval
 from marge import job
 
@@ -58,8 +59,9 @@ def env(**kwargs):
 
 @contextlib.contextmanager
 def main(cmdline=''):
-    def api_mock(gitlab_url, auth_token):
+    def api_mock(gitlab_url, auth_token, **kwargs):
         assert gitlab_url == 'http://foo.com'
+        api_mock.kwargs = kwargs
         assert auth_token in ('NON-ADMIN-TOKEN', 'ADMIN-TOKEN')
         api = gitlab_mock.Api(gitlab_url=gitlab_url, auth_token=auth_token, initial_state='initial')
         user_info_for_token = dict(user_info, is_admin=auth_token == 'ADMIN-TOKEN')
@@ -82,6 +84,7 @@ def main(cmdline=''):
         app.main(args=shlex.split(cmdline))
         the_bot = DoNothingBot.instance
         assert the_bot is not None
+        the_bot.api_kwargs = api_mock.kwargs
         yield the_bot
 
 
@@ -286,3 +289,167 @@ def test_config_overwrites():
                 )
                 assert bot.config.project_regexp == re.compile('foo.*bar')
                 assert bot.config.git_timeout == datetime.timedelta(seconds=100)
+
+
+def test_max_workers():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main("--max-workers=4") as bot:
+            assert bot.config.max_workers == 4
+
+        with pytest.raises(app.MargeBotCliArgError):
+            with main("--max-workers=0"):
+                pass
+
+
+def test_api_pool_and_timeouts():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.api_kwargs == {
+                'pool_connections': 10, 'pool_maxsize': 10, 'timeout': (60.0, 60.0), 'page_concurrency': 4,
+                'cache': None, 'etag_store_size': 1000,
+            }
+
+        with main(
+            "--api-pool-connections=2 --api-pool-maxsize=3 --api-connect-timeout=5s --api-read-timeout=2min "
+            "--api-page-concurrency=2"
+        ) as bot:
+            assert bot.api_kwargs == {
+                'pool_connections': 2, 'pool_maxsize': 3, 'timeout': (5.0, 120.0), 'page_concurrency': 2,
+                'cache': None, 'etag_store_size': 1000,
+            }
+
+        with main("--api-pool-maxsize=3 --max-workers=8") as bot:
+            assert bot.api_kwargs['pool_maxsize'] == 8
+
+        with pytest.raises(app.MargeBotCliArgError):
+            with main("--api-pool-maxsize=0"):
+                pass
+
+        with main("--api-cache") as bot:
+            assert isinstance(bot.api_kwargs['cache'], gitlab.ResponseCache)
+
+        with main("--api-etag-cache-size=0") as bot:
+            assert bot.api_kwargs['etag_store_size'] == 0
+
+        with pytest.raises(app.MargeBotCliArgError, match='--api-etag-cache-size'):
+            with main("--api-etag-cache-size=-1"):
+                pass
+
+
+def test_webhook_listen():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.webhook_listen is None
+            assert bot.config.reconcile_interval == datetime.timedelta(minutes=5)
+
+    with env(
+        MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com',
+        MARGE_WEBHOOK_SECRET='s3cr3t',
+    ):
+        with main('--webhook-listen=127.0.0.1:8080 --reconcile-interval=1h') as bot:
+            assert bot.config.webhook_listen == ('127.0.0.1', 8080)
+            assert bot.config.webhook_secret == 's3cr3t'
+            assert bot.config.reconcile_interval == datetime.timedelta(hours=1)
+
+
+def test_disabled_webhook_secret_cli_arg():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--webhook-secret=s3cr3t'):
+                pass
+
+
+def test_repo_cache_dir():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.repo_cache_dir is None
+
+        with main('--repo-cache-dir=/var/cache/marge') as bot:
+            assert bot.config.repo_cache_dir == '/var/cache/marge'
+
+
+def test_clone_strategy():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.clone_strategy is bot_module.CloneStrategy.full
+            assert bot.config.clone_strategy_overrides == []
+
+        with main(
+            '--clone-strategy=shallow --project-clone-strategy=big/.*=blobless '
+            '--project-clone-strategy=huge/mono=treeless'
+        ) as bot:
+            assert bot.config.clone_strategy is bot_module.CloneStrategy.shallow
+            assert [
+                (regexp.pattern, strategy) for regexp, strategy in bot.config.clone_strategy_overrides
+            ] == [
+                ('big/.*', bot_module.CloneStrategy.blobless),
+                ('huge/mono', bot_module.CloneStrategy.treeless),
+            ]
+
+        with pytest.raises(SystemExit):
+            with main('--project-clone-strategy=big/.*=sparse'):
+                pass
+
+
+def test_targeted_fetch():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.targeted_fetch is False
+
+        with main('--targeted-fetch') as bot:
+            assert bot.config.targeted_fetch is True
+
+
+def test_batch_max_size():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main("--batch") as bot:
+            assert bot.config.batch_max_size == 10
+
+        with main("--batch --batch-max-size=3") as bot:
+            assert bot.config.batch_max_size == 3
+
+        with pytest.raises(app.MargeBotCliArgError):
+            with main("--batch --batch-max-size=0"):
+                pass
+
+
+def test_merge_train():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main("--merge-train") as bot:
+            assert bot.config.merge_train is True
+            assert bot.config.merge_train_length == 5
+
+        with main("--merge-train --merge-train-length=3") as bot:
+            assert bot.config.merge_train_length == 3
+
+        with pytest.raises(app.MargeBotCliArgError):
+            with main("--merge-train --batch"):
+                pass
+
+        with pytest.raises(app.MargeBotCliArgError, match='rebase remotely'):
+            with main("--merge-train --rebase-remotely"):
+                pass
+
+
+def test_hand_off_merges():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main("--hand-off-merges") as bot:
+            assert bot.config.merge_opts == job.MergeJobOptions.default(hand_off=True)
+
+
+def test_use_worktrees():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.use_worktrees is False
+
+        with main('--use-worktrees') as bot:
+            assert bot.config.use_worktrees is True
+
+
+def test_in_memory_fusion():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.in_memory_fusion is False
+
+        with main('--in-memory-fusion') as bot:
+            assert bot.config.in_memory_fusion is True
@@ -1,14 +1,16 @@
 # pylint: disable=protected-access
-from unittest.mock import ANY, patch, create_autospec
+import threading
+from unittest.mock import ANY, Mock, patch, create_autospec
 
 import pytest
 
+import marge.commit
 import marge.git
 import marge.project
 import marge.user
 from marge.batch_job import BatchMergeJob, CannotBatch
 from marge.gitlab import GET
-from marge.job import CannotMerge, MergeJobOptions
+from marge.job import CannotMerge, MergeJobOptions, Mergeability
 from marge.merge_request import MergeRequest
 from tests import create_bot_config
 from tests.gitlab_api_mock import MockLab, Ok, commit
@@ -118,15 +120,16 @@ class TestBatchJob:
         r_maser_mrs = batch_merge_job.get_mrs_with_common_target_branch('master')
         assert r_maser_mrs == master_mrs
 
-    @patch.object(BatchMergeJob, 'get_mr_ci_status')
-    def test_ensure_mergeable_mr_ci_not_ok(self, bmj_get_mr_ci_status, api, mocklab):
+    @patch('marge.job.Pipeline')
+    def test_ensure_mergeable_mr_ci_not_ok(self, pipeline_class, api, mocklab):
         batch_merge_job = self.get_batch_merge_job(api, mocklab)
-        bmj_get_mr_ci_status.return_value = 'failed'
+        pipeline_class.pipelines_by_merge_request.return_value = [Mock(sha='abc', status='failed')]
         merge_request = self._mock_merge_request(
             assignee_ids=[batch_merge_job._user.id],
             state='opened',
             work_in_progress=False,
             squash=False,
+            sha='abc',
         )
         merge_request.fetch_approvals.return_value.sufficient = True
         with pytest.raises(CannotBatch) as exc_info:
@@ -165,20 +168,64 @@ class TestBatchJob:
         batch_merge_job._repo.fast_forward.assert_not_called()
 
     def test_ensure_mr_not_changed(self, api, mocklab):
-        with patch('marge.batch_job.MergeRequest') as mr_class:
-            batch_merge_job = self.get_batch_merge_job(api, mocklab)
-            merge_request = self._mock_merge_request()
-            changed_merge_request = self._mock_merge_request()
-            mr_class.fetch_by_iid.return_value = changed_merge_request
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request = self._mock_merge_request(sha='abc')
 
-            with pytest.raises(CannotMerge):
-                batch_merge_job.ensure_mr_not_changed(merge_request)
+        def refetch_info():
+            merge_request.sha = 'def'
+        merge_request.refetch_info.side_effect = refetch_info
 
-            mr_class.fetch_by_iid.assert_called_once_with(
-                merge_request.project_id,
-                merge_request.iid,
-                batch_merge_job._api,
-            )
+        with pytest.raises(CannotMerge) as exc_info:
+            batch_merge_job.ensure_mr_not_changed(merge_request)
+
+        assert exc_info.value.reason == 'The sha changed whilst merging!'
+        merge_request.refetch_info.assert_called_once_with()
+
+    def test_get_mergeable_mrs_keeps_order(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_requests = [self._mock_merge_request(iid=iid) for iid in range(6)]
+        mergeabilities = [Mergeability(f'approvals {iid}', [], None) for iid in range(6)]
+        errors = {1: CannotBatch('CI is running'), 4: CannotMerge('Not approved')}
+        checked = []
+
+        def check_mergeable_mr(merge_request, mergeability):
+            checked.append((merge_request.iid, mergeability, threading.current_thread()))
+            if merge_request.iid in errors:
+                raise errors[merge_request.iid]
+
+        with patch.object(
+                batch_merge_job, 'fetch_mergeability', return_value=mergeabilities,
+        ) as fetch_mergeability, \
+                patch.object(batch_merge_job, 'check_mergeable_mr', side_effect=check_mergeable_mr), \
+                patch.object(batch_merge_job, 'unassign_from_mr') as unassign_from_mr:
+            mergeable_mrs = batch_merge_job.get_mergeable_mrs(merge_requests)
+
+        assert [merge_request.iid for merge_request in mergeable_mrs] == [0, 2, 3, 5]
+        assert checked == [
+            (iid, mergeability, threading.current_thread())
+            for iid, mergeability in enumerate(mergeabilities)
+        ]
+        fetch_mergeability.assert_called_once_with(merge_requests, pipelines=True)
+        unassign_from_mr.assert_called_once_with(merge_requests[4])
+        merge_requests[4].comment.assert_called_once_with("I couldn't merge this merge request: Not approved")
+        merge_requests[1].comment.assert_not_called()
+
+    def test_reuses_approvals_of_mergeability_check(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request = MergeRequest.fetch_by_iid(
+            mocklab.merge_request_info['project_id'], mocklab.merge_request_info['iid'], api,
+        )
+        approvals = batch_merge_job.ensure_mergeable_mr(merge_request, skip_ci=True)
+        last_commit = marge.commit.Commit(api, {'id': 'abc'})
+        updated = (None, None, 'abc')
+        with patch.object(MergeRequest, 'fetch_approvals') as fetch_approvals, \
+                patch.object(batch_merge_job, 'update_from_target_branch_and_push', return_value=updated), \
+                patch('marge.batch_job.Commit.last_on_branch', return_value=last_commit), \
+                patch.object(batch_merge_job, 'maybe_reapprove') as maybe_reapprove:
+            batch_merge_job.update_merge_request(merge_request)
+
+        fetch_approvals.assert_not_called()
+        maybe_reapprove.assert_called_once_with(merge_request, approvals)
 
     def test_fuse_mr_when_target_branch_was_moved(self, api, mocklab):
         batch_merge_job = self.get_batch_merge_job(api, mocklab)
@@ -206,3 +253,116 @@ class TestBatchJob:
             batch_merge_job.accept_mr(merge_request, mocklab.initial_master_sha)
 
         assert str(exc_info.value) == 'Someone pushed to branch while we were trying to merge'
+
+    def test_accept_mr_waits_for_gitlab_to_see_it_merged(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request = self._mock_merge_request(
+            iid=54, target_branch='master', source_branch='feature', source_project_id=1234,
+            force_remove_source_branch=False, state='opened',
+        )
+        states = iter(['opened', 'merged'])
+        merge_request.refetch_info.side_effect = lambda fresh: setattr(merge_request, 'state', next(states))
+        last_commit = marge.commit.Commit(api, {'id': 'abc'})
+
+        with patch('marge.batch_job.Commit.last_on_branch', return_value=last_commit), \
+                patch.object(batch_merge_job, 'update_merge_request'), \
+                patch.object(batch_merge_job, 'merge_batch', return_value='def'), \
+                patch('marge.batch_job.Pipeline') as pipeline_class, \
+                patch('marge.polling.sleep') as sleep:
+            pipeline_class.pipelines_by_branch.return_value = []
+            assert batch_merge_job.accept_mr(merge_request, 'abc') == 'def'
+
+        assert merge_request.refetch_info.call_count == 2
+        assert sleep.call_count == 1
+        batch_merge_job._repo.push.assert_called_once_with('master', force=False)
+
+    def _bisect(self, batch_merge_job, merge_requests, broken):
+        """Bisect a failed batch in which MRs `broken` (indices) break the build.
+
+        Rebatching MR `i` gives `rebuilt-i`, which fails CI if any MR up to it but the first
+        culprit breaks the build.
+        """
+        batch_mr = self._mock_merge_request(iid=99, target_branch='master')
+        batch_shas = [f'batch-{i}' for i in range(len(merge_requests))]
+        tried = []
+
+        def wait_for_ci_to_pass(_merge_request, commit_sha):
+            tried.append(commit_sha)
+            if commit_sha.startswith('rebuilt-'):
+                failed = any(int(commit_sha[len('rebuilt-'):]) >= i for i in broken[1:])
+            else:
+                failed = any(batch_shas.index(commit_sha) >= i for i in broken)
+            if failed:
+                raise CannotMerge('CI failed!')
+
+        def add_to_batch(_batch_mr, rest):
+            return list(rest), [f'rebuilt-{merge_request.iid}' for merge_request in rest]
+
+        with patch.object(BatchMergeJob, 'wait_for_ci_to_pass', side_effect=wait_for_ci_to_pass), \
+                patch.object(BatchMergeJob, 'add_to_batch', side_effect=add_to_batch):
+            result = batch_merge_job.drop_culprit(batch_mr, merge_requests, batch_shas, 'CI failed!')
+        return result, tried
+
+    @pytest.mark.parametrize('culprit', range(8))
+    def test_drop_culprit(self, api, mocklab, culprit):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_requests = [self._mock_merge_request(iid=i) for i in range(8)]
+
+        with patch.object(BatchMergeJob, 'unassign_from_mr') as unassign_from_mr:
+            (good, good_sha), tried = self._bisect(batch_merge_job, merge_requests, broken=[culprit])
+
+        # three pipelines to bisect, and one more for the MRs after the culprit
+        assert len(tried) == (3 if culprit == 7 else 4)
+        assert batch_merge_job.culprit is merge_requests[culprit]
+        unassign_from_mr.assert_called_once_with(merge_requests[culprit])
+        assert 'breaks the build' in merge_requests[culprit].comment.call_args[0][0]
+        assert good == merge_requests[:culprit] + merge_requests[culprit + 1:]
+        assert good_sha == ('batch-6' if culprit == 7 else 'rebuilt-7')
+        for merge_request in good:
+            merge_request.comment.assert_not_called()
+        if culprit < 7:
+            # the MRs after the culprit are batched again on top of those before it
+            batch_merge_job._repo.checkout_branch.assert_called_with(
+                BatchMergeJob.BATCH_BRANCH_NAME, f'batch-{culprit - 1}' if culprit else 'origin/master',
+            )
+
+    def test_drop_culprit_finds_the_first_of_many(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_requests = [self._mock_merge_request(iid=i) for i in range(5)]
+
+        with patch.object(BatchMergeJob, 'unassign_from_mr'):
+            (good, good_sha), tried = self._bisect(batch_merge_job, merge_requests, broken=[2, 4])
+
+        assert batch_merge_job.culprit is merge_requests[2]
+        assert tried[-1] == 'rebuilt-4'
+        # the MRs after the culprit failed again, so they are left for the next batch
+        assert (good, good_sha) == (merge_requests[:2], 'batch-1')
+        for merge_request in merge_requests[3:]:
+            merge_request.comment.assert_called_once_with(
+                'Batch MR !99 failed because of !2. I will retry later...',
+            )
+
+    def test_drop_culprit_with_merge_commit_batches(self, api, mocklab):
+        options = MergeJobOptions.default(use_merge_commit_batches=True, bisect_batches=True)
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, options=options)
+        merge_requests = [self._mock_merge_request(iid=i) for i in range(4)]
+
+        with patch.object(BatchMergeJob, 'unassign_from_mr'):
+            (_, good_sha), _ = self._bisect(batch_merge_job, merge_requests, broken=[3])
+
+        assert good_sha == 'batch-2'
+        # the batch MR is what gets merged, so it must be left at what passed CI
+        batch_merge_job._repo.checkout_branch.assert_called_with(BatchMergeJob.BATCH_BRANCH_NAME, 'batch-2')
+        batch_merge_job._repo.push.assert_called_with(BatchMergeJob.BATCH_BRANCH_NAME, force=True)
+
+    def test_drop_culprit_rebatches_with_merge_commits(self, api, mocklab):
+        options = MergeJobOptions.default(use_merge_commit_batches=True, bisect_batches=True)
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, options=options)
+        merge_requests = [self._mock_merge_request(iid=i) for i in range(4)]
+
+        with patch.object(BatchMergeJob, 'unassign_from_mr'):
+            (good, good_sha), _ = self._bisect(batch_merge_job, merge_requests, broken=[1])
+
+        assert good == [merge_requests[0]] + merge_requests[2:]
+        assert good_sha == 'rebuilt-3'
+        batch_merge_job._repo.checkout_branch.assert_called_with(BatchMergeJob.BATCH_BRANCH_NAME, 'rebuilt-3')
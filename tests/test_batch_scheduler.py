@@ -0,0 +1,67 @@
+import pytest
+
+from marge.batch_scheduler import BatchScheduler
+
+
+LANE = (1234, 'master')
+
+
+class TestBatchScheduler:
+
+    def test_no_batch_for_a_single_merge_request(self):
+        scheduler = BatchScheduler(max_batch_size=10)
+        assert scheduler.batch_size(LANE, queued=1) == 1
+        assert scheduler.batch_size(LANE, queued=0) == 0
+
+    def test_prior(self):
+        scheduler = BatchScheduler(max_batch_size=20)
+        assert scheduler.failure_rate(LANE) == pytest.approx(0.1)
+        assert scheduler.durations(LANE) == (1, 1)
+        # about 1/p, the size that merges the most merge requests per pipeline
+        assert scheduler.batch_size(LANE, queued=20) == 8
+
+    def test_capped_by_queue_and_max_size(self):
+        assert BatchScheduler(max_batch_size=20).batch_size(LANE, queued=3) == 3
+        assert BatchScheduler(max_batch_size=4).batch_size(LANE, queued=20) == 4
+
+    def test_failures_shrink_batches(self):
+        scheduler = BatchScheduler(max_batch_size=20)
+        for _ in range(5):
+            scheduler.record(LANE, 4, False, 1800)
+        assert scheduler.failure_rate(LANE) == pytest.approx(6 / 30)
+        assert scheduler.batch_size(LANE, queued=20) == 4
+
+        flaky_lane = (1234, 'flaky')
+        for _ in range(10):
+            scheduler.record(flaky_lane, 2, False, 1800)
+        scheduler.record(flaky_lane, 1, None, 600)
+        assert scheduler.batch_size(flaky_lane, queued=20) == 1
+
+        # other lanes are not affected
+        assert scheduler.batch_size((1234, 'stable'), queued=20) == 8
+
+    def test_successes_grow_batches(self):
+        scheduler = BatchScheduler(max_batch_size=20)
+        for _ in range(10):
+            scheduler.record(LANE, 8, True, 1800)
+        assert scheduler.failure_rate(LANE) == pytest.approx(1 / 90)
+        assert scheduler.batch_size(LANE, queued=20) == 20
+
+    def test_slow_fallbacks_favour_smaller_batches(self):
+        scheduler = BatchScheduler(max_batch_size=20)
+        scheduler.record(LANE, 1, None, 600)
+        scheduler.record(LANE, 4, True, 600)
+        fast_fallback = scheduler.batch_size(LANE, queued=20)
+
+        scheduler = BatchScheduler(max_batch_size=20)
+        scheduler.record(LANE, 1, None, 6000)
+        scheduler.record(LANE, 4, True, 600)
+        assert scheduler.durations(LANE) == (600, 6000)
+        assert scheduler.batch_size(LANE, queued=20) < fast_fallback
+
+    def test_window(self):
+        scheduler = BatchScheduler(max_batch_size=20, window=2)
+        scheduler.record(LANE, 2, False, 60)
+        scheduler.record(LANE, 2, True, 60)
+        scheduler.record(LANE, 2, True, 60)
+        assert scheduler.failure_rate(LANE) == pytest.approx(1 / 14)
@@ -0,0 +1,251 @@
+# pylint: disable=protected-access
+import threading
+from datetime import timedelta
+from unittest.mock import MagicMock, Mock, create_autospec, patch
+
+import pytest
+
+import marge.batch_job
+import marge.bot
+import marge.git
+import marge.gitlab
+import marge.merge_request
+import marge.project
+import marge.user
+from marge import webhook
+from marge.job import CannotMerge, MergeJobOptions
+from tests import create_bot_config
+from tests.gitlab_api_mock import MockLab
+
+
+def make_bot(**config):
+    user = create_autospec(marge.user.User, spec_set=True, is_admin=False, id=77)
+    bot_config = create_bot_config(user, MergeJobOptions.default())._replace(**config)
+    return marge.bot.Bot(api=create_autospec(marge.gitlab.Api, spec_set=True), config=bot_config)
+
+
+class TestRunLanes:  # pylint: disable=too-few-public-methods
+
+    def test_lanes_of_a_project_take_turns(self):
+        bot = make_bot(max_workers=2, cli=True)
+        projects = {project_id: Mock(id=project_id) for project_id in (1, 2)}
+        pending = {(1, 'master'), (1, 'stable'), (2, 'master')}
+        lock = threading.Lock()
+        running, overlaps = set(), []
+        other_project_started = threading.Event()
+
+        def iter_assigned_lanes():
+            with lock:
+                lanes = sorted(pending)
+            return iter([(lane, (projects[lane[0]], [Mock(target_branch=lane[1])])) for lane in lanes])
+
+        def process_merge_requests(_repo_manager, project, merge_requests):
+            with lock:
+                if project.id in running:
+                    overlaps.append(project.id)
+                running.add(project.id)
+            if project.id == 2:
+                other_project_started.set()
+            else:
+                # The other project gets a worker while this one is busy
+                assert other_project_started.wait(5)
+            with lock:
+                running.discard(project.id)
+                pending.discard((project.id, merge_requests[0].target_branch))
+
+        with patch.object(bot, '_iter_assigned_lanes', side_effect=iter_assigned_lanes), \
+                patch.object(bot, '_process_merge_requests', side_effect=process_merge_requests):
+            bot._run_lanes(repo_manager=Mock())
+
+        assert not overlaps
+        assert not pending
+
+
+def merge_request_hook(project_id, iid):
+    return webhook.Event(webhook.MERGE_REQUEST_HOOK, {
+        'object_attributes': {'target_project_id': project_id, 'iid': iid},
+    })
+
+
+def pipeline_hook(project_id, iid):
+    return webhook.Event(webhook.PIPELINE_HOOK, {
+        'project': {'id': project_id},
+        'merge_request': {'iid': iid},
+        'object_attributes': {'id': 1000, 'status': 'success'},
+    })
+
+
+class TestTrackedMergeRequests:
+
+    @pytest.fixture()
+    def bot(self):
+        return make_bot(webhook_listen=('localhost', 0), reconcile_interval=timedelta(minutes=10))
+
+    @pytest.fixture()
+    def mr_class(self):
+        with patch('marge.bot.MergeRequest') as mr_class:
+            mr_class.sorted_by_merge_order.side_effect = lambda merge_requests, **_: merge_requests
+            yield mr_class
+
+    @staticmethod
+    def _merge_request(iid, *, assignee_ids=(77,), state='opened'):
+        return Mock(project_id=1, iid=iid, state=state, assignee_ids=list(assignee_ids))
+
+    def test_refreshes_stale_merge_requests(self, bot, mr_class):
+        mr_class.fetch_all_open_assigned_to_me.return_value = [self._merge_request(1)]
+        assert [mr.iid for mr in bot._tracked_merge_requests()] == [1]
+
+        refreshed = self._merge_request(1)
+        newly_assigned = self._merge_request(2)
+        fetched = {1: refreshed, 2: newly_assigned}
+        mr_class.fetch_by_iid.side_effect = lambda _project_id, iid, _api: fetched[iid]
+        bot._on_event(pipeline_hook(1, 1))
+        bot._on_event(merge_request_hook(1, 2))
+        # Not assigned to me, and a pipeline can't change that
+        bot._on_event(pipeline_hook(1, 3))
+
+        assert bot._tracked_merge_requests() == [refreshed, newly_assigned]
+        assert sorted(call.args[1] for call in mr_class.fetch_by_iid.call_args_list) == [1, 2]
+        mr_class.fetch_all_open_assigned_to_me.assert_called_once()
+
+        # Nothing is stale anymore
+        mr_class.fetch_by_iid.reset_mock()
+        assert bot._tracked_merge_requests() == [refreshed, newly_assigned]
+        mr_class.fetch_by_iid.assert_not_called()
+
+    def test_drops_merge_requests_that_are_not_mine_anymore(self, bot, mr_class):
+        mr_class.fetch_all_open_assigned_to_me.return_value = [self._merge_request(iid) for iid in (1, 2, 3)]
+        bot._tracked_merge_requests()
+
+        merge_requests = {
+            1: self._merge_request(1, assignee_ids=[]),
+            2: self._merge_request(2, state='merged'),
+        }
+
+        def fetch_by_iid(_project_id, iid, _api):
+            if iid not in merge_requests:
+                raise marge.gitlab.NotFound(404, {'message': '404 Not found'})
+            return merge_requests[iid]
+
+        mr_class.fetch_by_iid.side_effect = fetch_by_iid
+        for iid in (1, 2, 3):
+            bot._on_event(merge_request_hook(1, iid))
+
+        assert not bot._tracked_merge_requests()
+
+    def test_reconciles_every_reconcile_interval(self, bot, mr_class):
+        mr_class.fetch_all_open_assigned_to_me.return_value = [self._merge_request(1)]
+        bot._tracked_merge_requests()
+        bot._tracked_merge_requests()
+        assert mr_class.fetch_all_open_assigned_to_me.call_count == 1
+
+        # e.g. we missed the event of MR 2 being assigned to me
+        mr_class.fetch_all_open_assigned_to_me.return_value = [self._merge_request(1), self._merge_request(2)]
+        bot._last_reconciliation -= timedelta(minutes=11).total_seconds()
+        assert [mr.iid for mr in bot._tracked_merge_requests()] == [1, 2]
+        assert mr_class.fetch_all_open_assigned_to_me.call_count == 2
+        mr_class.fetch_by_iid.assert_not_called()
+
+
+class TestTryBatch:
+
+    @pytest.fixture()
+    def mocklab(self):
+        return MockLab()
+
+    @pytest.fixture()
+    def bot(self, mocklab):
+        user = marge.user.User.myself(mocklab.api)
+        bot_config = create_bot_config(user, MergeJobOptions.default())._replace(batch=True, batch_max_size=3)
+        return marge.bot.Bot(api=mocklab.api, config=bot_config)
+
+    @pytest.fixture()
+    def project(self, mocklab):
+        return marge.project.Project.fetch_by_id(mocklab.project_info['id'], mocklab.api)
+
+    @pytest.fixture()
+    def merge_requests(self, mocklab):
+        return [
+            create_autospec(
+                marge.merge_request.MergeRequest, spec_set=True,
+                iid=iid, target_branch='master', source_branch=f'feature-{iid}',
+                source_project_id=mocklab.project_info['id'],
+            )
+            for iid in range(1, 6)
+        ]
+
+    def _process(self, bot, project, merge_requests, *, ci_fails=False):
+        """Process the lane of `merge_requests`.
+
+        Returns the MRs merged in a batch, those merged on their own, and the scheduler's `record` spy.
+        """
+        repo = create_autospec(marge.git.Repo, spec_set=True)
+        repo_manager = MagicMock()
+        repo_manager.checkout.return_value.__enter__.return_value = repo
+        batched, merged_alone = [], []
+
+        def wait_for_ci_to_pass(_merge_request, commit_sha):  # pylint: disable=unused-argument
+            if ci_fails:
+                raise CannotMerge('CI failed!')
+
+        def accept_mr(merge_request, target_sha, source_remote):  # pylint: disable=unused-argument
+            batched.append(merge_request)
+            return target_sha
+
+        with patch.multiple(
+                marge.batch_job.BatchMergeJob,
+                close_batch_mr=lambda _self: None,
+                get_mergeable_mrs=lambda _self, merge_requests: merge_requests,
+                fetch_source_project=lambda _self, _merge_request: (project, None, 'origin'),
+                fuse=Mock(),
+                create_batch_mr=Mock(return_value=Mock(iid=100, sha='batch-sha')),
+                push_batch=Mock(),
+                wait_for_ci_to_pass=lambda _self, *args, **kwargs: wait_for_ci_to_pass(*args, **kwargs),
+                ensure_mr_not_changed=Mock(),
+                ensure_mergeable_mr=Mock(),
+                accept_mr=lambda _self, *args, **kwargs: accept_mr(*args, **kwargs),
+        ), patch.object(bot._batch_scheduler, 'record', wraps=bot._batch_scheduler.record) as record, \
+                patch.object(bot, '_process_merge_request') as process_merge_request:
+            process_merge_request.side_effect = lambda _project, merge_request, _repo: merged_alone.append(
+                merge_request,
+            )
+            bot._process_merge_requests(repo_manager, project, merge_requests)
+        return batched, merged_alone, record
+
+    def test_batches_as_many_as_the_scheduler_says(self, bot, project, merge_requests):
+        lane = (project.id, 'master')
+        with patch.object(bot._batch_scheduler, 'batch_size', return_value=2) as batch_size:
+            batched, merged_alone, record = self._process(bot, project, merge_requests)
+
+        batch_size.assert_called_once_with(lane, 5)
+        assert batched == merge_requests[:2]
+        assert not merged_alone
+        record.assert_called_once()
+        assert record.call_args.args[:3] == (lane, 2, True)
+
+    def test_scheduler_max_size_caps_the_batch(self, bot, project, merge_requests):
+        batched, merged_alone, _ = self._process(bot, project, merge_requests)
+
+        assert 1 < len(batched) <= 3
+        assert batched == merge_requests[:len(batched)]
+        assert not merged_alone
+
+    def test_falls_back_to_a_single_merge_when_the_batch_fails_ci(self, bot, project, merge_requests):
+        lane = (project.id, 'master')
+        with patch.object(bot._batch_scheduler, 'batch_size', return_value=3):
+            batched, merged_alone, record = self._process(bot, project, merge_requests, ci_fails=True)
+
+        assert not batched
+        assert merged_alone == merge_requests[:1]
+        record.assert_called_once()
+        assert record.call_args.args[:3] == (lane, 3, False)
+        # The failure makes the next batch smaller
+        assert bot._batch_scheduler.failure_rate(lane) > 1 / 10
+
+    def test_no_batch_when_the_scheduler_says_one(self, bot, project, merge_requests):
+        with patch.object(bot._batch_scheduler, 'batch_size', return_value=1):
+            batched, merged_alone, record = self._process(bot, project, merge_requests)
+
+        assert not batched
+        assert merged_alone == merge_requests[:1]
+        record.assert_not_called()
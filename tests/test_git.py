@@ -1,6 +1,5 @@
 import datetime
 import os
-import re
 import shlex
 import subprocess
 from unittest import mock
@@ -8,6 +7,7 @@ from unittest import mock
 import pytest
 
 import marge.git
+import marge.trailerfilter
 from marge.git import GIT_SSH_COMMAND
 
 
@@ -57,47 +57,332 @@ class TestRepo:
             'git -C /tmp/local/path rev-parse HEAD'
         ]
 
+    def test_targeted_fetch(self, mocked_run):
+        repo = self.repo._replace(targeted_fetch=True)
+        repo.rebase('feature_branch', 'master_of_the_universe')
+        repo.rebase('feature_branch', 'master_of_the_universe', source_remote='fork-1234')
+
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path fetch --no-tags origin '
+            '+refs/heads/master_of_the_universe:refs/remotes/origin/master_of_the_universe '
+            '+refs/heads/feature_branch:refs/remotes/origin/feature_branch',
+            'git -C /tmp/local/path checkout -B feature_branch origin/feature_branch --',
+            'git -C /tmp/local/path rebase origin/master_of_the_universe',
+            'git -C /tmp/local/path rev-parse HEAD',
+            'git -C /tmp/local/path fetch --no-tags origin '
+            '+refs/heads/master_of_the_universe:refs/remotes/origin/master_of_the_universe',
+            'git -C /tmp/local/path checkout -B feature_branch fork-1234/feature_branch --',
+            'git -C /tmp/local/path rebase origin/master_of_the_universe',
+            'git -C /tmp/local/path rev-parse HEAD',
+        ]
+
+    def test_fetch_merge_request(self, mocked_run):
+        self.repo.fetch_merge_request(42, 'fork-1234', 'feature_branch')
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path fetch --no-tags origin '
+            '+refs/merge-requests/42/head:refs/remotes/fork-1234/feature_branch',
+        ]
+
+    def test_ensure_remote(self, mocked_run):
+        remote_urls = {}
+
+        def run(*args, **_kwargs):
+            if args[-3:-1] == ('config', '--get'):
+                if 'fork-1234' not in remote_urls:
+                    raise subprocess.CalledProcessError(1, args)
+                return mocked_stdout(remote_urls['fork-1234'].encode())
+            if 'remote' in args:
+                remote_urls[args[-2]] = args[-1]
+            return mocked_stdout(b'')
+        mocked_run.side_effect = run
+
+        self.repo.ensure_remote('fork-1234', 'ssh://git@git.foo.com/fork.git')
+        self.repo.ensure_remote('fork-1234', 'ssh://git@git.foo.com/fork.git')
+        self.repo.ensure_remote('fork-1234', 'ssh://git@git.foo.com/moved.git')
+
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path config --get remote.fork-1234.url',
+            'git -C /tmp/local/path remote add fork-1234 ssh://git@git.foo.com/fork.git',
+            'git -C /tmp/local/path config --get remote.fork-1234.url',
+            'git -C /tmp/local/path config --get remote.fork-1234.url',
+            'git -C /tmp/local/path remote set-url fork-1234 ssh://git@git.foo.com/moved.git',
+        ]
+
+    def test_add_worktree(self, mocked_run):
+        worktree = self.repo.add_worktree('/tmp/local/path.worktrees/1')
+        worktree.detach()
+
+        assert worktree == self.repo._replace(local_path='/tmp/local/path.worktrees/1')
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path worktree add --detach /tmp/local/path.worktrees/1',
+            'git -C /tmp/local/path.worktrees/1 checkout --detach',
+        ]
+
+    def test_prune(self, mocked_run):
+        self.repo.prune()
+        assert get_calls(mocked_run) == ['git -C /tmp/local/path remote prune origin']
+
+    def test_rebase_deepens_shallow_clone(self, mocked_run):
+        repo = self.repo._replace(clone_strategy=marge.git.CloneStrategy.shallow)
+        merge_bases = iter([False, False, True])
+
+        def run(*args, **_kwargs):
+            if 'merge-base' in args and not next(merge_bases):
+                raise subprocess.CalledProcessError(1, args)
+            if '--is-shallow-repository' in args:
+                return mocked_stdout(b'true\n')
+            return mocked_stdout(b'')
+        mocked_run.side_effect = run
+
+        repo.rebase('feature_branch', 'master_of_the_universe')
+
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path fetch --prune origin',
+            'git -C /tmp/local/path checkout -B feature_branch origin/feature_branch --',
+            'git -C /tmp/local/path merge-base feature_branch origin/master_of_the_universe',
+            'git -C /tmp/local/path rev-parse --is-shallow-repository',
+            'git -C /tmp/local/path fetch --deepen=50 origin',
+            'git -C /tmp/local/path merge-base feature_branch origin/master_of_the_universe',
+            'git -C /tmp/local/path rev-parse --is-shallow-repository',
+            'git -C /tmp/local/path fetch --deepen=100 origin',
+            'git -C /tmp/local/path merge-base feature_branch origin/master_of_the_universe',
+            'git -C /tmp/local/path rebase origin/master_of_the_universe',
+            'git -C /tmp/local/path rev-parse HEAD'
+        ]
+
+    def test_deepen_gives_up_and_unshallows(self, mocked_run):
+        def run(*args, **_kwargs):
+            if 'merge-base' in args:
+                raise subprocess.CalledProcessError(1, args)
+            if '--is-shallow-repository' in args:
+                return mocked_stdout(b'true\n')
+            return mocked_stdout(b'')
+        mocked_run.side_effect = run
+
+        with mock.patch('marge.git.MAX_DEEPEN', 50):
+            self.repo.deepen_to_merge_base('feature_branch', 'source/master', remotes=['source'])
+
+        assert get_calls(mocked_run)[-6:] == [
+            'git -C /tmp/local/path merge-base feature_branch source/master',
+            'git -C /tmp/local/path rev-parse --is-shallow-repository',
+            'git -C /tmp/local/path rev-parse --is-shallow-repository',
+            'git -C /tmp/local/path fetch --unshallow origin',
+            'git -C /tmp/local/path rev-parse --is-shallow-repository',
+            'git -C /tmp/local/path fetch --unshallow source',
+        ]
+
+    def mock_history(self, mocked_run, messages):
+        """Pretend origin/master..feature_branch is `c1`, `c2`, ... with these messages."""
+        commits = [f'c{i}' for i in range(1, len(messages) + 1)]
+        raw_commits = {
+            commit: b'tree t%d\nparent %s\nauthor A U Thor <a@x> 1500000000 +0200\n'
+                    b'committer C O Mitter <c@x> 1500000001 -0100\n\n%s' % (
+                        i, (commits[i - 1] if i else 'base').encode(), message,
+                    )
+            for i, (commit, message) in enumerate(zip(commits, messages))
+        }
+
+        def run(*args, **kwargs):
+            if 'rev-list' in args:
+                range_start = args[-1].split('..')[0]
+                in_range = commits[-1:] if range_start == 'feature_branch^' else commits
+                return mocked_stdout(''.join(
+                    f'{c} {commits[commits.index(c) - 1] if commits.index(c) else "base"}\n'
+                    for c in reversed(in_range)
+                ).encode())
+            if 'rev-parse' in args:
+                return mocked_stdout(commits[-1].encode())
+            if 'cat-file' in args:
+                return mocked_stdout(b''.join(
+                    b'%s commit %d\n%s\n' % (commit.encode(), len(raw_commits[commit]), raw_commits[commit])
+                    for commit in kwargs['stdin'].decode().split()
+                ))
+            if 'commit-tree' in args:
+                return mocked_stdout(b'new-' + args[4].encode() + b'\n')
+            return mocked_stdout(b'')
+        mocked_run.side_effect = run
+
+    def mock_in_memory_fusion(self, mocked_run, *, conflict=False, became_empty=()):
+        """Pretend origin/master..origin/feature_branch is `c1`, `c2`, and origin/master is `m`."""
+        history = [('c1', 'base', b'First\n'), ('c2', 'c1', b'Second\n')]
+        raw_commits = {
+            commit: b'tree t%d\nparent %s\nauthor A U Thor <a@x> 1500000000 +0200\n'
+                    b'committer C O Mitter <c@x> 1500000001 -0100\n\n%s' % (i, parent.encode(), message)
+            for i, (commit, parent, message) in enumerate(history)
+        }
+
+        def merge_tree(args, _kwargs):
+            if args[-1] in became_empty:
+                return b'tree-of-' + args[-2].encode() + b'^{tree}\n'
+            return b'merged-' + args[-1].encode() + b'\nsome info\n'
+
+        outputs = {
+            'rev-list': lambda args, kwargs: b'c1 base\nc2 c1\n',
+            'rev-parse': lambda args, kwargs: {'origin/master': b'm\n'}.get(
+                args[-1], b'tree-of-' + args[-1].encode(),
+            ),
+            'cat-file': lambda args, kwargs: b''.join(
+                b'%s commit %d\n%s\n' % (commit.encode(), len(raw_commits[commit]), raw_commits[commit])
+                for commit in kwargs['stdin'].decode().split()
+            ),
+            'merge-tree': merge_tree,
+            'commit-tree': lambda args, kwargs: b'new-' + args[4].encode() + b'\n',
+            'symbolic-ref': lambda args, kwargs: b'refs/heads/feature_branch\n',
+        }
+
+        def run(*args, **kwargs):
+            command = args[3]
+            if '--is-ancestor' in args or (command == 'merge-tree' and conflict):
+                raise subprocess.CalledProcessError(1, args)
+            return mocked_stdout(outputs.get(command, lambda args, kwargs: b'')(args, kwargs))
+        mocked_run.side_effect = run
+
+    def test_rebase_in_memory(self, mocked_run):
+        self.mock_in_memory_fusion(mocked_run)
+        repo = self.repo._replace(in_memory_fusion=True)
+
+        assert repo.rebase('feature_branch', 'master') == 'new-merged-c2'
+        assert [call.split(' git ')[-1] for call in get_calls(mocked_run)] == [
+            'git -C /tmp/local/path fetch --prune origin',
+            'git -C /tmp/local/path merge-base --is-ancestor origin/master origin/feature_branch',
+            'git -C /tmp/local/path rev-list --reverse --topo-order --parents --cherry-pick --right-only '
+            'origin/master...origin/feature_branch',
+            'git -C /tmp/local/path rev-parse origin/master',
+            "git -C /tmp/local/path rev-parse 'm^{tree}'",
+            'git -C /tmp/local/path cat-file --batch',
+            'git -C /tmp/local/path merge-tree --write-tree --merge-base=base m c1',
+            '-C /tmp/local/path commit-tree merged-c1 -p m',
+            'git -C /tmp/local/path merge-tree --write-tree --merge-base=c1 new-merged-c1 c2',
+            '-C /tmp/local/path commit-tree merged-c2 -p new-merged-c1',
+            'git -C /tmp/local/path symbolic-ref -q HEAD',
+            'git -C /tmp/local/path update-ref --no-deref HEAD HEAD',
+            "git -C /tmp/local/path update-ref -m 'marge-bot: rebase' "
+            "refs/heads/feature_branch new-merged-c2",
+        ]
+        _, commit_tree_kwargs = mocked_run.call_args_list[7]
+        assert commit_tree_kwargs['stdin'] == b'First\n'
+        assert set(commit_tree_kwargs['env'].items()) - set(os.environ.items()) == {
+            ('GIT_AUTHOR_NAME', 'A U Thor'),
+            ('GIT_AUTHOR_EMAIL', 'a@x'),
+            ('GIT_AUTHOR_DATE', '@1500000000 +0200'),
+        }
+
+    def test_rebase_in_memory_drops_commits_already_upstream(self, mocked_run):
+        self.mock_in_memory_fusion(mocked_run, became_empty=['c1'])
+        repo = self.repo._replace(in_memory_fusion=True)
+
+        assert repo.rebase('feature_branch', 'master') == 'new-merged-c2'
+        assert [call.split(' git ')[-1] for call in get_calls(mocked_run)][6:10] == [
+            'git -C /tmp/local/path merge-tree --write-tree --merge-base=base m c1',
+            "git -C /tmp/local/path rev-parse 'base^{tree}'",
+            'git -C /tmp/local/path merge-tree --write-tree --merge-base=c1 m c2',
+            '-C /tmp/local/path commit-tree merged-c2 -p m',
+        ]
+
+    def test_rebase_in_memory_falls_back_on_conflicts(self, mocked_run):
+        self.mock_in_memory_fusion(mocked_run, conflict=True)
+        repo = self.repo._replace(in_memory_fusion=True)
+
+        repo.rebase('feature_branch', 'master')
+        assert get_calls(mocked_run)[-4:] == [
+            'git -C /tmp/local/path merge-tree --write-tree --merge-base=base m c1',
+            'git -C /tmp/local/path checkout -B feature_branch origin/feature_branch --',
+            'git -C /tmp/local/path rebase origin/master',
+            'git -C /tmp/local/path rev-parse HEAD',
+        ]
+
+    def test_merge_in_memory(self, mocked_run):
+        self.mock_in_memory_fusion(mocked_run)
+        repo = self.repo._replace(in_memory_fusion=True)
+
+        assert repo.merge('feature_branch', 'master') == 'new-merged-origin/master'
+        assert get_calls(mocked_run)[1:5] == [
+            'git -C /tmp/local/path merge-base --is-ancestor origin/master origin/feature_branch',
+            'git -C /tmp/local/path merge-base --is-ancestor origin/feature_branch origin/master',
+            'git -C /tmp/local/path merge-tree --write-tree origin/feature_branch origin/master',
+            'git -C /tmp/local/path commit-tree merged-origin/master '
+            '-p origin/feature_branch -p origin/master',
+        ]
+        _, commit_tree_kwargs = mocked_run.call_args_list[4]
+        assert commit_tree_kwargs['stdin'] == (
+            b"Merge remote-tracking branch 'origin/master' into feature_branch\n"
+        )
+
+    def test_push_in_memory_skips_the_working_tree(self, mocked_run):
+        self.repo._replace(in_memory_fusion=True).push('my_branch', force=True)
+        assert get_calls(mocked_run) == ['git -C /tmp/local/path push --force origin my_branch:my_branch']
+
     def test_reviewer_tagging_success(self, mocked_run):
-        self.repo.tag_with_trailer(
+        self.mock_history(mocked_run, [b'First\n\nReviewed-by: Old <old@invalid>\n', b'Second'])
+
+        sha = self.repo.tag_with_trailer(
             trailer_name='Reviewed-by',
             trailer_values=['John Simon <john@invalid>'],
             branch='feature_branch',
             start_commit='origin/master_of_the_universe',
         )
 
-        rewrite, parse = get_calls(mocked_run)
-        pattern = ''.join([
-            'git -C /tmp/local/path filter-branch --force ',
-            '--msg-filter.*John Simon <john@invalid>.*origin/master_of_the_universe..feature_branch',
-        ])
-        assert re.match(pattern, rewrite)
-        assert parse == 'git -C /tmp/local/path rev-parse HEAD'
+        assert sha == 'new-t1'
+        assert [call.split(' git ')[-1] for call in get_calls(mocked_run)] == [
+            'git -C /tmp/local/path rev-list --parents origin/master_of_the_universe..feature_branch',
+            'git -C /tmp/local/path rev-parse feature_branch',
+            'git -C /tmp/local/path cat-file --batch',
+            '-C /tmp/local/path commit-tree t0 -p base',
+            '-C /tmp/local/path commit-tree t1 -p new-t0',
+            "git -C /tmp/local/path update-ref -m 'marge-bot: add trailers' "
+            "refs/heads/feature_branch new-t1 c2",
+        ]
+        _, commit_tree_kwargs = mocked_run.call_args_list[3]
+        assert set(commit_tree_kwargs['env'].items()) - set(os.environ.items()) == {
+            ('GIT_AUTHOR_NAME', 'A U Thor'),
+            ('GIT_AUTHOR_EMAIL', 'a@x'),
+            ('GIT_AUTHOR_DATE', '@1500000000 +0200'),
+            ('GIT_COMMITTER_NAME', 'C O Mitter'),
+            ('GIT_COMMITTER_EMAIL', 'c@x'),
+            ('GIT_COMMITTER_DATE', '@1500000001 -0100'),
+        }
+        messages = [kwargs['stdin'] for args, kwargs in mocked_run.call_args_list if 'commit-tree' in args]
+        assert messages == [
+            b'First\n\nReviewed-by: John Simon <john@invalid>\n',
+            b'Second\n\nReviewed-by: John Simon <john@invalid>\n',
+        ]
 
-    def test_reviewer_tagging_failure(self, mocked_run):
-        def fail_on_filter_branch(*args, **unused_kwargs):
-            if 'filter-branch' in args:
-                raise subprocess.CalledProcessError(returncode=1, cmd='git rebase blah')
-            if 'rev-parse' in args or 'reset' in args:
-                return mock.Mock()
-            raise AssertionError('Unexpected call:', args)
+    def test_tagging_applies_all_trailers_in_one_pass(self, mocked_run):
+        self.mock_history(mocked_run, [b'First', b'Second\n'])
 
-        mocked_run.side_effect = fail_on_filter_branch
+        self.repo.tag_with_trailers(
+            [
+                ('Reviewed-by', ['John Simon <john@invalid>'], 'origin/master'),
+                ('Tested-by', ['Marge <https://mr/1>'], 'feature_branch^'),
+                ('Part-of', ['<https://mr/1>'], 'origin/master'),
+            ],
+            branch='feature_branch',
+        )
 
-        try:
+        assert sum('cat-file' in call for call in get_calls(mocked_run)) == 1
+        messages = [kwargs['stdin'] for args, kwargs in mocked_run.call_args_list if 'commit-tree' in args]
+        assert messages == [
+            b'First\n\nReviewed-by: John Simon <john@invalid>\nPart-of: <https://mr/1>\n',
+            b'Second\n\nReviewed-by: John Simon <john@invalid>\nTested-by: Marge <https://mr/1>\n'
+            b'Part-of: <https://mr/1>\n',
+        ]
+
+    def test_reviewer_tagging_failure(self, mocked_run):
+        self.mock_history(mocked_run, [b'First', b'Reviewed-by: Someone <else@invalid>'])
+
+        with pytest.raises(marge.git.GitError):
             self.repo.tag_with_trailer(
                 trailer_name='Reviewed-by',
                 branch='feature_branch',
                 start_commit='origin/master_of_the_universe',
                 trailer_values=['John Simon <john@invalid.com>']
             )
-        except marge.git.GitError:
-            pass
-        else:
-            assert False
-        rewrite, check, abort = get_calls(mocked_run)
-        assert 'filter-branch' in rewrite
-        assert check == 'git -C /tmp/local/path rev-parse refs/original/refs/heads/'
-        assert abort == 'git -C /tmp/local/path reset --hard refs/original/refs/heads/feature_branch'
+        # the branch was left alone
+        assert not any('update-ref' in call for call in get_calls(mocked_run))
+
+    def test_parents_first(self, unused_mocked_run):
+        parents = {'d': ['c', 'b'], 'c': ['a'], 'b': ['a'], 'a': ['base']}
+        assert marge.git._parents_first(parents) == ['a', 'c', 'b', 'd']  # pylint: disable=protected-access
 
     def test_rebase_same_branch(self, mocked_run):
         with pytest.raises(AssertionError):
@@ -216,7 +501,10 @@ def mocked_stdout(stdout):
 
 
 def _filter_test(message, trailer_name, trailer_values):
-    script = marge.git._filter_branch_script(trailer_name, trailer_values)  # pylint: disable=protected-access
+    trailers = shlex.quote(
+        '\n'.join(f'{trailer_name}: {trailer_value}' for trailer_value in trailer_values or [''])
+    )
+    script = f'TRAILERS={trailers} python3 {marge.trailerfilter.__file__}'
     result = subprocess.check_output(
         [b'sh', b'-c', script.encode('utf-8')],
         input=message.encode('utf-8'),
@@ -307,3 +595,96 @@ def test_filter_ignore_first_line_trailer_in_commit_message_if_not_set():
 
 Reviewed-by: John Simon <john@invalid>
 '''
+
+
+def _git_version():
+    output = subprocess.run(['git', '--version'], check=True, stdout=subprocess.PIPE).stdout.decode('ascii')
+    return tuple(int(part) for part in output.split()[2].split('.')[:2])
+
+
+@pytest.mark.skipif(_git_version() < (2, 40), reason='in-memory fusion needs git merge-tree --merge-base')
+def test_in_memory_rebase_matches_git_rebase(tmp_path, monkeypatch):
+    for role in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{role}_NAME', 'A U Thor')
+        monkeypatch.setenv(f'GIT_{role}_EMAIL', 'a@example.com')
+        monkeypatch.setenv(f'GIT_{role}_DATE', '@1500000000 +0200')
+
+    def git(*args):
+        return subprocess.run(['git', '-C', str(origin), *args], check=True, stdout=subprocess.PIPE).stdout
+
+    def commit(message, **files):
+        for name, content in files.items():
+            (origin / name).write_text(content)
+        git('add', '--all')
+        git('commit', '-q', '-m', message)
+        return git('rev-parse', 'HEAD').decode('ascii').strip()
+
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git('init', '-q', '-b', 'master')
+    commit('Base', **{'a.txt': '1\n2\n3\n'})
+    git('checkout', '-q', '-b', 'feature')
+    picked = commit('Add b', **{'b.txt': 'b\n'})
+    commit('Change a', **{'a.txt': '1\n2\nthree\n'})
+    git('checkout', '-q', 'master')
+    git('cherry-pick', picked)
+    git('revert', '--no-edit', 'HEAD')  # git rebase drops the cherry-picked commit all the same
+    commit('Change a too', **{'a.txt': 'one\n2\n3\n'})
+
+    heads = {}
+    for in_memory_fusion in (False, True):
+        local_path = tmp_path / f'in_memory_{in_memory_fusion}'
+        subprocess.run(['git', 'clone', '-q', str(origin), str(local_path)], check=True)
+        repo = marge.git.Repo(
+            remote_url=str(origin),
+            local_path=str(local_path),
+            ssh_key_file=None,
+            timeout=datetime.timedelta(seconds=30),
+            reference=None,
+            in_memory_fusion=in_memory_fusion,
+        )
+        heads[in_memory_fusion] = repo.rebase('feature', 'master')
+
+    # Same commit ids, so the same trees, parents, messages, authors and committers
+    assert heads[True] == heads[False]
+    origin = tmp_path / 'in_memory_True'
+    assert git('log', '--format=%s', heads[True]).decode('utf-8').splitlines() == [
+        'Change a', 'Change a too', 'Revert "Add b"', 'Add b', 'Base',
+    ]
+    # ... without checking the branch out
+    assert git('symbolic-ref', 'HEAD') == b'refs/heads/master\n'
+
+
+def test_tag_with_trailer_handles_idents_in_other_encodings(tmp_path):
+    def git(*args, stdin=None):
+        return subprocess.run(
+            ['git', '-C', str(tmp_path), *args], check=True, input=stdin, stdout=subprocess.PIPE,
+        ).stdout.strip()
+
+    git('init', '-q', '-b', 'master')
+    empty_tree = git('hash-object', '-t', 'tree', '-w', '--stdin', stdin=b'').decode('ascii')
+    parent = None
+    for message in (b'Base', b'Latin-1 author'):
+        # A commit with no encoding header, but an author that isn't UTF-8
+        ident = b'J\xe9r\xf4me <j@example.com> 1500000000 +0200'
+        raw_commit = b'tree %s\n%sauthor %s\ncommitter %s\n\n%s\n' % (
+            empty_tree.encode(), b'parent %s\n' % parent if parent else b'', ident, ident, message,
+        )
+        parent = git('hash-object', '-t', 'commit', '-w', '--stdin', stdin=raw_commit)
+    git('update-ref', 'refs/heads/master', parent.decode('ascii'))
+    repo = marge.git.Repo(
+        remote_url=str(tmp_path),
+        local_path=str(tmp_path),
+        ssh_key_file=None,
+        timeout=datetime.timedelta(seconds=30),
+        reference=None,
+    )
+
+    head = repo.tag_with_trailer('Tested-by', ['T. Estes <testes@example.com>'], 'master', 'master^')
+
+    # Like git filter-branch, git commit-tree takes what isn't UTF-8 for Latin-1
+    assert git('log', '-1', '--format=%an <%ae> %at%n%cn <%ce> %ct%n%B', head).decode('utf-8') == (
+        'Jérôme <j@example.com> 1500000000\n'
+        'Jérôme <j@example.com> 1500000000\n'
+        'Latin-1 author\n\nTested-by: T. Estes <testes@example.com>'
+    )
@@ -1,3 +1,10 @@
+import asyncio
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
 from marge import gitlab
 
 
@@ -11,3 +18,414 @@ class TestVersion:
     def test_is_ee(self):
         assert gitlab.Version.parse('9.4.0-ee').is_ee
         assert not gitlab.Version.parse('9.4.0').is_ee
+
+
+def _response(status_code, json=None, headers=None):
+    response = Mock(requests.Response)
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.json = Mock(return_value=json)
+    response.content = b''
+    return response
+
+
+class TestApi:
+    def test_mounts_pooled_adapters(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token', pool_connections=3, pool_maxsize=7)
+        # pylint: disable=protected-access
+        for prefix in ('http://', 'https://'):
+            adapter = api._session.get_adapter(prefix + 'gitlab.example.com')
+            assert adapter._pool_connections == 3
+            assert adapter._pool_maxsize == 7
+
+    def test_reuses_one_session(self):
+        api = gitlab.Api('https://gitlab.example.com/', 'token', timeout=(5, 30))
+        version = _response(200, {'version': '16.0.0'})
+        with patch.object(requests.Session, 'request', return_value=version) as request:
+            assert api.version() == gitlab.Version(release=(16, 0, 0), edition=None)
+            api.call(gitlab.PUT('/projects/1/merge_requests/2', {'assignee_id': 3}), sudo=4)
+
+        assert request.call_args_list[0].args == ('GET', 'https://gitlab.example.com/api/v4/version')
+        assert request.call_args_list[0].kwargs == {
+            'headers': {'PRIVATE-TOKEN': 'token'}, 'timeout': (5, 30), 'params': {},
+        }
+        assert request.call_args_list[1].args == (
+            'PUT', 'https://gitlab.example.com/api/v4/projects/1/merge_requests/2',
+        )
+        assert request.call_args_list[1].kwargs == {
+            'headers': {'PRIVATE-TOKEN': 'token', 'SUDO': '4'},
+            'timeout': (5, 30),
+            'json': {'assignee_id': 3},
+        }
+
+    def test_maps_errors(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        with patch.object(requests.Session, 'request', return_value=_response(404, {'message': 'nope'})):
+            with pytest.raises(gitlab.NotFound) as exc_info:
+                api.call(gitlab.GET('/projects/1'))
+        assert exc_info.value.error_message == 'nope'
+
+
+class TestAsyncApi:
+
+    def test_calls_are_in_flight_at_once(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        barrier = threading.Barrier(3, timeout=5)
+
+        def request(_method, url, **_kwargs):
+            barrier.wait()  # only returns once all three requests were made
+            return _response(200, {'url': url})
+
+        async def main():
+            async with gitlab.AsyncApi(api, max_concurrency=3) as async_api:
+                return await asyncio.gather(*(
+                    async_api.run(api.call, gitlab.GET(f'/projects/{n}')) for n in (1, 2, 3)
+                ))
+
+        with patch.object(requests.Session, 'request', side_effect=request):
+            results = asyncio.run(main())
+        assert results == [{'url': f'https://gitlab.example.com/api/v4/projects/{n}'} for n in (1, 2, 3)]
+
+    def test_raises_what_the_api_raises(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        async_api = gitlab.AsyncApi(api)
+        with patch.object(requests.Session, 'request', return_value=_response(404, {'message': 'nope'})):
+            with pytest.raises(gitlab.NotFound) as exc_info:
+                asyncio.run(async_api.run(api.call, gitlab.GET('/projects/1')))
+        async_api.close()
+        assert exc_info.value.error_message == 'nope'
+
+
+class TestCollectAllPages:
+
+    @staticmethod
+    def paged_request(pages, headers_for_page):
+        def request(_method, _url, params, **_kwargs):
+            page_no = int(params['page'])
+            assert params['per_page'] == '100'
+            return _response(200, pages[page_no - 1], headers_for_page(page_no))
+        return request
+
+    def test_fetches_remaining_pages_concurrently(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token', page_concurrency=2)
+        pages = [[{'id': 1}, {'id': 2}], [{'id': 3}], [{'id': 4}], [{'id': 5}]]
+
+        def headers(page_no):
+            return {'x-total-pages': '4', 'x-next-page': str(page_no + 1) if page_no < 4 else ''}
+
+        paged_request = self.paged_request(pages, headers)
+        with patch.object(requests.Session, 'request', side_effect=paged_request) as request:
+            result = api.collect_all_pages(gitlab.GET('/projects', {'simple': True}))
+
+        assert result == [{'id': i} for i in range(1, 6)]
+        requested_pages = sorted(call.kwargs['params']['page'] for call in request.call_args_list)
+        assert requested_pages == ['1', '2', '3', '4']  # and no trailing empty page
+
+    def test_follows_next_page_without_total(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        pages = [[{'id': 1}], [{'id': 2}]]
+
+        def headers(page_no):
+            return {'X-Next-Page': '2' if page_no == 1 else ''}
+
+        paged_request = self.paged_request(pages, headers)
+        with patch.object(requests.Session, 'request', side_effect=paged_request) as request:
+            result = api.collect_all_pages(gitlab.GET('/projects'))
+
+        assert result == [{'id': 1}, {'id': 2}]
+        assert request.call_count == 2
+
+    def test_stops_on_short_page_without_headers(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        pages = [[{'id': i} for i in range(100)], [{'id': 100}]]
+
+        paged_request = self.paged_request(pages, lambda _: {})
+        with patch.object(requests.Session, 'request', side_effect=paged_request) as request:
+            result = api.collect_all_pages(gitlab.GET('/projects'))
+
+        assert len(result) == 101
+        assert request.call_count == 2
+
+    def test_empty_listing(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        headers = {'X-Total-Pages': '1', 'X-Next-Page': ''}
+        with patch.object(requests.Session, 'request', return_value=_response(200, [], headers)) as request:
+            assert not api.collect_all_pages(gitlab.GET('/projects'))
+        assert request.call_count == 1
+
+
+class TestIterAllPages:
+
+    def test_follows_keyset_links_lazily(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        next_link = (
+            '<https://gitlab.example.com/api/v4/projects?id_after=2&order_by=id&pagination=keyset'
+            '&per_page=100&search=foo&sort=asc>; rel="next"'
+        )
+        responses = [
+            _response(200, [{'id': 1}, {'id': 2}], {'Link': next_link}),
+            _response(200, [{'id': 3}], {}),
+        ]
+        with patch.object(requests.Session, 'request', side_effect=responses) as request:
+            projects = api.iter_all_pages(gitlab.GET('/projects', {'search': 'foo'}), keyset=True)
+            assert next(projects) == {'id': 1}
+            assert request.call_count == 1
+            assert list(projects) == [{'id': 2}, {'id': 3}]
+
+        first, second = request.call_args_list
+        assert first.kwargs['params'] == {
+            'pagination': 'keyset', 'per_page': '100', 'order_by': 'id', 'sort': 'asc', 'search': 'foo',
+        }
+        assert second.kwargs['params'] == {
+            'id_after': '2', 'order_by': 'id', 'pagination': 'keyset', 'per_page': '100', 'search': 'foo',
+            'sort': 'asc',
+        }
+
+    def test_falls_back_to_offset_pagination(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        responses = [
+            _response(200, [{'id': 1}], {'X-Next-Page': '2'}),
+            _response(200, [{'id': 2}], {'X-Next-Page': ''}),
+        ]
+        with patch.object(requests.Session, 'request', side_effect=responses) as request:
+            assert list(api.iter_all_pages(gitlab.GET('/things'), keyset=True)) == [{'id': 1}, {'id': 2}]
+
+        assert request.call_args_list[1].kwargs['params']['page'] == '2'
+
+    def test_offset_pagination(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        responses = [
+            _response(200, [{'id': 1}], {'X-Next-Page': '2', 'X-Total-Pages': '2'}),
+            _response(200, [{'id': 2}], {'X-Next-Page': '', 'X-Total-Pages': '2'}),
+        ]
+        with patch.object(requests.Session, 'request', side_effect=responses) as request:
+            assert list(api.iter_all_pages(gitlab.GET('/things'))) == [{'id': 1}, {'id': 2}]
+
+        assert [call.kwargs['params']['page'] for call in request.call_args_list] == ['1', '2']
+
+
+class TestResponseCache:
+
+    def setup_method(self, _method):
+        # pylint: disable=attribute-defined-outside-init
+        self.now = 1000.0
+        self.cache = gitlab.ResponseCache(clock=lambda: self.now)
+        self.api = gitlab.Api('https://gitlab.example.com', 'token', cache=self.cache)
+
+    def test_ttls(self):
+        cache = self.cache
+        assert cache.ttl('/projects/1234') == 300
+        assert cache.ttl('projects/1234/merge_requests/54') == 10
+        assert cache.ttl('/projects/1234/repository/branches/master') == 10
+        assert cache.ttl('/projects/1234/merge_requests/54/pipelines') is None
+        assert cache.ttl('/projects/1234/pipelines/47') is None
+
+    def test_reuses_fresh_responses(self):
+        command = gitlab.GET('/projects/1234/merge_requests/54')
+        response = _response(200)
+        response.json = lambda: {'iid': 54}
+        with patch.object(requests.Session, 'request', return_value=response) as request:
+            first = self.api.call(command)
+            first['sha'] = 'changed by the caller'
+            assert self.api.call(command) == {'iid': 54}
+            assert self.api.call(command._replace(extract=lambda info: info['iid'])) == 54
+            assert request.call_count == 1
+
+            self.now += 11
+            assert self.api.call(command) == {'iid': 54}
+            assert request.call_count == 2
+
+        assert self.cache.stats() == {'hits': 2, 'misses': 2, 'entries': 1}
+
+    def test_keeps_pages(self):
+        command = gitlab.GET('/projects/1234/merge_requests/54/approvals')
+        response = _response(200, [{'id': 1}], {'X-Total-Pages': '1'})
+        with patch.object(requests.Session, 'request', return_value=response) as request:
+            self.api.call(command)
+            page = self.api.call(command)
+        assert request.call_count == 1
+        assert isinstance(page, gitlab.Page) and page.total_pages == 1
+
+    def test_distinguishes_args_and_sudo(self):
+        with patch.object(requests.Session, 'request', return_value=_response(200, {'id': 1})) as request:
+            self.api.call(gitlab.GET('/projects/1234'))
+            self.api.call(gitlab.GET('/projects/1234', {'statistics': True}))
+            self.api.call(gitlab.GET('/projects/1234'), sudo=7)
+            self.api.call(gitlab.GET('/projects/1234'))
+        assert request.call_count == 3
+
+    def test_writes_invalidate_their_project(self):
+        mr_1234 = gitlab.GET('/projects/1234/merge_requests/54')
+        mr_99 = gitlab.GET('/projects/99/merge_requests/54')
+        with patch.object(requests.Session, 'request', return_value=_response(200, {'id': 1})) as request:
+            for command in (mr_1234, mr_99, gitlab.GET('/projects/1234')):
+                self.api.call(command)
+            self.api.call(gitlab.PUT('/projects/1234/merge_requests/54/merge'))
+            assert request.call_count == 4
+
+            for command in (mr_1234, mr_99, gitlab.GET('/projects/1234')):
+                self.api.call(command)
+            # only the merge request of the project written to was fetched again
+            assert request.call_count == 5
+
+            self.api.invalidate_cache()
+            self.api.call(mr_99)
+            assert request.call_count == 6
+
+    def test_errors_are_not_cached(self):
+        command = gitlab.GET('/projects/1234')
+        responses = [_response(404, {'message': 'nope'}), _response(200, {'id': 1234})]
+        with patch.object(requests.Session, 'request', side_effect=responses):
+            with pytest.raises(gitlab.NotFound):
+                self.api.call(command)
+            assert self.api.call(command) == {'id': 1234}
+
+
+class TestConditionalRequests:
+
+    def test_reuses_body_when_not_modified(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        responses = [
+            _response(200, {'iid': 54, 'state': 'opened'}, {'ETag': 'W/"abc"'}),
+            _response(304),
+            _response(200, {'iid': 54, 'state': 'merged'}, {'ETag': 'W/"def"'}),
+        ]
+        command = gitlab.GET('/projects/1234/merge_requests/54')
+        with patch.object(requests.Session, 'request', side_effect=responses) as request:
+            first = api.call(command)
+            first['state'] = 'changed by the caller'
+            assert api.call(command) == {'iid': 54, 'state': 'opened'}
+            assert api.call(command) == {'iid': 54, 'state': 'merged'}
+
+        assert 'If-None-Match' not in request.call_args_list[0].kwargs['headers']
+        assert request.call_args_list[1].kwargs['headers']['If-None-Match'] == 'W/"abc"'
+        assert request.call_args_list[2].kwargs['headers']['If-None-Match'] == 'W/"abc"'
+
+    def test_keeps_pages_and_extract(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        responses = [_response(200, [{'id': 1}], {'ETag': '"abc"', 'X-Total-Pages': '1'}), _response(304)]
+        command = gitlab.GET('/projects/1234/pipelines', {'ref': 'master'})
+        with patch.object(requests.Session, 'request', side_effect=responses):
+            api.call(command)
+            page = api.call(command)
+        assert isinstance(page, gitlab.Page) and page.total_pages == 1 and page == [{'id': 1}]
+
+    def test_only_for_the_same_params_and_sudo(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        with patch.object(
+                requests.Session, 'request', return_value=_response(200, {'id': 1}, {'ETag': '"abc"'}),
+        ) as request:
+            api.call(gitlab.GET('/projects/1234'))
+            api.call(gitlab.GET('/projects/1234', {'statistics': True}))
+            api.call(gitlab.GET('/projects/1234'), sudo=7)
+            api.call(gitlab.PUT('/projects/1234', {'name': 'foo'}))
+
+        for request_call in request.call_args_list[1:]:
+            assert 'If-None-Match' not in request_call.kwargs['headers']
+
+    def test_304_without_etag(self):
+        api = gitlab.Api('https://gitlab.example.com', 'token')
+        with patch.object(requests.Session, 'request', return_value=_response(304)):
+            assert api.call(gitlab.POST('/projects/1234/merge_requests/54/approve')) is False
+
+
+class TestEtagStore:
+
+    def test_forgets_least_recently_used(self):
+        store = gitlab.EtagStore(maxsize=2)
+        entries = [gitlab.EtagEntry(f'"{i}"', {'id': i}, {}) for i in range(3)]
+        store.put('a', entries[0])
+        store.put('b', entries[1])
+        assert store.get('a') is entries[0]
+        store.put('c', entries[2])
+
+        assert len(store) == 2
+        assert store.get('b') is None
+        assert store.get('a') is entries[0]
+        assert store.get('c') is entries[2]
+
+    def test_disabled(self):
+        store = gitlab.EtagStore(maxsize=0)
+        store.put('a', gitlab.EtagEntry('"0"', {'id': 0}, {}))
+        assert store.get('a') is None
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+def _budget(clock, remaining, reset_in, limit=10):
+    return {
+        'RateLimit-Limit': str(limit),
+        'RateLimit-Remaining': str(remaining),
+        'RateLimit-Reset': str(int(clock.now + reset_in)),
+    }
+
+
+class TestRateLimiter:
+
+    def test_unknown_budget_is_not_paced(self):
+        clock = FakeClock()
+        limiter = gitlab.RateLimiter(clock=clock, sleep=clock.sleep)
+        for _ in range(100):
+            limiter.acquire()
+        limiter.update(200, {})
+        limiter.acquire(background=True)
+        assert not clock.sleeps
+
+    def test_spreads_the_budget_until_it_resets(self):
+        clock = FakeClock()
+        limiter = gitlab.RateLimiter(clock=clock, sleep=clock.sleep)
+        limiter.update(200, _budget(clock, remaining=2, reset_in=10))
+        limiter.acquire()
+        limiter.acquire()
+        assert clock.sleeps == [5]
+        limiter.acquire()  # nothing left until the reset
+        assert clock.sleeps == [5, 5]
+
+    def test_background_calls_leave_a_reserve(self):
+        clock = FakeClock()
+        limiter = gitlab.RateLimiter(reserve=0.2, clock=clock, sleep=clock.sleep)
+        limiter.update(200, _budget(clock, remaining=2, reset_in=30))
+        limiter.acquire(background=True)
+        assert clock.sleeps == [30]
+
+        limiter.update(200, _budget(clock, remaining=2, reset_in=30))
+        limiter.acquire()
+        assert clock.sleeps == [30]
+
+    @staticmethod
+    def _api(clock):
+        limiter = gitlab.RateLimiter(clock=clock, sleep=clock.sleep)
+        return gitlab.Api('https://gitlab.example.com', 'token', rate_limiter=limiter)
+
+    def test_honors_retry_after(self):
+        clock = FakeClock(now=1445412480 - 10)  # 10 secs before Wed, 21 Oct 2015 07:28:00 GMT
+        api = self._api(clock)
+        responses = [
+            _response(429, {'message': 'Retry later'}, {'Retry-After': '7'}),
+            _response(429, {'message': 'Retry later'}, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+            _response(200, {'id': 1}),
+        ]
+        with patch.object(requests.Session, 'request', side_effect=responses):
+            assert api.call(gitlab.GET('/projects/1')) == {'id': 1}
+        assert clock.sleeps == [7, 3]
+
+    def test_gives_up_when_still_rate_limited(self):
+        clock = FakeClock()
+        api = self._api(clock)
+        rate_limited = _response(429, {'message': 'No'})
+        with patch.object(requests.Session, 'request', return_value=rate_limited) as request:
+            with pytest.raises(gitlab.TooManyRequests):
+                api.call(gitlab.GET('/projects/1'))
+        assert request.call_count == gitlab.RATE_LIMITED_TRIES
+        assert clock.sleeps == [gitlab.RateLimiter.DEFAULT_RETRY_AFTER] * (gitlab.RATE_LIMITED_TRIES - 1)
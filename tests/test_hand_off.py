@@ -0,0 +1,127 @@
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+import pytest
+
+from marge.hand_off import HandOffReconciler
+
+USER_ID = 77
+AUTHOR_ID = 88
+
+
+def _merge_request(**info):
+    merge_request = Mock(
+        project_id=1234, iid=54, target_branch='master', state='opened', sha='beef',
+        assignee_ids=[USER_ID], author_id=AUTHOR_ID, merge_when_pipeline_succeeds=True,
+    )
+    for attr, value in info.items():
+        setattr(merge_request, attr, value)
+    return merge_request
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestHandOffReconciler:
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.now = 0
+        self.ci_status = 'running'
+        self.target_sha = 'cafe'
+        self.reconciler = HandOffReconciler(
+            api=Mock(), user=Mock(id=USER_ID), timeout=timedelta(minutes=15), clock=lambda: self.now,
+        )
+        with patch('marge.hand_off.PipelineTracker') as tracker_class, \
+                patch('marge.hand_off.Commit') as commit_class:
+            tracker_class.return_value.poll_status.side_effect = lambda: self.ci_status
+            commit_class.last_on_branch.side_effect = lambda *_args: Mock(id=self.target_sha)
+            yield
+
+    def hand_off(self, **info):
+        merge_request = _merge_request(**info)
+        self.reconciler.add(merge_request, 'beef', 'cafe')
+        return merge_request
+
+    def test_keeps_lane_busy_until_merged(self):
+        merge_request = self.hand_off()
+        self.reconciler.reconcile()
+        assert self.reconciler.busy_lanes() == {(1234, 'master')}
+
+        merge_request.state = 'merged'
+        self.reconciler.reconcile()
+        assert not self.reconciler.busy_lanes() and not self.reconciler.pending
+        merge_request.comment.assert_not_called()
+
+    def test_gives_up_when_ci_fails(self):
+        merge_request = self.hand_off()
+        self.ci_status = 'failed'
+        self.reconciler.reconcile()
+
+        assert not self.reconciler.pending
+        merge_request.cancel_merge_when_pipeline_succeeds.assert_called_once_with()
+        merge_request.hand_back.assert_called_once_with(USER_ID)
+        merge_request.comment.assert_called_once_with("I couldn't merge this merge request: CI failed!")
+
+    def test_gives_up_when_ci_takes_too_long(self):
+        merge_request = self.hand_off()
+        self.now = 15 * 60 + 1
+        self.reconciler.reconcile()
+
+        assert not self.reconciler.pending
+        merge_request.comment.assert_called_once_with(
+            "I couldn't merge this merge request: CI is taking too long.",
+        )
+
+    @pytest.mark.parametrize('ci_status', ['success', 'skipped'])
+    def test_waits_for_gitlab_once_ci_passed(self, ci_status):
+        merge_request = self.hand_off()
+        self.ci_status = ci_status
+        # GitLab may merge it any time now: neither the time nor the target moving matter anymore
+        self.now = 15 * 60 + 1
+        self.target_sha = 'f00d'
+        self.reconciler.reconcile()
+
+        assert self.reconciler.busy_lanes() == {(1234, 'master')}
+        merge_request.cancel_merge_when_pipeline_succeeds.assert_not_called()
+        merge_request.comment.assert_not_called()
+
+    def test_gives_up_when_someone_pushed(self):
+        merge_request = self.hand_off()
+        merge_request.sha = 'f00d'
+        merge_request.merge_when_pipeline_succeeds = False
+        self.reconciler.reconcile()
+
+        merge_request.cancel_merge_when_pipeline_succeeds.assert_not_called()
+        merge_request.comment.assert_called_once_with(
+            "I couldn't merge this merge request: Someone pushed to branch while we were trying to merge",
+        )
+
+    def test_starts_over_when_target_moved(self):
+        merge_request = self.hand_off()
+        self.target_sha = 'f00d'
+        self.reconciler.reconcile()
+
+        assert not self.reconciler.pending
+        merge_request.cancel_merge_when_pipeline_succeeds.assert_called_once_with()
+        merge_request.hand_back.assert_not_called()
+        merge_request.comment.assert_called_once_with(
+            "My job would be easier if people didn't jump the queue and push directly... *sigh*"
+        )
+
+    def test_starts_over_when_gitlab_dropped_the_merge(self):
+        merge_request = self.hand_off()
+        merge_request.merge_when_pipeline_succeeds = False
+        self.reconciler.reconcile()
+
+        assert not self.reconciler.pending
+        merge_request.hand_back.assert_not_called()
+        merge_request.comment.assert_not_called()
+
+    def test_lets_go_of_merge_requests_no_longer_ours(self):
+        merge_request = self.hand_off(iid=55)
+        other_merge_request = self.hand_off(iid=56, target_branch='stable')
+        merge_request.assignee_ids = []
+        self.reconciler.reconcile()
+
+        assert self.reconciler.busy_lanes() == {(1234, 'stable')}
+        merge_request.comment.assert_not_called()
+        other_merge_request.comment.assert_not_called()
@@ -1,10 +1,11 @@
 # pylint: disable=protected-access
+import threading
 from datetime import timedelta
 from unittest.mock import ANY, MagicMock, patch, create_autospec
 
 import pytest
 
-from marge.job import CannotMerge, Fusion, MergeJob, MergeJobOptions, SkipMerge
+from marge.job import CannotMerge, Fusion, MergeJob, MergeJobOptions, Mergeability, SkipMerge
 import marge.interval
 import marge.git
 import marge.gitlab
@@ -53,6 +54,32 @@ class TestJob:
             assert r_source_project is not merge_job._project
             assert r_source_project is project_class.fetch_by_id.return_value
 
+            # the same fork is not fetched again
+            assert merge_job.get_source_project(merge_request) is r_source_project
+            project_class.fetch_by_id.assert_called_once()
+
+    @pytest.mark.parametrize('head_sha', ['abc', 'stale'])
+    def test_fetch_source_project_when_is_fork(self, head_sha):
+        with patch('marge.job.Project') as project_class:
+            merge_job = self.get_merge_job()
+            source_project = project_class.fetch_by_id.return_value
+            source_project.id = 1235
+            merge_request = self._mock_merge_request(iid=54, source_branch='feature', sha='abc')
+            repo = merge_job._repo
+            repo.get_commit_hash.return_value = head_sha
+
+            assert merge_job.fetch_source_project(merge_request) == (source_project, 'fork-1235', 'fork-1235')
+
+            repo.ensure_remote.assert_called_once_with('fork-1235', source_project.ssh_url_to_repo)
+            repo.fetch_merge_request.assert_called_once_with(54, 'fork-1235', 'feature')
+            repo.get_commit_hash.assert_called_once_with('fork-1235/feature')
+            if head_sha == 'abc':
+                repo.fetch.assert_not_called()
+            else:
+                repo.fetch.assert_called_once_with(
+                    remote_name='fork-1235', remote_url=source_project.ssh_url_to_repo, branches=['feature'],
+                )
+
     @pytest.mark.parametrize(
         'version,use_merge_request_pipelines',
         [('10.5.0-ee', True)],
@@ -84,6 +111,29 @@ class TestJob:
                 )
             assert r_ci_status == 'success'
 
+    def test_fetch_mergeability_fetches_everything_at_once(self):
+        merge_job = self.get_merge_job()
+        merge_request = self._mock_merge_request(iid=54, target_project_id=1234, target_branch='master')
+        # Only lets them through once all four calls are in flight
+        barrier = threading.Barrier(4, timeout=5)
+
+        def fetched(result):
+            def fetch(*_args):
+                barrier.wait()
+                return result
+            return fetch
+
+        merge_request.fetch_approvals.side_effect = fetched('approvals')
+        merge_request.refetch_info.side_effect = fetched(None)
+        with patch('marge.job.Pipeline') as pipeline_class, patch('marge.job.Branch') as branch_class:
+            pipeline_class.pipelines_by_merge_request.side_effect = fetched(['pipeline'])
+            branch_class.fetch_by_name.side_effect = fetched('master')
+            mergeability, = merge_job.fetch_mergeability([merge_request], pipelines=True, target_branch=True)
+
+        assert mergeability == Mergeability('approvals', ['pipeline'], 'master')
+        pipeline_class.pipelines_by_merge_request.assert_called_once_with(1234, 54, merge_job._api)
+        branch_class.fetch_by_name.assert_called_once_with(1234, 'master', merge_job._api)
+
     def test_ensure_mergeable_mr_not_assigned(self):
         merge_job = self.get_merge_job()
         merge_request = self._mock_merge_request(
@@ -170,14 +220,8 @@ class TestJob:
         merge_job = self.get_merge_job()
         merge_request = self._mock_merge_request()
 
-        # when we are not the author
-        merge_job.unassign_from_mr(merge_request)
-        merge_request.assign_to.assert_called_once_with(merge_request.author_id)
-
-        # when we are the author
-        merge_request.author_id = merge_job._user.id
         merge_job.unassign_from_mr(merge_request)
-        merge_request.unassign.assert_called_once()
+        merge_request.hand_back.assert_called_once_with(merge_job._user.id)
 
     def test_fuse_using_rebase(self):
         merge_job = self.get_merge_job(options=MergeJobOptions.default(fusion=Fusion.rebase))
@@ -189,7 +233,7 @@ class TestJob:
         merge_job._repo.rebase.assert_called_once_with(
             branch_a,
             branch_b,
-            source_repo_url=ANY,
+            source_remote=ANY,
             local=ANY,
         )
 
@@ -203,7 +247,7 @@ class TestJob:
         merge_job._repo.merge.assert_called_once_with(
             branch_a,
             branch_b,
-            source_repo_url=ANY,
+            source_remote=ANY,
             local=ANY,
         )
 
@@ -222,7 +266,9 @@ class TestMergeJobOptions:
             use_no_ff_batches=False,
             use_merge_commit_batches=False,
             skip_ci_batches=False,
+            bisect_batches=False,
             guarantee_final_pipeline=False,
+            hand_off=False,
         )
 
     def test_default_ci_time(self):
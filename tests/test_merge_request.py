@@ -1,9 +1,10 @@
-from unittest.mock import call, Mock
+from unittest.mock import call, patch, Mock
 
 import pytest
 
 from marge.gitlab import Api, GET, POST, PUT, Version
-from marge.merge_request import MergeRequest, MergeRequestRebaseFailed
+from marge.merge_request import AssignedAtCache, MergeRequest, MergeRequestRebaseFailed
+from marge.webhook import Event, MERGE_REQUEST_HOOK
 import marge.user
 
 from tests.test_user import INFO as USER_INFO
@@ -106,6 +107,16 @@ class TestMergeRequest:
         self.merge_request.unassign()
         self.api.call.assert_called_once_with(PUT('/projects/1234/merge_requests/54', {'assignee_id': 0}))
 
+    def test_hand_back_to_author(self):
+        self.merge_request.hand_back(42)
+        self.api.call.assert_called_once_with(
+            PUT('/projects/1234/merge_requests/54', {'assignee_id': INFO['author']['id']})
+        )
+
+    def test_hand_back_when_we_are_the_author(self):
+        self.merge_request.hand_back(INFO['author']['id'])
+        self.api.call.assert_called_once_with(PUT('/projects/1234/merge_requests/54', {'assignee_id': 0}))
+
     def test_rebase_was_not_in_progress_no_error(self):
         expected = [
             (
@@ -130,21 +141,24 @@ class TestMergeRequest:
                 GET(
                     '/projects/1234/merge_requests/54',
                     {'include_rebase_in_progress': 'true'}
-                ),  # refetch_info -> succeeded
+                ),  # refetch_info -> succeeded, but GitLab still shows the old SHA
                 dict(INFO, rebase_in_progress=False)
             ),
             (
                 GET(
                     '/projects/1234/merge_requests/54',
                     {'include_rebase_in_progress': 'true'}
-                ),  # second refetch_info with correct SHA
-                dict(INFO, rebase_in_progress=False)
+                ),  # refetch_info with the new SHA
+                dict(INFO, rebase_in_progress=False, sha='rebased')
             ),
         ]
 
         self.api.call = Mock(side_effect=[resp for (req, resp) in expected])
-        self.merge_request.rebase()
+        with patch('marge.merge_request.polling.sleep') as sleep:
+            self.merge_request.rebase()
         self.api.call.assert_has_calls([call(req) for (req, resp) in expected])
+        assert self.merge_request.sha == 'rebased'
+        assert [args[0] for args, _ in sleep.call_args_list] == [0.5, 0.75]
 
     def test_rebase_was_not_in_progress_error(self):
         expected = [
@@ -195,20 +209,56 @@ class TestMergeRequest:
                     '/projects/1234/merge_requests/54',
                     {'include_rebase_in_progress': 'true'}
                 ),  # refetch_info -> succeeded
-                dict(INFO, rebase_in_progress=False)
-            ),
-            (
-                GET(
-                    '/projects/1234/merge_requests/54',
-                    {'include_rebase_in_progress': 'true'}
-                ),  # second refetch_info with correct SHA
-                dict(INFO, rebase_in_progress=False)
+                dict(INFO, rebase_in_progress=False, sha='rebased')
             ),
         ]
         self.api.call = Mock(side_effect=[resp for (req, resp) in expected])
-        self.merge_request.rebase()
+        with patch('marge.merge_request.polling.sleep'):
+            self.merge_request.rebase()
         self.api.call.assert_has_calls([call(req) for (req, resp) in expected])
 
+    def test_rebase_waits_for_the_base_to_change(self):
+        old = dict(INFO, diff_refs={'base_sha': 'old-base', 'head_sha': INFO['sha']})
+        new = dict(old, sha='rebased', diff_refs={'base_sha': 'new-base', 'head_sha': 'rebased'})
+        self.api.call = Mock(side_effect=[old, True, old, old, new])
+        with patch('marge.merge_request.polling.sleep'):
+            self.merge_request.rebase(target_sha='new-base')
+        assert self.merge_request.sha == 'rebased'
+
+    def test_rebase_already_up_to_date(self):
+        up_to_date = dict(INFO, diff_refs={'base_sha': 'new-base', 'head_sha': INFO['sha']})
+        self.api.call = Mock(side_effect=[up_to_date, True, up_to_date])
+        with patch('marge.merge_request.polling.sleep') as sleep:
+            self.merge_request.rebase(target_sha='new-base')
+        sleep.assert_not_called()
+
+    def test_rebase_settles_without_target_sha(self):
+        self.api.call = Mock(side_effect=[INFO, True, INFO, INFO])
+        with patch('marge.merge_request.polling.sleep'), \
+                patch('marge.merge_request.time.monotonic', side_effect=[0, 0, 1, 2, 8]):
+            self.merge_request.rebase(settle_time=7)
+        assert self.api.call.call_count == 4
+
+    def test_rebase_timeout(self):
+        self.api.call = Mock(side_effect=[INFO, True] + [dict(INFO, rebase_in_progress=True)] * 2)
+        with patch('marge.merge_request.polling.sleep'), \
+                patch('marge.merge_request.time.monotonic', side_effect=[0, 10, 31]):
+            with pytest.raises(TimeoutError):
+                self.merge_request.rebase(timeout=30)
+
+    def test_rebase_woken_up_by_webhook(self):
+        events = Mock(cursor=Mock(return_value=3))
+        in_progress, rebased = dict(INFO, rebase_in_progress=True), dict(INFO, sha='new')
+        self.api.call = Mock(side_effect=[INFO, True, in_progress, rebased])
+        with patch('marge.merge_request.polling.sleep') as sleep:
+            self.merge_request.rebase(events=events)
+
+        (_, sleep_events, match), kwargs = sleep.call_args
+        assert sleep_events is events and kwargs == {'since': 3}
+        for iid, relevant in ((54, True), (55, False)):
+            event = Event(MERGE_REQUEST_HOOK, {'object_attributes': {'iid': iid, 'target_project_id': 1234}})
+            assert match(event) is relevant
+
     def test_accept_remove_branch(self):
         self._load(dict(INFO, sha='badc0de'))
 
@@ -276,6 +326,64 @@ class TestMergeRequest:
         ))
         assert result == 1597733578.093
 
+    def test_sorted_by_merge_order(self):
+        user = marge.user.User(api=None, info=dict(USER_INFO, id=_MARGE_ID))
+        old = MergeRequest(self.api, dict(INFO, id=1, created_at='2020-08-01T00:00:00.000Z',
+                                          updated_at='2020-08-05T00:00:00.000Z'))
+        new = MergeRequest(self.api, dict(INFO, id=2, created_at='2020-08-02T00:00:00.000Z',
+                                          updated_at='2020-08-03T00:00:00.000Z'))
+
+        def sort(merge_order):
+            return MergeRequest.sorted_by_merge_order(
+                [new, old], user=user, api=self.api, merge_order=merge_order,
+            )
+
+        assert sort('created_at') == [old, new]
+        assert sort('updated_at') == [new, old]
+
+        assigned_at = {1: 20, 2: 10}
+
+        def fetch_assigned_at(user, api, merge_request):  # pylint: disable=unused-argument
+            return assigned_at[merge_request['id']]
+
+        with patch.object(MergeRequest, 'fetch_assigned_at', side_effect=fetch_assigned_at):
+            assert sort('assigned_at') == [new, old]
+
+    def test_assigned_at_cache(self):
+        user = marge.user.User(api=None, info=dict(USER_INFO, id=_MARGE_ID))
+        mr1 = dict(INFO, updated_at='2020-08-05T00:00:00.000Z')
+        mr2 = dict(INFO, iid=55, updated_at='2020-08-05T00:00:00.000Z')
+        cache = AssignedAtCache()
+
+        with patch.object(MergeRequest, 'fetch_assigned_at', side_effect=[10, 20, 30, 40]) as fetch:
+            assert cache.fetch(user, self.api, mr1) == 10
+            assert cache.fetch(user, self.api, mr2) == 20
+            assert cache.fetch(user, self.api, dict(mr1)) == 10
+            assert fetch.call_count == 2
+
+            # reassigned
+            assert cache.fetch(user, self.api, dict(mr1, updated_at='2020-08-06T00:00:00.000Z')) == 30
+
+            cache.retain([mr1])
+            assert cache.fetch(user, self.api, mr2) == 40
+            assert fetch.call_count == 4
+
+    def test_fetch_all_open_assigned_to_me_with_cache(self):
+        api = self.api
+        user = marge.user.User(api=None, info=dict(USER_INFO, id=_MARGE_ID))
+        mr1 = dict(INFO, updated_at='2020-08-05T00:00:00.000Z')
+        mr2 = dict(INFO, iid=55, updated_at='2020-08-05T00:00:00.000Z')
+        api.collect_all_pages = Mock(return_value=[mr1, mr2])
+        cache = AssignedAtCache()
+
+        with patch.object(MergeRequest, 'fetch_assigned_at', side_effect=[20, 10]) as fetch_assigned_at:
+            for _ in range(3):
+                result = MergeRequest.fetch_all_open_assigned_to_me(
+                    user=user, api=api, merge_order='assigned_at', assigned_at_cache=cache,
+                )
+                assert [mr.iid for mr in result] == [55, 54]
+        assert fetch_assigned_at.call_count == 2
+
     def _load(self, json):
         old_mock = self.api.call
         self.api.call = Mock(return_value=json)
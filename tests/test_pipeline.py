@@ -1,7 +1,9 @@
-from unittest.mock import Mock
+import time
+from unittest.mock import Mock, call, patch
 
+from marge import polling, webhook
 from marge.gitlab import Api, GET
-from marge.pipeline import Pipeline
+from marge.pipeline import Pipeline, PipelineTracker
 
 
 INFO = {
@@ -48,3 +50,97 @@ class TestPipeline:
         assert pipeline.status == "pending"
         assert pipeline.ref == "new-pipeline"
         assert pipeline.sha == "a91957a858320c0e17f3a0eca7cfacbff50ea29a"
+
+    def test_fetch_by_id(self):
+        api = self.api
+        api.call = Mock(return_value=dict(INFO))
+
+        pipeline = Pipeline.fetch_by_id(project_id=1234, pipeline_id=47, api=api)
+
+        api.call.assert_called_once_with(GET('/projects/1234/pipelines/47'))
+        assert pipeline.status == 'pending'
+        assert pipeline.project_id == 1234
+
+
+class TestPipelineTracker:
+
+    def setup_method(self, _method):
+        self.api = Mock(Api)
+        self.merge_request = Mock(target_project_id=1234, iid=54, source_branch='new-pipeline')
+
+    def test_lists_pipelines_only_until_found(self):
+        api = self.api
+        api.call = Mock(side_effect=[
+            [dict(INFO, id=46, sha='other')],
+            [dict(INFO, id=46, sha='other'), INFO],
+            dict(INFO, status='running'),
+            dict(INFO, status='success'),
+        ])
+        tracker = PipelineTracker(api, self.merge_request, INFO['sha'])
+
+        assert [tracker.poll_status() for _ in range(4)] == [None, 'pending', 'running', 'success']
+        assert api.call.call_args_list == [
+            call(GET('/projects/1234/merge_requests/54/pipelines')),
+            call(GET('/projects/1234/merge_requests/54/pipelines')),
+            call(GET('/projects/1234/pipelines/47')),
+            call(GET('/projects/1234/pipelines/47')),
+        ]
+
+    def test_lists_pipelines_of_ref(self):
+        api = self.api
+        api.call = Mock(side_effect=[[INFO], dict(INFO, status='success')])
+        tracker = PipelineTracker(api, self.merge_request, INFO['sha'], ref='marge_bot_train/54')
+
+        assert [tracker.poll_status() for _ in range(2)] == ['pending', 'success']
+        assert api.call.call_args_list == [
+            call(GET(
+                '/projects/1234/pipelines',
+                {'ref': 'marge_bot_train/54', 'order_by': 'id', 'sort': 'desc'},
+            )),
+            call(GET('/projects/1234/pipelines/47')),
+        ]
+
+    def test_newer_pipeline_supersedes_failed_one(self):
+        api = self.api
+        api.call = Mock(side_effect=[
+            [INFO],
+            dict(INFO, status='failed'),
+            [dict(INFO, id=48, status='running'), dict(INFO, status='failed')],
+        ])
+        tracker = PipelineTracker(api, self.merge_request, INFO['sha'])
+
+        assert tracker.poll_status() == 'pending'
+        assert tracker.poll_status() == 'running'
+        assert tracker.pipeline.id == 48
+
+    def test_backoff_grows_while_status_is_unchanged(self):
+        api = self.api
+        api.call = Mock(side_effect=[[INFO], dict(INFO), dict(INFO, status='running')])
+        backoff = polling.Backoff(2, 10, factor=2)
+        tracker = PipelineTracker(api, self.merge_request, INFO['sha'], backoff=backoff)
+
+        with patch('time.sleep') as sleep:
+            tracker.poll_status()
+            tracker.wait(60)
+            tracker.poll_status()
+            tracker.wait(60)
+            tracker.wait(3)
+            tracker.poll_status()  # status changed
+            tracker.wait(60)
+
+        assert sleep.call_args_list == [call(2), call(4), call(3), call(2)]
+
+    def test_pipeline_event_ends_the_wait(self):
+        api = self.api
+        api.call = Mock(side_effect=[[INFO]])
+        events = webhook.EventHub()
+        tracker = PipelineTracker(api, self.merge_request, INFO['sha'], events=events)
+        tracker.poll_status()
+
+        # published after polling, but before waiting: must not be missed
+        events.publish(webhook.Event(webhook.PIPELINE_HOOK, {'object_attributes': {'id': 46}}))
+        events.publish(webhook.Event(webhook.PIPELINE_HOOK, {'object_attributes': {'id': 47}}))
+
+        time_0 = time.monotonic()
+        tracker.wait(60)
+        assert time.monotonic() - time_0 < 1
@@ -0,0 +1,71 @@
+from unittest.mock import patch
+
+from marge import polling, webhook
+
+
+def test_backoff():
+    backoff = polling.Backoff(initial=5, maximum=30)
+    assert [backoff.next_delay() for _ in range(6)] == [5, 7.5, 11.25, 16.875, 25.3125, 30]
+    backoff.reset()
+    assert backoff.next_delay() == 5
+
+
+def test_sleep_without_events():
+    with patch('time.sleep') as sleep:
+        assert polling.sleep(3) is None
+        assert polling.sleep(0) is None
+    sleep.assert_called_once_with(3)
+
+
+def test_sleep_is_cut_short_by_matching_event():
+    events = webhook.EventHub()
+    since = events.cursor()
+    event = webhook.Event(webhook.PIPELINE_HOOK, {})
+    events.publish(webhook.Event(webhook.NOTE_HOOK, {}))
+    events.publish(event)
+
+    def match(candidate):
+        return candidate.kind == webhook.PIPELINE_HOOK
+
+    assert polling.sleep(60, events, match, since=since) is event
+    assert polling.sleep(0.01, events, match) is None
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, secs):
+        self.now += secs
+
+    def monotonic(self):
+        return self.now
+
+
+def test_wait_until_returns_as_soon_as_satisfied():
+    clock = FakeClock()
+    results = iter([None, None, 'done'])
+    with patch('time.sleep', side_effect=clock.sleep), patch('time.monotonic', side_effect=clock.monotonic):
+        assert polling.wait_until(lambda: next(results), timeout=60, name='test-satisfied') == 'done'
+    assert clock.now == 0.5 + 0.75
+    assert polling.WAITS.summary()['test-satisfied'] == {
+        'count': 1, 'timeouts': 0, 'total_secs': 1.25, 'max_secs': 1.25,
+    }
+
+
+def test_wait_until_gives_up():
+    clock = FakeClock()
+    with patch('time.sleep', side_effect=clock.sleep), patch('time.monotonic', side_effect=clock.monotonic):
+        assert polling.wait_until(lambda: False, timeout=10, name='test-timeout') is False
+        assert polling.wait_until(lambda: False, timeout=2, name='test-timeout') is False
+    stats = polling.WAITS.summary()['test-timeout']
+    assert stats == {'count': 2, 'timeouts': 2, 'total_secs': 12, 'max_secs': 10}
+
+
+def test_wait_metrics():
+    metrics = polling.WaitMetrics()
+    metrics.record('merge status', 1.5, True)
+    metrics.record('merge status', 10, False)
+    assert metrics.summary() == {
+        'merge status': {'count': 2, 'timeouts': 1, 'total_secs': 11.5, 'max_secs': 10},
+    }
@@ -56,12 +56,29 @@ class TestProject:
         prj1 = INFO
         prj2 = dict(INFO, id=1235, path_with_namespace='foo/bar')
         prj3 = dict(INFO, id=1240, path_with_namespace='foo/foo')
-        api.collect_all_pages = Mock(return_value=[prj1, prj2, prj3])
+        consumed = []
+
+        def iter_all_pages(*_args, **_kwargs):
+            for prj in (prj1, prj2, prj3):
+                consumed.append(prj)
+                yield prj
+
+        api.iter_all_pages = Mock(side_effect=iter_all_pages)
 
         project = Project.fetch_by_path('foo/bar', api)
 
-        api.collect_all_pages.assert_called_once_with(GET('/projects'))
+        api.iter_all_pages.assert_called_once_with(
+            GET('/projects', {'search': 'foo/bar', 'search_namespaces': True}),
+            keyset=True,
+        )
         assert project and project.info == prj2
+        assert consumed == [prj1, prj2]  # stopped reading as soon as it was found
+
+    def test_fetch_by_path_missing(self):
+        api = self.api
+        api.iter_all_pages = Mock(return_value=iter([INFO]))
+
+        assert Project.fetch_by_path('foo/bar', api) is None
 
     def fetch_all_mine_with_min_access_level(self):
         prj1, prj2 = dict(INFO, permissions=NONE_ACCESS), dict(INFO, id=678, permissions=NONE_ACCESS)
@@ -1,4 +1,4 @@
-# pylint: disable=too-many-locals
+# pylint: disable=too-many-locals,too-many-lines
 import contextlib
 from collections import namedtuple
 from datetime import timedelta
@@ -12,6 +12,7 @@ import marge.interval
 import marge.git
 import marge.gitlab
 import marge.job
+import marge.pipeline
 import marge.project
 import marge.single_merge_job
 import marge.user
@@ -276,7 +277,13 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
 
     @pytest.fixture(autouse=True)
     def patch_sleep(self):
-        with patch('time.sleep'):
+        # Time only passes when sleeping, so waits give up without delaying the tests
+        clock = [0.0]
+
+        def sleep(secs):
+            clock[0] += secs
+
+        with patch('time.sleep', side_effect=sleep), patch('time.monotonic', side_effect=lambda: clock[0]):
             yield
 
     @pytest.fixture()
@@ -364,6 +371,30 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
         assert api.state == 'merged'
         assert api.notes == []
 
+    def test_hands_off_to_gitlab(self, mocks_factory):
+        mocklab, api, job = mocks_factory(extra_opts={'hand_off': True})
+        sha = mocklab.rewritten_sha
+        if job.opts.fusion is Fusion.gitlab_rebase:
+            sha = mocklab.merge_request_info['sha']
+            api.add_transition(
+                PUT(
+                    f"/projects/1234/merge_requests/{mocklab.merge_request_info['iid']}/merge",
+                    {'sha': sha, 'should_remove_source_branch': True, 'merge_when_pipeline_succeeds': True},
+                ),
+                Ok({}),
+                from_state='pipeline-running', to_state='merged',
+            )
+
+        with patch.object(job, 'wait_for_ci_to_pass') as wait_for_ci_to_pass, \
+                patch.object(job, 'wait_for_branch_to_be_merged') as wait_for_branch_to_be_merged:
+            job.execute()
+
+        assert api.state == 'merged'  # as far as the mock is concerned
+        assert job.handed_off == (sha, mocklab.initial_master_sha)
+        assert api.notes == []
+        wait_for_ci_to_pass.assert_not_called()
+        wait_for_branch_to_be_merged.assert_not_called()
+
     def test_succeeds_with_updated_branch(self, mocks):
         mocklab, api, job = mocks
 
@@ -511,7 +542,7 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
                 f"/projects/{mocklab.merge_request_info['source_project_id']}/repository/branches/useless_new_feature",
             ),
             Ok({'commit': _commit(commit_id=new_branch_head_sha, status='success')}),
-            from_state='pushed', to_state='pushed_but_head_changed'
+            from_state=['pushed', 'pushed_but_head_changed'], to_state='pushed_but_head_changed'
         )
         with mocklab.expected_failure("Someone pushed to branch while we were trying to merge"):
             job.execute()
@@ -990,3 +1021,17 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
 
         assert api.state == 'initial'
         assert api.notes == [f"I couldn't merge this merge request: {expected_message}"]
+
+    def test_waits_for_new_pipeline(self, mocks):
+        _, api, job = mocks
+        merge_request = job._merge_request  # pylint: disable=protected-access
+        old = marge.pipeline.Pipeline(api, {'id': 7, 'sha': 'abc', 'status': 'success'}, 1234)
+        new = marge.pipeline.Pipeline(api, {'id': 8, 'sha': 'abc', 'status': 'pending'}, 1234)
+
+        with patch.object(
+                marge.pipeline.Pipeline, 'pipelines_by_merge_request', side_effect=[[old], [old], [new, old]],
+        ) as pipelines_by_merge_request:
+            assert job.last_pipeline_id(merge_request) == 7
+            job.wait_for_new_pipeline(merge_request, 'abc', 7)
+
+        assert pipelines_by_merge_request.call_count == 3
@@ -1,5 +1,8 @@
 import os.path
+import re
+import subprocess
 import tempfile
+import threading
 from unittest import mock
 
 import marge.git
@@ -128,3 +131,197 @@ class TestRepoManager:
 
         # shouldn't fail
         repo_manager.forget_repo(self.new_project(90, 'non/existent'))
+
+    def test_project_locks(self, unused_git_run):
+        repo_manager = self.repo_manager
+        project_1 = self.new_project(1234, 'some/stuff')
+        project_2 = self.new_project(5678, 'other/things')
+
+        lock_1 = repo_manager.project_lock(project_1)
+        assert repo_manager.project_lock(project_1) is lock_1
+        assert repo_manager.project_lock(project_2) is not lock_1
+
+        # re-entrant, so callers may hold it around repo_for_project()
+        with lock_1:
+            repo_manager.repo_for_project(project_1)
+
+        acquired_elsewhere = []
+
+        def try_acquire():
+            acquired_elsewhere.append(lock_1.acquire(blocking=False))
+
+        with lock_1:
+            thread = threading.Thread(target=try_acquire)
+            thread.start()
+            thread.join()
+        assert acquired_elsewhere == [False]
+
+    def new_persistent_repo_manager(self):
+        return marge.store.SshRepoManager(
+            user=self.repo_manager.user,
+            root_dir=self.root_dir.name,
+            skip_clone=False,
+            ssh_key_file='/ssh/key',
+            persistent=True,
+        )
+
+    def test_persistent_clones_live_under_project_id(self, git_run):
+        repo_manager = self.new_persistent_repo_manager()
+        project = self.new_project(1234, 'some/stuff')
+
+        repo = repo_manager.repo_for_project(project)
+
+        assert repo.local_path == os.path.join(self.root_dir.name, '1234')
+        assert os.path.exists(os.path.join(self.root_dir.name, '1234.lock'))
+        assert [call.split(' git ')[1] for call in get_git_calls(git_run)] == [
+            f'clone --origin=origin {project.ssh_url_to_repo} {repo.local_path}',
+            f'-C {repo.local_path} config user.email pparker@bugle.com',
+            f"-C {repo.local_path} config user.name 'Peter Parker'",
+        ]
+
+    def test_reuses_persistent_clone(self, git_run):
+        project = self.new_project(1234, 'some/stuff')
+        local_path = os.path.join(self.root_dir.name, '1234')
+        os.makedirs(os.path.join(local_path, '.git'))
+        with open(os.path.join(local_path, '.git', 'index.lock'), 'w', encoding='utf-8'):
+            pass
+
+        repo = self.new_persistent_repo_manager().repo_for_project(project)
+
+        assert repo.local_path == local_path
+        assert not os.path.exists(os.path.join(local_path, '.git', 'index.lock'))
+        assert [call.split(' git ')[1] for call in get_git_calls(git_run)] == [
+            f'-C {local_path} remote set-url origin {project.ssh_url_to_repo}',
+            f'-C {local_path} fsck --connectivity-only --no-dangling --no-progress',
+            f'-C {local_path} rebase --abort',
+            f'-C {local_path} merge --abort',
+            f'-C {local_path} cherry-pick --abort',
+            f'-C {local_path} reset --hard',
+            f'-C {local_path} clean -fdx',
+            f'-C {local_path} fetch --prune origin',
+            f'-C {local_path} config user.email pparker@bugle.com',
+            f"-C {local_path} config user.name 'Peter Parker'",
+        ]
+
+    def test_reclones_broken_persistent_clone(self, git_run):
+        project = self.new_project(1234, 'some/stuff')
+        local_path = os.path.join(self.root_dir.name, '1234')
+        os.makedirs(os.path.join(local_path, '.git'))
+
+        def run(*args, **_kwargs):
+            if 'fsck' in args:
+                raise subprocess.CalledProcessError(4, args)
+            return mock.DEFAULT
+        git_run.side_effect = run
+
+        repo = self.new_persistent_repo_manager().repo_for_project(project)
+
+        assert not os.path.exists(local_path)  # removed, then (not really) cloned again
+        assert [call.split(' git ')[1] for call in get_git_calls(git_run)] == [
+            f'-C {local_path} remote set-url origin {project.ssh_url_to_repo}',
+            f'-C {local_path} fsck --connectivity-only --no-dangling --no-progress',
+            f'clone --origin=origin {project.ssh_url_to_repo} {repo.local_path}',
+            f'-C {local_path} config user.email pparker@bugle.com',
+            f"-C {local_path} config user.name 'Peter Parker'",
+        ]
+
+    def test_clone_strategy_per_project(self, git_run):
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user,
+            root_dir=self.root_dir.name,
+            skip_clone=False,
+            clone_strategy=marge.git.CloneStrategy.shallow,
+            clone_strategy_overrides=[(re.compile('big/'), marge.git.CloneStrategy.blobless)],
+        )
+        small, big = self.new_project(1234, 'some/stuff'), self.new_project(5678, 'big/monorepo')
+
+        assert repo_manager.repo_for_project(small).clone_strategy is marge.git.CloneStrategy.shallow
+        assert repo_manager.repo_for_project(big).clone_strategy is marge.git.CloneStrategy.blobless
+
+        clones = [call for call in get_git_calls(git_run) if ' clone ' in f' {call} ']
+        assert clones[0].startswith('git clone --origin=origin --depth=50 --no-single-branch ')
+        assert clones[1].startswith('git clone --origin=origin --filter=blob:none ')
+
+    def test_targeted_fetch_prunes_idle_repos(self, git_run):
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user, root_dir=self.root_dir.name, skip_clone=False, targeted_fetch=True,
+        )
+        idle, busy = self.new_project(1234, 'some/stuff'), self.new_project(5678, 'other/things')
+        idle_repo = repo_manager.repo_for_project(idle)
+        repo_manager.repo_for_project(busy)
+        assert f'git -C {idle_repo.local_path} config protocol.version 2' in get_git_calls(git_run)
+        git_run.reset_mock()
+
+        busy_lock = repo_manager.project_lock(busy)
+        with busy_lock:
+            thread = threading.Thread(target=repo_manager.prune_idle_repos)
+            thread.start()
+            thread.join()
+
+        assert get_git_calls(git_run) == [f'git -C {idle_repo.local_path} remote prune origin']
+
+    def test_pruning_runs_in_the_background(self, unused_git_run):
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user, root_dir=self.root_dir.name, skip_clone=False,
+            targeted_fetch=True, prune_interval=0.01,
+        )
+        pruned = threading.Event()
+        with mock.patch.object(repo_manager, 'prune_idle_repos', side_effect=pruned.set):
+            with repo_manager.pruning():
+                assert pruned.wait(5)
+
+    def test_worktrees_are_recycled(self, git_run):
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user, root_dir=self.root_dir.name, skip_clone=False, worktrees=True,
+        )
+        project = self.new_project(1234, 'some/stuff')
+
+        with repo_manager.checkout(project) as worktree:
+            clone = repo_manager.repo_for_project(project)
+            assert worktree.local_path == f'{clone.local_path}.worktrees/1'
+            assert worktree.remote_url == clone.remote_url
+        with repo_manager.checkout(project) as worktree_again:
+            assert worktree_again == worktree
+
+        recycle_calls = [
+            f'-C {worktree.local_path} rebase --abort',
+            f'-C {worktree.local_path} merge --abort',
+            f'-C {worktree.local_path} cherry-pick --abort',
+            f'-C {worktree.local_path} reset --hard',
+            f'-C {worktree.local_path} clean -fdx',
+            f'-C {worktree.local_path} checkout --detach',
+        ]
+        assert [call.removeprefix('git ') for call in get_git_calls(git_run)][3:] == [
+            f'-C {clone.local_path} worktree prune',
+            f'-C {clone.local_path} checkout --detach',
+            f'-C {clone.local_path} worktree add --detach {worktree.local_path}',
+            *recycle_calls,
+            *recycle_calls,
+        ]
+
+    def test_worktree_that_cannot_be_cleaned_up_is_removed(self, git_run):
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user, root_dir=self.root_dir.name, skip_clone=False, worktrees=True,
+        )
+        project = self.new_project(1234, 'some/stuff')
+
+        def run(*args, **_kwargs):
+            if 'reset' in args:
+                raise subprocess.CalledProcessError(128, args)
+            return mock.DEFAULT
+        git_run.side_effect = run
+
+        with repo_manager.checkout(project) as worktree:
+            pass
+        with repo_manager.checkout(project) as another_worktree:
+            pass
+
+        clone = repo_manager.repo_for_project(project)
+        remove_worktree = f'git -C {clone.local_path} worktree remove --force {worktree.local_path}'
+        assert remove_worktree in get_git_calls(git_run)
+        assert another_worktree.local_path == f'{clone.local_path}.worktrees/2'
+
+    def test_checkout_is_the_clone_without_worktrees(self, unused_git_run):
+        project = self.new_project(1234, 'some/stuff')
+        with self.repo_manager.checkout(project) as repo:
+            assert repo is self.repo_manager.repo_for_project(project)
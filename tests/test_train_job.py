@@ -0,0 +1,198 @@
+# pylint: disable=protected-access
+from unittest.mock import call, create_autospec, patch
+
+import pytest
+
+import marge.git
+import marge.project
+import marge.user
+from marge.batch_job import CannotBatch
+from marge.gitlab import DELETE, GET
+from marge.job import CannotMerge, MergeJobOptions
+from marge.merge_request import MergeRequest
+from marge.train_job import Car, MergeTrainJob
+from tests import create_bot_config
+from tests.gitlab_api_mock import MockLab
+
+
+class TestMergeTrainJob:
+
+    @pytest.fixture()
+    def mocklab(self):
+        return MockLab()
+
+    @pytest.fixture()
+    def api(self, mocklab):
+        return mocklab.api
+
+    def _mock_merge_request(self, **options):
+        return create_autospec(MergeRequest, spec_set=True, **options)
+
+    def get_train_job(self, api, mocklab, merge_requests, train_length=2):
+        project_id = mocklab.project_info['id']
+        user = marge.user.User.myself(api)
+        options = MergeJobOptions.default()
+        return MergeTrainJob(
+            api=api,
+            user=user,
+            project=marge.project.Project.fetch_by_id(project_id, api),
+            repo=create_autospec(marge.git.Repo, spec_set=True),
+            config=create_bot_config(user, options),
+            options=options,
+            merge_requests=merge_requests,
+            train_length=train_length,
+        )
+
+    def _run(self, train_job, failing=()):
+        """Run the train, where the CI of the cars of MRs with iids in `failing` fails once."""
+        failing = set(failing)
+        events = []
+
+        def add_car(merge_request):
+            events.append(('board', merge_request.iid))
+            branch = train_job.car_branch(merge_request)
+            car_mr = self._mock_merge_request(iid=100 + merge_request.iid, source_branch=branch)
+            car_mr.close.side_effect = lambda: events.append(('close', car_mr.iid))
+            car = Car(merge_request, branch, f'sha-{merge_request.iid}', car_mr)
+            train_job._cars.append(car)
+            return car
+
+        def wait_for_ci_to_pass(car_mr, commit_sha):
+            iid = car_mr.iid - 100
+            assert car_mr.source_branch == f'marge_bot_train/{iid}'
+            assert commit_sha == f'sha-{iid}'
+            if iid in failing:
+                failing.remove(iid)
+                raise CannotMerge('CI failed!')
+
+        def depart(car, target_sha):
+            events.append(('merge', car.merge_request.iid))
+            train_job.merged_merge_requests.append(car.merge_request)
+            return target_sha
+
+        with patch.multiple(
+                train_job,
+                add_car=add_car,
+                wait_for_ci_to_pass=wait_for_ci_to_pass,
+                depart=depart,
+                remove_train_branches=lambda: None,
+                close_train_mrs=lambda: None,
+                remove_remote_branch=lambda branch: events.append(('remove', branch)),
+                get_mergeable_mrs=lambda merge_requests: merge_requests,
+                unassign_from_mr=lambda merge_request: events.append(('unassign', merge_request.iid)),
+        ), patch('marge.train_job.Pipeline') as pipeline_class:
+            pipeline_class.pipelines_by_merge_request.return_value = []
+            train_job.execute()
+        return events
+
+    def test_merges_in_order(self, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=i, target_branch='master') for i in range(1, 5)]
+        train_job = self.get_train_job(api, mocklab, merge_requests)
+
+        events = self._run(train_job)
+
+        assert [event for event in events if event[0] not in ('remove', 'close')] == [
+            ('board', 1), ('board', 2),
+            ('merge', 1), ('board', 3),
+            ('merge', 2), ('board', 4),
+            ('merge', 3),
+            ('merge', 4),
+        ]
+        assert train_job.merged_merge_requests == merge_requests
+
+    def test_failure_rebuilds_the_cars_behind(self, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=i, target_branch='master') for i in range(1, 5)]
+        train_job = self.get_train_job(api, mocklab, merge_requests, train_length=3)
+
+        events = self._run(train_job, failing=[2])
+
+        assert [event for event in events if event[0] not in ('remove', 'close')] == [
+            ('board', 1), ('board', 2), ('board', 3),
+            ('merge', 1), ('board', 4),
+            ('unassign', 2),
+            # 3 and 4 were tested with 2 ahead of them
+            ('board', 3), ('board', 4),
+            ('merge', 3),
+            ('merge', 4),
+        ]
+        assert ('remove', 'marge_bot_train/3') in events
+        assert ('close', 102) in events
+        merge_requests[1].comment.assert_called_once_with(
+            "I couldn't merge this merge request: CI of marge_bot_train/2 failed: CI failed!",
+        )
+        assert train_job.merged_merge_requests == [merge_requests[0], merge_requests[2], merge_requests[3]]
+
+    def test_not_enough_merge_requests(self, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=1, target_branch='master')]
+        train_job = self.get_train_job(api, mocklab, merge_requests)
+
+        with pytest.raises(CannotBatch):
+            self._run(train_job)
+
+    def test_remove_train_branches(self, api, mocklab):
+        train_job = self.get_train_job(api, mocklab, [])
+        project_id = mocklab.project_info['id']
+        with patch.object(api, 'collect_all_pages') as collect_all_pages, \
+                patch.object(api, 'call') as api_call:
+            collect_all_pages.return_value = [{'name': 'marge_bot_train/12'}, {'name': 'marge_bot_train/13'}]
+            train_job.remove_train_branches()
+
+        collect_all_pages.assert_called_once_with(
+            GET(f'/projects/{project_id}/repository/branches', {'search': '^marge_bot_train/'}),
+        )
+        assert api_call.call_args_list == [
+            call(DELETE(f'/projects/{project_id}/repository/branches/marge_bot_train%2F12')),
+            call(DELETE(f'/projects/{project_id}/repository/branches/marge_bot_train%2F13')),
+        ]
+
+    def test_close_train_mrs(self, api, mocklab):
+        train_job = self.get_train_job(api, mocklab, [])
+        with patch('marge.train_job.MergeRequest') as mr_class:
+            car_mr = self._mock_merge_request()
+            mr_class.search.return_value = [car_mr]
+            train_job.close_train_mrs()
+
+        mr_class.search.assert_called_once_with(
+            api=api,
+            project_id=mocklab.project_info['id'],
+            params={'author_id': train_job._user.id, 'labels': 'marge_bot_train', 'state': 'opened'},
+        )
+        car_mr.close.assert_called_once_with()
+
+    def test_add_car(self, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(
+                iid=i, target_branch='master', source_branch=f'feature-{i}',
+                source_project_id=mocklab.project_info['id'],
+            )
+            for i in (1, 2)
+        ]
+        train_job = self.get_train_job(api, mocklab, merge_requests)
+        repo = train_job._repo
+        repo.fast_forward.side_effect = ['sha-1', 'sha-2']
+        car_mrs = [self._mock_merge_request(iid=iid) for iid in (11, 12)]
+
+        with patch('marge.train_job.MergeRequest') as mr_class:
+            mr_class.create.side_effect = car_mrs
+            first, second = [train_job.add_car(merge_request) for merge_request in merge_requests]
+
+        assert first == Car(merge_requests[0], 'marge_bot_train/1', 'sha-1', car_mrs[0])
+        assert second == Car(merge_requests[1], 'marge_bot_train/2', 'sha-2', car_mrs[1])
+        # Each car gets an MR of its own, so that merge request pipelines run for it
+        assert mr_class.create.call_args_list == [
+            call(api=api, project_id=mocklab.project_info['id'], params={
+                'source_branch': f'marge_bot_train/{i}',
+                'target_branch': 'master',
+                'title': f'Marge Bot Train car of !{i} - DO NOT TOUCH',
+                'labels': 'marge_bot_train',
+            })
+            for i in (1, 2)
+        ]
+        assert repo.rebase.call_args_list == [
+            call('feature-1', 'master', source_remote=None, local=True),
+            call('feature-2', 'marge_bot_train/1', source_remote=None, local=True),
+        ]
+        assert repo.push.call_args_list == [
+            call('marge_bot_train/1', force=True),
+            call('marge_bot_train/2', force=True),
+        ]
@@ -0,0 +1,134 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from marge import webhook
+
+
+MERGE_REQUEST_EVENT = {
+    'object_kind': 'merge_request',
+    'project': {'id': 1234},
+    'object_attributes': {'iid': 54, 'target_project_id': 1234, 'state': 'opened'},
+}
+
+PIPELINE_EVENT = {
+    'object_kind': 'pipeline',
+    'project': {'id': 1234},
+    'object_attributes': {'id': 47, 'status': 'success', 'sha': 'dead4g00d'},
+    'merge_request': {'iid': 54},
+}
+
+NOTE_EVENT = {
+    'object_kind': 'note',
+    'project_id': 1234,
+    'object_attributes': {'id': 1, 'noteable_type': 'MergeRequest'},
+    'merge_request': {'iid': 54},
+}
+
+
+class TestEvent:
+    def test_merge_request_event(self):
+        event = webhook.Event(webhook.MERGE_REQUEST_HOOK, MERGE_REQUEST_EVENT)
+        assert (event.project_id, event.merge_request_iid) == (1234, 54)
+        assert event.pipeline_id is None
+
+    def test_pipeline_event(self):
+        event = webhook.Event(webhook.PIPELINE_HOOK, PIPELINE_EVENT)
+        assert (event.project_id, event.merge_request_iid) == (1234, 54)
+        assert (event.pipeline_id, event.pipeline_status) == (47, 'success')
+
+    def test_pipeline_event_without_merge_request(self):
+        event = webhook.Event(webhook.PIPELINE_HOOK, dict(PIPELINE_EVENT, merge_request=None))
+        assert event.merge_request_iid is None
+
+    def test_note_event(self):
+        event = webhook.Event(webhook.NOTE_HOOK, NOTE_EVENT)
+        assert (event.project_id, event.merge_request_iid) == (1234, 54)
+
+
+class TestEventHub:
+    def test_publishes_to_subscribers(self):
+        hub = webhook.EventHub()
+        received = []
+        hub.subscribe(received.append)
+        event = webhook.Event(webhook.NOTE_HOOK, NOTE_EVENT)
+        hub.publish(event)
+        assert received == [event]
+
+    def test_wait_for_times_out(self):
+        hub = webhook.EventHub()
+        assert hub.wait_for(lambda event: True, timeout=0.01) is None
+
+    def test_wait_for_sees_events_since_cursor(self):
+        hub = webhook.EventHub()
+        cursor = hub.cursor()
+        note = webhook.Event(webhook.NOTE_HOOK, NOTE_EVENT)
+        pipeline = webhook.Event(webhook.PIPELINE_HOOK, PIPELINE_EVENT)
+        hub.publish(note)
+        hub.publish(pipeline)
+
+        assert hub.wait_for(lambda event: event.pipeline_id == 47, timeout=0, since=cursor) == pipeline
+        # without a cursor, only future events count
+        assert hub.wait_for(lambda event: True, timeout=0) is None
+
+    def test_wait_for_wakes_up(self):
+        hub = webhook.EventHub()
+        pipeline = webhook.Event(webhook.PIPELINE_HOOK, PIPELINE_EVENT)
+        timer = threading.Timer(0.05, hub.publish, args=(pipeline,))
+        timer.start()
+        try:
+            assert hub.wait_for(lambda event: event.pipeline_id == 47, timeout=10) == pipeline
+        finally:
+            timer.cancel()
+
+
+class TestWebhookServer:
+
+    @pytest.fixture()
+    def server(self):
+        server = webhook.WebhookServer(('127.0.0.1', 0), hub=webhook.EventHub(), secret='s3cr3t')
+        server.start()
+        yield server
+        server.stop()
+
+    @staticmethod
+    def post(server, kind, payload, token='s3cr3t'):
+        host, port = server.server_address[:2]
+        request = urllib.request.Request(
+            f'http://{host}:{port}/',
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'X-Gitlab-Event': kind, 'X-Gitlab-Token': token, 'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as err:
+            return err.code
+
+    def test_publishes_events(self, server):
+        received = []
+        server.hub.subscribe(received.append)
+        assert self.post(server, webhook.MERGE_REQUEST_HOOK, MERGE_REQUEST_EVENT) == 200
+        assert received == [webhook.Event(webhook.MERGE_REQUEST_HOOK, MERGE_REQUEST_EVENT)]
+
+    def test_rejects_bad_token(self, server):
+        received = []
+        server.hub.subscribe(received.append)
+        assert self.post(server, webhook.MERGE_REQUEST_HOOK, MERGE_REQUEST_EVENT, token='wrong') == 401
+        assert not received
+
+    def test_ignores_unknown_events(self, server):
+        received = []
+        server.hub.subscribe(received.append)
+        assert self.post(server, 'Push Hook', {'object_kind': 'push'}) == 204
+        assert not received
+
+
+def test_parse_address():
+    assert webhook.parse_address('8080') == ('0.0.0.0', 8080)
+    assert webhook.parse_address('127.0.0.1:8080') == ('127.0.0.1', 8080)
+    with pytest.raises(ValueError):
+        webhook.parse_address('localhost:http')